@@ -1,16 +1,31 @@
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from pyramid_beaker import session_factory_from_settings
 
+from biopyramid.views import mutex
+from biopyramid.models.geneindex import GeneIndex
+
 def main(global_config, **settings):
 	""" This function returns a Pyramid WSGI application.
 	"""
 	session_factory = session_factory_from_settings(settings)
 
+	# Extend file locks across processes when multiple workers serve the same dataset files
+	mutex.manager.processLocks = asbool(settings.get('biopyramid.model.process_locks', False))
+
 	config = Configurator(settings=settings)
+
+	# Build the gene search index now rather than on the first search
+	if asbool(settings.get('biopyramid.genes.preload_index', False)):
+		config.registry.geneIndex = GeneIndex()
 	config.set_session_factory(session_factory)
 
 	config.include('pyramid_mako')
 
+	# Request timings and dataset file metrics served at /metrics
+	if asbool(settings.get('biopyramid.metrics.enabled', False)):
+		config.include('biopyramid.views.metrics')
+
 	config.add_static_view('static', 'static', cache_max_age=3600)
 	config.add_static_view('css', 'static/css')
 	config.add_static_view('images', 'static/images')
@@ -20,11 +35,21 @@ def main(global_config, **settings):
 	
 	config.add_route('/genes', '/genes')
 	config.add_route('/gene_search','/gene_search')
+	config.add_route('/gene_autocomplete','/gene_autocomplete')
 	
 	config.add_route('/datasets', '/datasets')
 	
 	config.add_route('/pca', '/pca')	
+	config.add_route('/pca_coords', '/pca_coords')
 	config.add_route('/expression', '/expression')
+	config.add_route('/expression_values', '/expression_values')
+	config.add_route('/coexpression', '/coexpression')
+	config.add_route('/differential_expression', '/differential_expression')
+	config.add_route('/download', '/download')
+
+	config.add_route('/jobs/submit', '/jobs/submit')
+	config.add_route('/jobs/status', '/jobs/status')
+	config.add_route('/jobs/result', '/jobs/result')
 	
 	config.scan()
 	return config.make_wsgi_app()
@@ -7,12 +7,152 @@ At one stage, the HDF file created by the dataset had issues when multiple users
 the same dataset at exactly the same moment (it crashed the server!), even though the file was read only. 
 Hence we came up with a way to "lock" the file briefly while one user accesses it through this 
 mutual exclusion (mutex) system. Even though there have been updates to HDF packages since these issues 
-(late 2016), we've kept the code here as a safeguard.
+(late 2016), we've kept the code here as a safeguard. Each file now has its own reader/writer lock, so users
+reading different datasets, or reading the same dataset, do not wait on each other; only writing to a file
+requires exclusive access (see biopyramid.views.mutex). Reading threads use handles of their own (see openStore()).
 """
-import pandas
+import os, glob, math, logging, json, hashlib, collections, threading, warnings
+from contextlib import contextmanager
+import numpy, pandas, tables
 import genedataset.dataset
 import biopyramid.views.mutex as mutex
 
+log = logging.getLogger(__name__)
+
+# --------------------------------------------------
+# Shared file handles
+# --------------------------------------------------
+# Open HDFStores of each dataset file, shared by all BPDataset instances of the file within the process, so that
+# reading an object does not open and close the file each time. A handle is not safe to use from several threads 
+# at once, so a thread reading a file takes a handle out of the file's pool of idle handles (opening a new one if
+# there is none) and puts it back when done: threads reading the same file, or different files, don't wait on each
+# other, and a file has at most as many handles as threads which have read it at once. 
+# _storePools: {abspath: [(HDFStore, file signature), ...]} holds the idle handles, and _storeGenerations: {abspath: int}
+# is increased by closeStore(), so that handles in use when it is called are closed rather than put back.
+# _storesLock only guards these dictionaries; handles are opened and closed outside it.
+_storePools = {}
+_storeGenerations = {}
+_storesLock = threading.Lock()
+_threadStores = threading.local()	# handles in use by the current thread: {abspath: HDFStore}
+
+@contextmanager
+def openStore(filepath):
+	"""
+	Context manager giving a read only pandas.HDFStore for filepath, which stays open for later use.
+	The underlying PyTables file is store._handle. Each thread gets a handle of its own, which is used again by
+	openStore() blocks nested inside this one. The store is reopened if the file has changed, and closed when a
+	thread starts writing to the file (see closeStore()). A thread which is writing to the file gets its own 
+	handle, which is closed on exit, as PyTables cannot open a file for writing while it is open for reading.
+	"""
+	key = os.path.abspath(filepath)
+	with mutex.reading(filepath):
+		if mutex.isWriting(filepath):
+			store = pandas.HDFStore(filepath, mode='r')
+			try:
+				yield store
+			finally:
+				store.close()
+			return
+
+		held = _threadStores.__dict__.setdefault('stores', {})
+		if key in held:	# nested inside another openStore() block of this thread
+			yield held[key]
+			return
+
+		store, signature, generation = _takeStore(key, filepath)
+		held[key] = store
+		try:
+			yield store
+		finally:
+			del held[key]
+			with _storesLock:
+				if generation==_storeGenerations.get(key, 0) and store.is_open:
+					_storePools.setdefault(key, []).append((store, signature))
+					store = None
+			if store is not None:
+				store.close()
+
+def _takeStore(key, filepath):
+	# Return (HDFStore, file signature, generation) of an idle handle of the current version of filepath, 
+	# opening a new one if there is none. Idle handles of earlier versions of the file are closed.
+	signature = _fileSignature(filepath)
+	store, stale = None, []
+	with _storesLock:
+		generation = _storeGenerations.get(key, 0)
+		pool = _storePools.get(key, [])
+		while pool and store is None:
+			candidate, candidateSignature = pool.pop()
+			if candidateSignature==signature and candidate.is_open:
+				store = candidate
+			else:
+				stale.append(candidate)
+	for candidate in stale:
+		candidate.close()
+	if store is None:
+		store = pandas.HDFStore(filepath, mode='r')
+	return store, signature, generation
+
+def closeStore(filepath=None):
+	"""Close the shared HDFStores of filepath, or of all files if filepath is None. Handles in use by other threads
+	are closed when they are done with them. Called whenever a thread starts writing to the file. 
+	The file is opened again when it is next used.
+	"""
+	stores = []
+	with _storesLock:
+		keys = set(_storePools.keys()) | set(_storeGenerations.keys()) if filepath is None else [os.path.abspath(filepath)]
+		for key in keys:
+			_storeGenerations[key] = _storeGenerations.get(key, 0) + 1
+			stores.extend(store for store, signature in _storePools.pop(key, []))
+	for store in stores:
+		store.close()
+
+mutex.manager.writeHooks.append(closeStore)
+
+def _fileSignature(filepath):
+	stat = os.stat(filepath)
+	return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+class DatasetFileChanged(IOError):
+	"""Raised when a dataset file is written or replaced while values are read from it over several reads.
+	"""
+
+# Functions called with (filepath, object) whenever an object is read from a dataset file, eg. to collect metrics.
+# Hooks which need the size of the object can get it from objectBytes().
+readHooks = []
+
+def objectBytes(obj):
+	"""Return the in-memory size in bytes of obj, a pandas object or numpy array read from a dataset file.
+	"""
+	if isinstance(obj, (pandas.DataFrame, pandas.Series)):
+		return int(numpy.sum(obj.memory_usage(index=True)))
+	return getattr(obj, 'nbytes', 0)
+
+def _objectRead(filepath, obj):
+	"""Call readHooks for obj read from filepath, and return obj.
+	"""
+	for hook in readHooks:
+		hook(filepath, obj)
+	return obj
+
+class StoredObject(object):
+	"""
+	BPDataset attribute holding the object stored in the dataset file at hdfKey, which is read the first
+	time the attribute is used and then kept in memory. Assigning to the attribute replaces the stored value.
+	"""
+	def __init__(self, hdfKey):
+		self.hdfKey = hdfKey
+
+	def __get__(self, dataset, owner):
+		if dataset is None:
+			return self
+		if self.hdfKey not in dataset._storedObjects:
+			with openStore(dataset.filepath) as store:
+				dataset._storedObjects[self.hdfKey] = _objectRead(dataset.filepath, store[self.hdfKey])
+		return dataset._storedObjects[self.hdfKey]
+
+	def __set__(self, dataset, value):
+		dataset._storedObjects[self.hdfKey] = value
+
 def createDatasetFile(destDir, **kwargs):
 	"""
 	This function extends genedataset.dataset.createDatasetFile() by adding more objects to the .h5
@@ -30,6 +170,17 @@ def createDatasetFile(destDir, **kwargs):
 		eg: {'cell_lineage': {'Stem Cell':'#cccccc', ...}, ... }
 	pca: (pandas.DataFrame) coordinates of PCA calculation to be stored. It should be in NxD shape, where
 		N is the number of samples in the data and D is the number of dimensions used for pca.
+	memmap: (boolean) if True, also write each expression matrix as a memory mapped float32 file next to
+		the .h5 file (see writeExpressionMemmap()).
+	correlation: (boolean) if True, also store normalised copies of each expression matrix used for 
+		co-expression searches (see writeCorrelationMatrices()).
+	groupSummaries: (boolean) if True, also store summary statistics of each gene for the items of each sample group
+		for display, so that plots can show them instead of every sample (see writeGroupSummaries()).
+	compression: (string) if specified, eg. 'blosc' or 'zlib', the file is rewritten with compressed objects and
+		expression matrices chunked for reading rows (see repackDatasetFile()).
+	dropFrames: (boolean) if True, expression matrices are only stored under /matrix/expression, and not also as
+		/dataframe/expression objects, so that the file does not hold each matrix twice. BPDataset reads such files,
+		but genedataset.dataset.Dataset does not (see writeExpressionFrame()), so this is False by default.
 
 	All parameters are optional and empty ones will be created if unspecified.
 	"""
@@ -37,25 +188,517 @@ def createDatasetFile(destDir, **kwargs):
 	sampleGroupOrdering = kwargs.get('sampleGroupOrdering', {})
 	sampleGroupColours = kwargs.get('sampleGroupColours', {})
 	pca = kwargs.get('pca', pandas.DataFrame())
-	ds = genedataset.dataset.createDatasetFile(destDir, **kwargs)
-	
-	instantiateDatasetFile(ds, sampleGroupsDisplayed, sampleGroupOrdering, sampleGroupColours, pca)		
+	dropFrames = kwargs.get('dropFrames', False)
+	expressions = kwargs.get('expressions')
+
+	# same file path as used by genedataset.dataset.createDatasetFile()
+	attributes = kwargs.get('attributes') or {}
+	filepath = os.path.join(destDir.rstrip('/'), '%s.%s.h5' % (attributes.get('name'), attributes.get('version')))
+	with mutex.writing(filepath):
+		# memory mapped files left from a previous version of this file would not match the new file
+		for path in glob.glob(expressionMemmapPath(filepath, '*')):
+			os.remove(path)
+
+		# genedataset gets matrices without rows, which still lets it check their sample ids, so that the values
+		# are only written once by writeExpressionRows()
+		if dropFrames and isinstance(expressions, list) and all(isinstance(df, pandas.DataFrame) for df in expressions):
+			kwargs = dict(kwargs, expressions=[df.iloc[:0] for df in expressions])
+		ds = genedataset.dataset.createDatasetFile(destDir, **kwargs)
+		if ds is None:	# genedataset prints the reason
+			return None
+		expressions = dict(zip(ds.expression_data_keys, expressions))
+		instantiateDatasetFile(ds, sampleGroupsDisplayed, sampleGroupOrdering, sampleGroupColours, pca, expressions=expressions)
+		if dropFrames:
+			store = pandas.HDFStore(ds.filepath, mode='a')
+			try:
+				for key in ds.expression_data_keys:
+					if expressions[key].size:	# an empty matrix has no /matrix/expression copy
+						store.remove('/dataframe/expression/%s' % key)
+			finally:
+				store.close()
+
+		if kwargs.get('compression'):
+			repackDatasetFile(ds.filepath, compression=kwargs['compression'], dropFrames=dropFrames)
+		if kwargs.get('memmap'):
+			for key in ds.expression_data_keys:
+				writeExpressionMemmap(ds.filepath, key, expressions[key])
+		if kwargs.get('correlation'):
+			for key in ds.expression_data_keys:
+				writeCorrelationMatrices(ds.filepath, key)
+		if kwargs.get('groupSummaries'):
+			for key in ds.expression_data_keys:
+				writeGroupSummaries(ds.filepath, key)
 
 	return BPDataset(ds.filepath)
 
 
-@mutex.mutual_exclusion
-def instantiateDatasetFile(ds, sampleGroupsDisplayed, sampleGroupOrdering, sampleGroupColours, pca):
-	"""This function is used to 
+def instantiateDatasetFile(ds, sampleGroupsDisplayed, sampleGroupOrdering, sampleGroupColours, pca, expressions=None):
+	"""This function is used to add the objects specific to BioPyramid to the file of ds,
+	a genedataset.dataset.Dataset instance. See createDatasetFile() for the parameters. expressions is a 
+	dictionary of expression matrices keyed on expression_data_key, ds.expressions by default.
+	"""
+	if expressions is None:
+		expressions = ds.expressions
+	with mutex.writing(ds.filepath):
+		store = ds.hdfStore()
+		store['/series/sampleGroupsDisplayed'] = pandas.Series(sampleGroupsDisplayed)
+		store['/series/sampleGroupOrdering'] = pandas.Series(sampleGroupOrdering)
+		store['/series/sampleGroupColours'] = pandas.Series(sampleGroupColours)
+		store['/dataframe/pca'] = pca
+		store.close()
+
+		for key in ds.expression_data_keys:
+			writeExpressionRows(ds.filepath, key, expressions[key])
+
+
+def writeExpressionRows(filepath, key, df, compression=None, complevel=5):
+	"""
+	Write expression matrix df to the file in a layout which allows individual rows to be read from disk,
+	so that fetching the expression profile of one gene does not require reading the whole matrix.
+	Three objects are written (and replaced if they exist):
+		/matrix/expression/[key]: values of df as a HDF5 array chunked by row
+		/series/featureIndex/[key]: row offset in the array keyed on feature id
+		/series/matrixColumns/[key]: sample ids matching the columns of the array
+	Files created before this layout existed can be updated by calling this function for each expression key.
+
+	Each chunk of the array holds one row, unless compression is specified (eg. 'blosc' or 'zlib'), in which
+	case the array is compressed with complevel and each chunk holds as many rows as fit in rowChunkshape().
+	"""
+	values = df.values
+	if values.dtype.kind not in 'iuf':
+		values = values.astype(float)
+	if values.size==0:
+		return
+
+	with mutex.writing(filepath):
+		h5 = tables.open_file(filepath, mode='a')
+		try:
+			path = '/matrix/expression/%s' % key
+			if path in h5:
+				h5.remove_node(path)
+			if compression:
+				h5.create_carray('/matrix/expression', key, obj=values, chunkshape=rowChunkshape(values.shape, values.dtype.itemsize),
+								 filters=compressionFilters(compression, complevel), createparents=True)
+			else:
+				h5.create_carray('/matrix/expression', key, obj=values, chunkshape=(1, values.shape[1]), createparents=True)
+		finally:
+			h5.close()
+
+		store = pandas.HDFStore(filepath, mode='a')
+		try:
+			store['/series/featureIndex/%s' % key] = pandas.Series(numpy.arange(len(df)), index=df.index)
+			store['/series/matrixColumns/%s' % key] = pandas.Series(df.columns)
+		finally:
+			store.close()
+
+def rowChunkshape(shape, itemsize, chunkBytes=32768):
+	"""Return the chunk shape for a compressed matrix of shape which is read a row at a time: each chunk holds
+	whole rows, as many as fit in chunkBytes. Reading one row then decompresses at most chunkBytes, while chunks
+	are still big enough to compress well.
+	"""
+	rows = chunkBytes // max(1, shape[1] * itemsize)
+	return (max(1, min(rows, shape[0])), shape[1])
+
+def compressionFilters(compression='blosc', complevel=5):
+	"""Return tables.Filters for compression, which is a compression library known to PyTables, eg. 'blosc',
+	'blosc:lz4' or 'zlib'. zlib is used if the library is not available.
+	"""
+	if tables.which_lib_version(compression.split(':')[0]) is None:
+		log.warning("Compression library %s is not available, using zlib", compression)
+		compression = 'zlib'
+	return tables.Filters(complevel=complevel, complib=compression, shuffle=True)
+
+def repackDatasetFile(filepath, destpath=None, compression='blosc', complevel=5, dropFrames=False):
+	"""
+	Rewrite the dataset file at filepath with all objects compressed, and expression matrices under /matrix/expression
+	chunked for reading rows (see writeExpressionRows()). Compressed files are smaller, so more datasets fit in the
+	page cache, and reading a gene only reads and decompresses the chunk holding its row.
+
+	If dropFrames is True, /dataframe/expression/[key] objects are left out, as BPDataset reads the expression 
+	matrices from /matrix/expression/[key] when they are missing (genedataset.dataset.Dataset can't read the file then). Files created before the row layout existed get it.
+	The new file is written to a temporary file first, then renamed to destpath (filepath by default), so that
+	readers never see a partially written file. Memory mapped files (see writeExpressionMemmap()) stay valid.
+	"""
+	destpath = destpath or filepath
+	tmppath = '%s.%s.tmp' % (destpath, os.getpid())
+	filters = compressionFilters(compression, complevel)
+
+	with mutex.reading(filepath):
+		# objects written by pandas
+		src = pandas.HDFStore(filepath, mode='r')
+		dst = pandas.HDFStore(tmppath, mode='w', complevel=complevel, complib=filters.complib)
+		try:
+			expressionKeys = src['/series/attributes']['expression_data_keys']
+			for key in src.keys():
+				if not (dropFrames and key.startswith('/dataframe/expression/')):
+					dst.put(key, src[key])
+		finally:
+			dst.close()
+			src.close()
+
+		# arrays written by PyTables
+		missingRows = []
+		src = tables.open_file(filepath, mode='r')
+		dst = tables.open_file(tmppath, mode='a')
+		try:
+			for key in expressionKeys:
+				path = '/matrix/expression/%s' % key
+				if path not in src:
+					missingRows.append(key)
+					continue
+				node = src.get_node(path)
+				_copyArray(node, dst, rowChunkshape(node.shape, node.atom.itemsize), filters)
+			if '/matrix' in src:	# other matrices, eg. those written by writeCorrelationMatrices()
+				for node in src.walk_nodes('/matrix', 'Leaf'):
+					if not node._v_pathname.startswith('/matrix/expression/'):
+						_copyArray(node, dst, node.chunkshape, filters)
+		finally:
+			dst.close()
+			src.close()
+
+		for key in missingRows:	# file created before the row layout existed
+			df = pandas.read_hdf(filepath, '/dataframe/expression/%s' % key)
+			writeExpressionRows(tmppath, key, df, compression=filters.complib, complevel=complevel)
+
+	with mutex.writing(destpath):
+		os.rename(tmppath, destpath)
+	return destpath
+
+def _copyArray(node, h5, chunkshape, filters, blockSize=1000):
+	"""Copy PyTables array node to the same path in h5, another open file, blockSize rows at a time.
 	"""
-	store = ds.hdfStore()
-	store['/series/sampleGroupsDisplayed'] = pandas.Series(sampleGroupsDisplayed)
-	store['/series/sampleGroupOrdering'] = pandas.Series(sampleGroupOrdering)
-	store['/series/sampleGroupColours'] = pandas.Series(sampleGroupColours)
-	store['/dataframe/pca'] = pca
-	store.close()
+	array = h5.create_carray(node._v_parent._v_pathname, node.name, atom=node.atom, shape=node.shape, 
+							 chunkshape=chunkshape, filters=filters, createparents=True)
+	node.attrs._f_copy(array)
+	for start in range(0, node.shape[0], blockSize):
+		array[start:start + blockSize] = node[start:start + blockSize]
 
+# Maximum number of results kept in the PCA cache directory of a dataset, see pcaCachePath()
+pcaCacheSize = 200
+
+def pcaCachePath(filepath):
+	"""Return the directory holding PCA results saved by BPDataset.computePCA(store=True), which sits next to
+	the dataset file, eg: '/data/haemopedia.2.7.h5' -> '/data/haemopedia.2.7.pcacache'. Only the pcaCacheSize
+	most recently saved results are kept.
+	"""
+	return '%s.pcacache' % os.path.splitext(filepath)[0]
+
+def _readCachedPCA(filepath, name):
+	path = os.path.join(pcaCachePath(filepath), '%s.pkl' % name)
+	try:
+		return pandas.read_pickle(path)
+	except (IOError, OSError):
+		return None
+
+def _writeCachedPCA(filepath, name, df):
+	"""Save df in the PCA cache directory of filepath, removing the oldest results beyond pcaCacheSize.
+	Files are written under a temporary name then renamed, so other processes never read a partial file.
+	Failures (eg. a read only directory) are logged, as the cache is optional.
+	"""
+	directory = pcaCachePath(filepath)
+	path = os.path.join(directory, '%s.pkl' % name)
+	tmppath = '%s.%s.tmp' % (path, os.getpid())
+	try:
+		os.makedirs(directory, exist_ok=True)
+		df.to_pickle(tmppath)
+		os.rename(tmppath, path)
+		paths = glob.glob(os.path.join(directory, '*.pkl'))
+		if len(paths)>pcaCacheSize:
+			paths.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+			for path in paths[:len(paths) - pcaCacheSize]:
+				try:
+					os.remove(path)
+				except OSError:	# removed by another process
+					pass
+	except (IOError, OSError):
+		log.warning("Could not save PCA result in %s", directory, exc_info=True)
+
+def expressionMemmapPath(filepath, key):
+	"""Return the path of the memory mapped file holding expression matrix for key, which sits next to
+	the dataset file, eg: '/data/haemopedia.2.7.h5' -> '/data/haemopedia.2.7.expression.normalised.npy'
+	"""
+	return '%s.expression.%s.npy' % (os.path.splitext(filepath)[0], key)
+
+def writeExpressionMemmap(filepath, key, df=None, blockSize=1000):
+	"""
+	Write expression matrix for key as a contiguous float32 array (numpy .npy format) to expressionMemmapPath().
+	BPDataset opens this file with numpy.memmap, so that all processes serving the dataset share the operating
+	system's page cache instead of each holding a private copy of the matrix.
+
+	Rows and columns must be in the same order as /matrix/expression/[key] (see writeExpressionRows()).
+	If df is None, values are copied from /matrix/expression/[key], blockSize rows at a time, so that
+	existing files can be converted without reading the whole matrix into memory.
+	"""
+	from numpy.lib.format import open_memmap
+	path = expressionMemmapPath(filepath, key)
+	tmppath = '%s.%s.tmp' % (path, os.getpid())
+
+	with mutex.reading(filepath):
+		h5 = tables.open_file(filepath, mode='r') if df is None else None
+		try:
+			node = h5.get_node('/matrix/expression/%s' % key) if h5 else None
+			shape = node.shape if node is not None else df.shape
+			mm = open_memmap(tmppath, mode='w+', dtype=numpy.float32, shape=shape)
+			for start in range(0, shape[0], blockSize):
+				mm[start:start + blockSize] = node[start:start + blockSize] if node is not None else df.values[start:start + blockSize]
+			mm.flush()
+			del mm
+		finally:
+			if h5:
+				h5.close()
+
+	with mutex.writing(filepath):
+		os.rename(tmppath, path)
+		os.utime(filepath, None)	# so that processes holding this dataset open it again
+
+def writeExpressionFrame(filepath, key, blockSize=1000):
+	"""
+	Store /dataframe/expression/[key], the expression matrix read by genedataset.dataset.Dataset, from 
+	/matrix/expression/[key] (see writeExpressionRows()), for files written without it (see dropFrames of 
+	createDatasetFile()). Values are copied blockSize rows at a time, so the whole matrix is never held in memory.
+	"""
+	path = '/dataframe/expression/%s' % key
+	with mutex.writing(filepath):
+		ds = BPDataset(filepath)
+		index = ds.featureIndex(key)
+		if index is None:	# the matrix is empty, or the file has no row layout and so has the frame already
+			return
+		h5 = tables.open_file(filepath, mode='r')
+		try:
+			first = h5.get_node('/matrix/expression/%s' % key)[:blockSize]
+		finally:
+			h5.close()
+
+		# pandas writes the frame in its fixed format from the first block of rows, then its values are replaced by an
+		# extendable array of all rows, and its index by that of a series written by pandas with all feature ids
+		store = pandas.HDFStore(filepath, mode='a')
+		try:
+			store.put(path, pandas.DataFrame(first, index=index.index[:len(first)], columns=ds.expressionColumns(key)))
+			store.put('%s_index' % path, pandas.Series(numpy.zeros(len(index), dtype=numpy.int8), index=index.index))
+		finally:
+			store.close()
+		h5 = tables.open_file(filepath, mode='a')
+		try:
+			node = h5.get_node('/matrix/expression/%s' % key)
+			group = h5.get_node(path)
+			attrs = dict((name, group.block0_values._v_attrs[name]) for name in group.block0_values._v_attrs._f_list())
+			h5.remove_node(group, 'block0_values')
+			values = h5.create_earray(group, 'block0_values', atom=tables.Atom.from_dtype(first.dtype), shape=(0, node.shape[1]),
+									  filters=node.filters)
+			for name, value in attrs.items():
+				values._v_attrs[name] = value
+			for start in range(0, node.shape[0], blockSize):
+				values.append(node[start:start + blockSize])
+			h5.remove_node(group, 'axis1')
+			h5.move_node('%s_index/index' % path, group, 'axis1')
+			h5.remove_node('%s_index' % path, recursive=True)
+		finally:
+			h5.close()
+
+def normalisedRows(values, method='pearson', log=True):
+	"""
+	Return float32 numpy array of values (features as rows, samples as columns) with each row centred and scaled
+	to unit length, so that the dot product of two rows is their correlation coefficient. method is 'pearson'
+	(using log2(x+1) values if log is True) or 'spearman' (using ranks within each row, with ties averaged).
+	Rows with no variance, and missing values, are set to 0.
+	"""
+	values = numpy.asarray(values, dtype=float)
+	if method=='spearman':
+		values = pandas.DataFrame(values).rank(axis=1).values
+	elif log:
+		values = numpy.log2(values + 1)
+	with numpy.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)	# rows of missing values only
+		values = values - numpy.nanmean(values, axis=1)[:,numpy.newaxis]
+		values = numpy.nan_to_num(values)
+		norms = numpy.sqrt((values * values).sum(axis=1))
+		values = numpy.where(norms[:,numpy.newaxis]>0, values / norms[:,numpy.newaxis], 0)
+	return values.astype(numpy.float32)
+
+def _nonNegative(values):
+	"""Return False if values has negative values, ignoring missing values (True if there are none).
+	"""
+	values = numpy.asarray(values, dtype=float)
+	if values.size==0:
+		return True
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)	# all values missing
+		return not numpy.nanmin(values)<0
+
+def writeCorrelationMatrices(filepath, key, blockSize=1000):
+	"""
+	Store normalised copies of the expression matrix for key (see normalisedRows()), which BPDataset uses to find
+	correlated features with a single matrix-vector product (see BPDataset.correlatedFeatures()):
+		/matrix/zscore/[key]: for pearson correlation of log2(x+1) values (or of the values themselves if the
+			matrix has negative values, as it is then assumed to be on log scale already)
+		/matrix/zrank/[key]: for spearman correlation
+	Rows match /matrix/expression/[key], which is written by writeExpressionRows() if it does not exist yet.
+	Values are processed blockSize rows at a time, so the whole matrix is never held in memory.
+	"""
+	with mutex.writing(filepath):
+		ds = BPDataset(filepath)
+		if ds.featureIndex(key) is None:	# file created before the row layout existed
+			writeExpressionRows(filepath, key, ds.expressions[key])
+
+		h5 = tables.open_file(filepath, mode='a')
+		try:
+			node = h5.get_node('/matrix/expression/%s' % key)
+			logValues = all(_nonNegative(node[start:start + blockSize]) for start in range(0, node.shape[0], blockSize))
+			for group, method in [('zscore', 'pearson'), ('zrank', 'spearman')]:
+				path = '/matrix/%s/%s' % (group, key)
+				if path in h5:
+					h5.remove_node(path)
+				array = h5.create_carray('/matrix/%s' % group, key, atom=tables.Float32Atom(), shape=node.shape, filters=node.filters,
+										 chunkshape=(max(1, min(blockSize, node.shape[0])), node.shape[1]), createparents=True)
+				for start in range(0, node.shape[0], blockSize):
+					array[start:start + blockSize] = normalisedRows(node[start:start + blockSize], method=method, log=logValues)
+		finally:
+			h5.close()
+
+# Statistics held by group summaries, in order, see groupSummaryValues()
+groupSummaryStats = ['mean', 'min', 'q1', 'median', 'q3', 'max']
+
+def groupSummaryValues(values, codes, numberOfItems):
+	"""
+	Return float32 numpy array of shape (rows, numberOfItems, len(groupSummaryStats)) holding the statistics in
+	groupSummaryStats of the log2(x+1) values of each row of values (features as rows, samples as columns) over the
+	samples of each sample group item. codes gives the item position of each column, -1 for samples not in any item.
+	Missing values are ignored, and items without values get NaN.
+	"""
+	values = numpy.log2(numpy.asarray(values, dtype=float) + 1)
+	codes = numpy.asarray(codes)
+	result = numpy.full((values.shape[0], numberOfItems, len(groupSummaryStats)), numpy.nan, dtype=numpy.float32)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)	# rows without values
+		for item in range(numberOfItems):
+			columns = values[:,codes==item]
+			if columns.size==0:
+				continue
+			result[:,item,0] = numpy.nanmean(columns, axis=1)
+			result[:,item,1:] = numpy.nanpercentile(columns, [0, 25, 50, 75, 100], axis=1).T
+	return result
+
+def writeGroupSummaries(filepath, key, sampleGroups=None, blockSize=1000):
+	"""
+	Store summary statistics (see groupSummaryValues()) of the expression matrix for key, for each item of each of
+	sampleGroups (sample groups for display by default), under /matrix/groupsummary/[key]/[sampleGroup].
+	Each is an array of features x items x statistics, with rows matching /matrix/expression/[key], which is written
+	by writeExpressionRows() if it does not exist yet. The items are held in its 'items' attribute.
+	Values are processed blockSize rows at a time, so the whole matrix is never held in memory.
+	"""
+	with mutex.writing(filepath):
+		ds = BPDataset(filepath)
+		if ds.featureIndex(key) is None:	# file created before the row layout existed
+			writeExpressionRows(filepath, key, ds.expressions[key])
+		if sampleGroups is None:
+			sampleGroups = ds.sampleGroups(returnType="display")
+		groups = [(sampleGroup, ds.sampleGroupItems(sampleGroup=sampleGroup), ds._sampleGroupCodes(sampleGroup, key)) \
+				  for sampleGroup in sampleGroups]
+
+		h5 = tables.open_file(filepath, mode='a')
+		try:
+			node = h5.get_node('/matrix/expression/%s' % key)
+			for sampleGroup, items, codes in groups:
+				path = '/matrix/groupsummary/%s/%s' % (key, sampleGroup)
+				if path in h5:
+					h5.remove_node(path)
+				if not items or node.shape[0]==0:
+					continue
+				shape = (node.shape[0], len(items), len(groupSummaryStats))
+				rows = rowChunkshape((shape[0], shape[1] * shape[2]), 4)[0]
+				with warnings.catch_warnings():
+					warnings.simplefilter('ignore', tables.NaturalNameWarning)	# sample group names need not be python identifiers
+					array = h5.create_carray('/matrix/groupsummary/%s' % key, sampleGroup, atom=tables.Float32Atom(), shape=shape,
+											 filters=node.filters, chunkshape=(rows,) + shape[1:], createparents=True)
+				array.attrs.items = list(items)
+				for start in range(0, node.shape[0], blockSize):
+					array[start:start + blockSize] = groupSummaryValues(node[start:start + blockSize], codes, len(items))
+		finally:
+			h5.close()
+
+def studentPValues(t, df, iterations=300):
+	"""
+	Return numpy array of two sided p-values of Student's t distribution for arrays t and df (degrees of freedom,
+	which need not be integers), from the regularised incomplete beta function I_x(df/2, 1/2) with x = df/(df+t^2),
+	evaluated with its continued fraction for all values at once. NaN values of t get a p-value of 1.
+	"""
+	t, df = numpy.broadcast_arrays(numpy.asarray(t, dtype=float), numpy.asarray(df, dtype=float))
+	valid = ~numpy.isnan(t) & (df>0)
+	a = numpy.where(valid, df / 2, 1.0)
+	b = numpy.full(a.shape, 0.5)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		x = numpy.where(valid, df / (df + t * t), 1.0)
+
+	# the continued fraction converges quickly for x < (a+1)/(a+b+2), otherwise use I_x(a,b) = 1 - I_(1-x)(b,a)
+	swap = x>(a + 1) / (a + b + 2)
+	a, b, x = numpy.where(swap, b, a), numpy.where(swap, a, b), numpy.where(swap, 1 - x, x)
+	lgamma = numpy.frompyfunc(math.lgamma, 1, 1)
+	with numpy.errstate(divide='ignore', invalid='ignore', over='ignore', under='ignore'):
+		front = numpy.exp((lgamma(a + b) - lgamma(a) - lgamma(b)).astype(float) + a * numpy.log(x) + b * numpy.log1p(-x)) / a
+		tiny = 1e-300
+		c, d = numpy.ones(x.shape), 1 - (a + b) * x / (a + 1)
+		d = 1 / numpy.where(numpy.abs(d)<tiny, tiny, d)
+		h = d.copy()
+		for m in range(1, iterations + 1):
+			for numerator in (m * (b - m) * x / ((a + 2*m - 1) * (a + 2*m)), -(a + m) * (a + b + m) * x / ((a + 2*m) * (a + 2*m + 1))):
+				d = 1 + numerator * d
+				d = 1 / numpy.where(numpy.abs(d)<tiny, tiny, d)
+				c = 1 + numerator / c
+				c = numpy.where(numpy.abs(c)<tiny, tiny, c)
+				h *= d * c
+			if numpy.all(numpy.abs(d * c - 1)<1e-10):	# converged
+				break
+		p = numpy.where(x>0, front * h, 0.0)
+	p = numpy.where(swap, 1 - p, p)
+	return numpy.where(valid, numpy.clip(p, 0, 1), 1.0)
+
+def benjaminiHochberg(pValues):
+	"""Return numpy array of p-values adjusted for multiple testing by the Benjamini-Hochberg method (false discovery rate).
+	"""
+	pValues = numpy.asarray(pValues, dtype=float)
+	if pValues.size==0:
+		return pValues
+	order = numpy.argsort(pValues)
+	adjusted = pValues[order] * len(pValues) / numpy.arange(1, len(pValues) + 1)
+	adjusted = numpy.minimum.accumulate(adjusted[::-1])[::-1]
+	result = numpy.empty_like(adjusted)
+	result[order] = numpy.minimum(adjusted, 1)
+	return result
+
+def _readRows(node, rows):
+	"""Return a numpy array of rows from a PyTables array node, where rows is a sorted array of row offsets.
+	Contiguous rows are read with one slice each.
+	"""
+	if len(rows)==0:
+		return numpy.empty((0,) + node.shape[1:], dtype=node.dtype)
+	runs = numpy.split(rows, numpy.flatnonzero(numpy.diff(rows)!=1) + 1)
+	return numpy.concatenate([node[run[0]:run[-1] + 1] for run in runs])
 	
+def _randomizedPCA(values, numberOfComponents, oversamples=10, iterations=4, seed=0):
+	"""
+	Return PCA coordinates of values, a numpy array with samples as rows and features as columns, as a numpy array
+	with samples as rows and numberOfComponents columns. Uses randomized truncated SVD (Halko et al. 2011), which
+	is much faster than a full SVD when there are many features. Exact SVD is used for small matrices.
+	"""
+	values = values - values.mean(axis=0)
+	k = min(numberOfComponents, min(values.shape))
+	if min(values.shape)<=k + oversamples:
+		u, s, vt = numpy.linalg.svd(values, full_matrices=False)
+	else:
+		rng = numpy.random.RandomState(seed)
+		q = numpy.linalg.qr(values.dot(rng.normal(size=(values.shape[1], k + oversamples))))[0]
+		for i in range(iterations):	# power iterations improve accuracy when singular values decay slowly
+			q = numpy.linalg.qr(values.T.dot(q))[0]
+			q = numpy.linalg.qr(values.dot(q))[0]
+		ub, s, vt = numpy.linalg.svd(q.T.dot(values), full_matrices=False)
+		u = q.dot(ub)
+	u, s, vt = u[:,:k], s[:k], vt[:k]
+
+	# make the result deterministic by making the largest loading of each component positive
+	signs = numpy.sign(vt[numpy.arange(k), numpy.abs(vt).argmax(axis=1)])
+	signs[signs==0] = 1
+	return u * s * signs
+
 def datasetAttributes(filepath, includeFilepath=False):
 	"""
 	Return a dictionary of dataset attributes from hdf5 file:
@@ -66,7 +709,6 @@ def datasetAttributes(filepath, includeFilepath=False):
 	If includeFilepath is true, filepath is included in the dictionary, which is useful when trying
 	to recover this info from afterwards
 	"""
-	import os
 	if os.path.exists(filepath):
 		
 		attributes = mutex.hdf_attr_to_dict(filepath, '/series/attributes')
@@ -91,23 +733,231 @@ class BPDataset(genedataset.dataset.Dataset):
 		/series/sampleGroupOrdering
 		/series/sampleGroupColours
 		/dataframe/samples
-		/dataframe/expression/[expression_data_key]
+		/dataframe/pca
+		/dataframe/expression/[expression_data_key]: left out by default, see createDatasetFile() and repackDatasetFile()
+		/matrix/expression/[expression_data_key]
+		/series/featureIndex/[expression_data_key]
+		/series/matrixColumns/[expression_data_key]
+		/matrix/zscore/[expression_data_key], /matrix/zrank/[expression_data_key]: optional, see correlatedFeatures()
+		/matrix/groupsummary/[expression_data_key]/[sampleGroup]: optional, see groupSummaries()
 
 	If attributes['expression_data_keys']=['counts','cpm'], for example, the hdf file will have
-	'dataframe/expression/counts' and 'dataframe/expression/cpm' as keys.
+	'matrix/expression/counts' and 'matrix/expression/cpm' as keys.
+	The /matrix and matching /series keys hold the expression matrices in a layout which can be read one row
+	at a time (see writeExpressionRows()). Files without them still work, but the full matrix is read for each query.
 	"""
 	
 	
-	@mutex.mutual_exclusion
+	samples = StoredObject('/dataframe/samples')
+	pca = StoredObject('/dataframe/pca')
+	_sampleGroupColours = StoredObject('/series/sampleGroupColours')
+	_sampleGroupOrdering = StoredObject('/series/sampleGroupOrdering')
+	_sampleGroupsDisplayed = StoredObject('/series/sampleGroupsDisplayed')
+
 	def __init__(self, pathToHDF):
-		"""Instantiate the object by reading the hdf file given by pathToHDF
+		"""Instantiate the object by reading the hdf file given by pathToHDF.
+		The base class __init__ is not called, as it reads every expression matrix into memory. Instead
+		self.expressions reads each matrix when it is first used, and samples, pca and sample group
+		properties are read from the file when they are first used (see StoredObject).
 		"""
-		super(BPDataset, self).__init__(pathToHDF)
-		
-		self._sampleGroupColours = pandas.read_hdf(self.filepath, '/series/sampleGroupColours')
-		self._sampleGroupOrdering = pandas.read_hdf(self.filepath, '/series/sampleGroupOrdering')
-		self._sampleGroupsDisplayed = pandas.read_hdf(self.filepath, '/series/sampleGroupsDisplayed')
-		self.pca = pandas.read_hdf(self.filepath, '/dataframe/pca')
+		self.filepath = pathToHDF
+		self._storedObjects = {}	# {hdf key: object}, see StoredObject
+		with openStore(pathToHDF) as store:
+			self.attributes = _objectRead(pathToHDF, store['/series/attributes']).to_dict()
+		self.name = self.attributes['name']
+		self.expression_data_keys = self.attributes['expression_data_keys']
+
+		self.expressions = ExpressionMatrices(self)
+		self._featureIndex = {}	# {expression_data_key: pandas.Series of row offsets keyed on feature id}
+		self._matrixColumns = {}	# {expression_data_key: list of sample ids}
+		self._memmaps = {}	# {expression_data_key: numpy.memmap or None}
+		self._sampleGroupItems = {}	# {(sampleGroup, groupBy, duplicates): value returned by sampleGroupItems()}
+		self._sampleGroupMetadata = None
+		self._pcaCache = collections.OrderedDict()	# {name of result: pandas.DataFrame}, see computePCA()
+		self._pcaLock = threading.Lock()
+		self._correlationMatrices = {}	# {(expression_data_key, method): numpy array}, see correlatedFeatures()
+		self._groupSummaries = collections.OrderedDict()	# {(expression_data_key, sampleGroup, featureId): numpy array}, see groupSummaries()
+		self._groupSummariesLock = threading.Lock()
+		self._differentialExpression = collections.OrderedDict()	# {(expression_data_key, sampleGroup, itemA, itemB): pandas.DataFrame}
+		self._differentialExpressionLock = threading.Lock()
+
+	def _expressionKey(self, expression_data_key=None):
+		"""Return expression_data_key if valid, otherwise the first key of self.expression_data_keys.
+		"""
+		return expression_data_key if expression_data_key in self.expression_data_keys else self.expression_data_keys[0]
+
+	def featureIndex(self, expression_data_key=None):
+		"""Return pandas.Series of row offsets keyed on feature id for the expression matrix stored under
+		/matrix/expression/[expression_data_key], or None if the file does not have this layout.
+		"""
+		key = self._expressionKey(expression_data_key)
+		if key not in self._featureIndex:
+			with openStore(self.filepath) as store:
+				if '/series/featureIndex/%s' % key in store:
+					self._matrixColumns[key] = _objectRead(self.filepath, store['/series/matrixColumns/%s' % key]).tolist()
+					self._featureIndex[key] = _objectRead(self.filepath, store['/series/featureIndex/%s' % key])
+				else:
+					self._featureIndex[key] = None
+		return self._featureIndex[key]
+
+	def expressionMemmap(self, expression_data_key=None):
+		"""Return the expression matrix as a read only numpy.memmap if the dataset has a memory mapped file
+		for it (see writeExpressionMemmap()), otherwise None. Rows match featureIndex().
+		"""
+		key = self._expressionKey(expression_data_key)
+		if key not in self._memmaps:
+			mm = None
+			path = expressionMemmapPath(self.filepath, key)
+			index = self.featureIndex(key)
+			if index is not None and os.path.exists(path):
+				mm = numpy.load(path, mmap_mode='r')
+				if mm.shape!=(len(index), len(self._matrixColumns[key])):
+					log.warning("Ignoring %s, as its shape does not match the dataset", path)
+					mm = None
+			self._memmaps[key] = mm
+		return self._memmaps[key]
+
+	def _readExpressionMatrix(self, key):
+		"""Return the full expression matrix for key as a pandas.DataFrame, which is a view over the
+		memory mapped file if there is one. Read from /matrix/expression/[key] if the file has it, otherwise
+		from /dataframe/expression/[key].
+		"""
+		mm = self.expressionMemmap(key)
+		if mm is not None:
+			index = self.featureIndex(key).index
+			return pandas.DataFrame(mm, index=index, columns=self._matrixColumns[key], copy=False)
+		if self.featureIndex(key) is not None:	# may be the only copy, see repackDatasetFile()
+			with openStore(self.filepath) as store:
+				values = _objectRead(self.filepath, store._handle.get_node('/matrix/expression/%s' % key)[:])
+			return pandas.DataFrame(values, index=self.featureIndex(key).index, columns=self._matrixColumns[key])
+		with openStore(self.filepath) as store:
+			return _objectRead(self.filepath, store['/dataframe/expression/%s' % key])
+
+	def expressionRows(self, featureIds, expression_data_key=None):
+		"""Return pandas.DataFrame of expression values for featureIds, reading only the matching rows from disk.
+		Rows are in the same order as featureIds, and feature ids not found in the dataset are ignored.
+		Requires the layout written by writeExpressionRows() - see featureIndex().
+		"""
+		key = self._expressionKey(expression_data_key)
+		index = self.featureIndex(key)
+		matched = self._matchedRows(index, featureIds)
+		mm = self.expressionMemmap(key)
+		if mm is not None:
+			result = mm[matched.values]
+		else:
+			result = self._readMatrixRows('/matrix/expression/%s' % key, matched.values)
+		df = pandas.DataFrame(result, index=matched.index, columns=self._matrixColumns[key])
+		df.index.name = index.index.name
+		return df
+
+	def _matchedRows(self, index, featureIds):
+		"""Return the part of index, a feature index (see featureIndex()), matching featureIds, in the same order.
+		"""
+		featureIds = pandas.unique(pandas.Series(list(featureIds), dtype=object))
+		if index.index.is_unique:
+			positions = index.index.get_indexer(featureIds)
+			return index.iloc[positions[positions>=0]]
+		return index[index.index.isin(featureIds)]
+
+	def _readMatrixRows(self, path, rows):
+		"""Return numpy array of rows (an array of row offsets, in any order) of the PyTables array at path.
+		"""
+		order = numpy.argsort(rows, kind='mergesort')
+		with openStore(self.filepath) as store:
+			values = _objectRead(self.filepath, _readRows(store._handle.get_node(path), rows[order]))
+
+		# put the rows back into the requested order
+		result = numpy.empty_like(values)
+		result[order] = values
+		return result
+
+	def expressionMatrix(self, expression_data_key=None, featureIds=None, sampleGroupForMean=None):
+		"""Return pandas DataFrame of expression values matching featureIds. Override base class method
+		so that only the matching rows are read from disk when the file has a feature index, and the full
+		matrix is returned without copying it (a view over the memory mapped file if there is one), so it
+		should be treated as read only.
+
+		Parameters
+		----------
+		See genedataset.dataset.Dataset.expressionMatrix().
+		"""
+		key = self._expressionKey(expression_data_key)
+		if isinstance(featureIds, str):	# assume single feature was specified
+			featureIds = [featureIds]
+
+		if featureIds is None or len(featureIds)==0:
+			df = self.expressions[key]
+		elif self.featureIndex(key) is not None:
+			df = self.expressionRows(featureIds, expression_data_key=key)
+		else:
+			return super(BPDataset, self).expressionMatrix(expression_data_key=key, featureIds=featureIds, 
+														   sampleGroupForMean=sampleGroupForMean)
+		if len(df)==0:
+			return pandas.DataFrame()
+
+		if sampleGroupForMean:
+			sgi = self.sampleGroupItems(sampleGroup=sampleGroupForMean, duplicates=True)
+			if ','.join([item if pandas.notnull(item) else '' for item in sgi])!=','.join(df.columns):
+				# it's possible for celltypes to be defined the same as sample ids, for example
+				df = df.groupby(sgi, axis=1).mean()
+
+		return df
+
+	def expressionColumns(self, expression_data_key=None):
+		"""Return a list of sample ids in the same order as the columns of the expression matrix, 
+		without reading the matrix if the file has a feature index.
+		"""
+		key = self._expressionKey(expression_data_key)
+		if self.featureIndex(key) is not None:
+			return list(self._matrixColumns[key])
+		return self.expressions[key].columns.tolist()
+
+	def featureIds(self, expression_data_key=None):
+		"""Return a list of all feature ids in the same order as the rows of the expression matrix.
+		"""
+		key = self._expressionKey(expression_data_key)
+		index = self.featureIndex(key)
+		return index.index.tolist() if index is not None else self.expressions[key].index.tolist()
+
+	def matchingFeatureIds(self, featureIds, expression_data_key=None):
+		"""Return a list of feature ids from featureIds which exist in the expression matrix, in the same order
+		as featureIds and with duplicates removed.
+		"""
+		key = self._expressionKey(expression_data_key)
+		index = self.featureIndex(key)
+		index = index.index if index is not None else self.expressions[key].index
+		featureIds = pandas.unique(pandas.Series(list(featureIds), dtype=object))
+		if index.is_unique:
+			return featureIds[index.get_indexer(featureIds)>=0].tolist()
+		return [featureId for featureId in featureIds if featureId in index]
+
+	def iterExpressionRows(self, featureIds, expression_data_key=None, chunkSize=1000):
+		"""Return a generator of pandas.DataFrame's holding the expression values of featureIds, chunkSize rows at a time,
+		so that values for many features can be processed without holding them all in memory.
+		Rows are in the order given by matchingFeatureIds(featureIds), one row per feature id.
+		As each chunk is read separately, the generator raises DatasetFileChanged if the file has changed since this
+		method was called, so that rows of two versions of the file are never mixed.
+		"""
+		key = self._expressionKey(expression_data_key)
+		signature = _fileSignature(self.filepath)
+		return self._expressionRowChunks(self.matchingFeatureIds(featureIds, key), key, chunkSize, signature)
+
+	def _expressionRowChunks(self, featureIds, key, chunkSize, signature):
+		hasIndex = self.featureIndex(key) is not None
+		if not hasIndex:
+			df = self.expressions[key]
+			df = df[~df.index.duplicated()]
+
+		for start in range(0, len(featureIds), chunkSize):
+			chunk = featureIds[start:start + chunkSize]
+			if hasIndex:
+				rows = self.expressionRows(chunk, expression_data_key=key)
+				rows = rows if rows.index.is_unique else rows[~rows.index.duplicated()].loc[chunk]
+			else:
+				rows = df.loc[chunk]
+			if _fileSignature(self.filepath)!=signature:	# checked after reading, so the rows read come from the same file
+				raise DatasetFileChanged("%s changed while its expression rows were read" % self.filepath)
+			yield rows
 				
 	def sampleGroups(self, returnType=None):
 		"""
@@ -153,43 +1003,328 @@ class BPDataset(genedataset.dataset.Dataset):
 		Note that this method does not make assumptions about the integrity of the data returned for 
 		groupBy specification. So it's possible to return {'Stem Cell':['LSK','STHSC'], 'B Cells':['LSK','B1']},
 		if there is a sample id which has been assigned to ('LSK','Stem Cell') and another to ('LSK','B Cells') by mistake.
+
+		Results are computed once for each combination of parameters and then returned from memory.
+		"""
+		key = (sampleGroup, groupBy, duplicates)
+		if key not in self._sampleGroupItems:
+			self._sampleGroupItems[key] = self._computeSampleGroupItems(sampleGroup, groupBy, duplicates)
+		value = self._sampleGroupItems[key]
+		# return a copy, so that callers can modify it without affecting the cached value
+		return dict([(item, list(items)) for item,items in value.items()]) if isinstance(value, dict) else list(value)
+
+	def _sampleRows(self, sampleIds):
+		"""Return the rows of the sample table for sampleIds, in the same order. A sample id found more than once
+		in the sample table gets its first row, and one not in the table gets a row of null values.
+		"""
+		samples = self.samples
+		if not samples.index.is_unique:
+			samples = samples[~samples.index.duplicated()]
+		return samples.reindex(sampleIds)
+
+	def _orderedSampleGroupItems(self, sampleGroup):
+		"""Return a list of unique items of sampleGroup without null values, ordered by sampleGroupOrdering
+		first, followed by any items not in sampleGroupOrdering in sorted order.
+		"""
+		items = pandas.unique(self.samples[sampleGroup].dropna())
+		sgo = pandas.Index(pandas.unique(pandas.Series(self._sampleGroupOrdering[sampleGroup] if sampleGroup in self._sampleGroupOrdering else [], dtype=object)))
+		return sgo[sgo.isin(items)].tolist() + sorted(items[~pandas.Index(items).isin(sgo)])
+
+	def _computeSampleGroupItems(self, sampleGroup, groupBy, duplicates):
+		"""See sampleGroupItems().
 		"""
 		df = self.samples
-		sgo = self._sampleGroupOrdering
 		
 		if sampleGroup in df.columns and groupBy in df.columns: # group each item by sample ids, then substitute items from sampleGroup
-			sampleIdsFromGroupBy = dict([(item, df[df[groupBy]==item].index.tolist()) for item in set(df[groupBy])])
-			# {'Stem Cell':['sample1','sample2',...], ... }
-		
-			# substitute items from sampleGroup for each sample id
-			dictToReturn = {}
-			for sampleGroupItem in sampleIdsFromGroupBy.keys():
-				# this is the set of matching sample group items with duplicates removed, eg: set(['LSK','CMP',...])
-				groupItems = set([df.at[sampleId,sampleGroup] for sampleId in sampleIdsFromGroupBy[sampleGroupItem]])
-				# order by sgo
-				if sampleGroup in sgo:
-					indexedItems = [(sgo[sampleGroup].index(item) if item in sgo[sampleGroup] else None, item) for item in groupItems]
-					dictToReturn[sampleGroupItem] = [value[1] for value in sorted([item for item in indexedItems if item[0] is not None])] + [item[1] for item in indexedItems if item[0] is None]
-				else:
-					dictToReturn[sampleGroupItem] = sorted(groupItems)
-			return dictToReturn
+			ordering = self._orderedSampleGroupItems(sampleGroup)
+			# position of each sample's item within ordering, which is -1 for null values
+			codes = pandas.Categorical(df[sampleGroup], categories=ordering).codes
+			pairs = pandas.DataFrame({'groupBy':df[groupBy].values, 'code':codes})
+			pairs = pairs[(pairs['code']>=0) & pairs['groupBy'].notnull()].drop_duplicates().sort_values('code')
+			# {'Stem Cell':['LSK','STHSC',...], ... }
+			return dict([(item, [ordering[code] for code in group['code']]) for item,group in pairs.groupby('groupBy', sort=False)])
 		
 		elif sampleGroup in df.columns:
-			if duplicates:
-				return super(BPDataset, self).sampleGroupItems(sampleGroup=sampleGroup, duplicates=True)
-				
-			groupItems = set(df[sampleGroup])
-			# order them if possible
-			if sampleGroup in sgo:
-				indexedItems = [(sgo[sampleGroup].index(item) \
-								 if item in sgo[sampleGroup] else None, item) for item in groupItems if pandas.notnull(item)]
-				return [value[1] for value in sorted([item for item in indexedItems if item[0] is not None])] + \
-						[item[1] for item in indexedItems if item[0] is None]
-			else:
-				return sorted([item for item in groupItems if pandas.notnull(item)])
+			if duplicates:	# same position as columns of expression matrix
+				return self._sampleRows(self.expressionColumns())[sampleGroup].tolist()
+			return self._orderedSampleGroupItems(sampleGroup)
 
 		else:
 			return []
+
+	def computePCA(self, sampleIds=None, expression_data_key=None, numberOfComponents=2, numberOfGenes=1000, store=False):
+		"""
+		Return pandas.DataFrame of PCA coordinates, with sample ids as index and 'PC1', 'PC2', ... as columns, 
+		computed from log2(x+1) expression values of sampleIds. Only the numberOfGenes genes with highest variance
+		across these samples are used, and randomized SVD is used, so that this scales to tens of thousands of genes.
+		Unlike self.pca, which is computed when the dataset file is created, this works for any subset of samples
+		and any expression matrix.
+
+		Results are kept in memory for the most recently used combinations of parameters, so repeated calls are 
+		instant. If store is True, results are also saved in a directory next to the dataset file (see pcaCachePath()),
+		so they are available to other processes and after restarts. The dataset file itself is never written, so
+		saving a result does not make servers reopen the dataset.
+
+		Parameters
+		----------
+		sampleIds: list of sample ids, eg: ['sample1','sample2',...]. Sample ids not found in the expression matrix are
+			ignored. All samples of the expression matrix are used if None.
+		expression_data_key: specifies which expression matrix to use (first one by default).
+		numberOfComponents: number of principal components to return.
+		numberOfGenes: number of genes with highest variance to use.
+		store: boolean to save the result in the cache directory of the dataset.
+		"""
+		key = self._expressionKey(expression_data_key)
+		columns = self.expressionColumns(key)
+		if sampleIds is not None:
+			columnSet = set(columns)
+			sampleIds = [item for item in pandas.unique(pandas.Series(list(sampleIds), dtype=object)) if item in columnSet]
+		else:
+			sampleIds = columns
+
+		# name under which the result is cached, which depends on all parameters and on the version of the file
+		digest = hashlib.sha1(json.dumps([key, sampleIds, numberOfComponents, numberOfGenes, _fileSignature(self.filepath)], 
+										 default=str).encode('utf-8')).hexdigest()
+		name = 'pca_%s' % digest[:20]
+		with self._pcaLock:
+			if name in self._pcaCache:
+				self._pcaCache.move_to_end(name)
+				return self._pcaCache[name]
+
+		df = _readCachedPCA(self.filepath, name)
+		if df is None:
+			df = self._computePCA(key, sampleIds, numberOfComponents, numberOfGenes)
+			if store:
+				_writeCachedPCA(self.filepath, name, df)
+
+		with self._pcaLock:
+			self._pcaCache[name] = df
+			while len(self._pcaCache)>32:
+				self._pcaCache.popitem(last=False)
+		return df
+
+	def _computePCA(self, key, sampleIds, numberOfComponents, numberOfGenes):
+		"""See computePCA().
+		"""
+		positions = pandas.Index(self.expressionColumns(key)).get_indexer(sampleIds)
+
+		# Keep the log values of numberOfGenes genes with highest variance, reading a chunk of rows at a time
+		# so that the whole matrix is never held in memory
+		variances, values = numpy.empty(0), numpy.empty((0, len(sampleIds)))
+		for df in self.iterExpressionRows(self.featureIds(key), expression_data_key=key, chunkSize=5000):
+			chunk = numpy.log2(df.values[:,positions].astype(float) + 1)
+			with numpy.errstate(invalid='ignore'), warnings.catch_warnings():
+				warnings.simplefilter('ignore', RuntimeWarning)	# no samples
+				chunkVariances = chunk.var(axis=1)
+			usable = numpy.isfinite(chunkVariances) & (chunkVariances>0)
+			variances = numpy.concatenate([variances, chunkVariances[usable]])
+			values = numpy.vstack([values, chunk[usable]])
+			if len(variances)>numberOfGenes:
+				keep = numpy.argpartition(-variances, numberOfGenes - 1)[:numberOfGenes]
+				variances, values = variances[keep], values[keep]
+
+		if len(sampleIds)<2 or len(values)==0:
+			return pandas.DataFrame(index=pandas.Index(sampleIds, name='sampleId'))
+		coords = _randomizedPCA(values.T, numberOfComponents)
+		return pandas.DataFrame(coords, index=pandas.Index(sampleIds, name='sampleId'), 
+								columns=['PC%s' % (i + 1) for i in range(coords.shape[1])])
+
+	def correlatedFeatures(self, featureId, expression_data_key=None, method='pearson', top=20, negative=False):
+		"""
+		Return pandas.Series of correlation coefficients between featureId and the top features most correlated with it,
+		keyed on feature id and sorted from highest to lowest (lowest to highest if negative is True, which returns the 
+		most negatively correlated features). featureId itself is left out. Returns an empty Series if featureId is 
+		not found.
+
+		method is 'pearson' (of log2(x+1) values) or 'spearman'. Correlations use all samples, and are computed with a 
+		single matrix-vector product against a normalised copy of the expression matrix, which is read from the file
+		if it has been stored (see writeCorrelationMatrices()), or computed otherwise, then kept in memory.
+		"""
+		key = self._expressionKey(expression_data_key)
+		if method not in ('pearson', 'spearman'):
+			raise ValueError("method should be 'pearson' or 'spearman', not %s" % method)
+
+		featureIds = pandas.Index(self.featureIds(key))
+		positions = numpy.flatnonzero(featureIds==featureId)
+		if len(positions)==0:
+			return pandas.Series(dtype=float, name='correlation')
+
+		matrix = self._correlationMatrix(key, method)
+		scores = matrix.dot(matrix[positions[0]]).astype(float)
+		scores[positions] = numpy.nan	# leave out featureId itself
+		valid = numpy.flatnonzero(numpy.isfinite(scores))
+		ordering = scores[valid] if negative else -scores[valid]
+
+		top = min(top, len(valid))
+		if top<=0:
+			return pandas.Series(dtype=float, name='correlation')
+		best = valid[numpy.argpartition(ordering, top - 1)[:top]] if top<len(valid) else valid
+		best = best[numpy.argsort(scores[best] if negative else -scores[best], kind='mergesort')]
+		return pandas.Series(scores[best], index=featureIds[best], name='correlation')
+
+	def _correlationMatrix(self, key, method):
+		"""Return normalised expression matrix used by correlatedFeatures(), with rows matching featureIds(key).
+		"""
+		if (key, method) not in self._correlationMatrices:
+			path = '/matrix/%s/%s' % ('zscore' if method=='pearson' else 'zrank', key)
+			matrix = None
+			with openStore(self.filepath) as store:
+				if path in store._handle:
+					matrix = _objectRead(self.filepath, store._handle.get_node(path)[:])
+			if matrix is None:
+				log.info("%s has no %s, computing it from the expression matrix", self.filepath, path)
+				values = self.expressions[key].values
+				matrix = normalisedRows(values, method=method, log=_nonNegative(values))
+			self._correlationMatrices[(key, method)] = matrix
+		return self._correlationMatrices[(key, method)]
+
+	def differentialExpression(self, sampleGroup, itemA, itemB, expression_data_key=None):
+		"""
+		Return pandas.DataFrame comparing the log2(x+1) expression values of the samples of itemA with those of itemB
+		of sampleGroup, for all features, with feature ids as index (in the order of featureIds()) and columns:
+			meanA, meanB: mean of each group
+			logFC: meanA - meanB
+			t, df: Welch's t statistic and degrees of freedom
+			moderatedT: t statistic with a constant added to the standard error of every feature (the median standard
+				error across features), so that features with very small variance don't rank high on small differences
+			pValue: two sided p-value of Welch's t-test
+			adjPValue: pValue adjusted for multiple testing (Benjamini-Hochberg)
+		For files with the row layout (see writeExpressionRows()) values are read a chunk of rows at a time, so that
+		the whole matrix is never held in memory; other files have their whole matrix read (see expressions). Results
+		are kept in memory for the most recently used comparisons, so they should be treated as read only.
+
+		Raises ValueError if sampleGroup is not a sample group of the dataset, or itemA or itemB has fewer than 2 samples.
+		"""
+		if sampleGroup not in self.samples.columns:
+			raise ValueError("No sample group called %s" % sampleGroup)
+		key = self._expressionKey(expression_data_key)
+		cacheKey = (key, sampleGroup, itemA, itemB)
+		with self._differentialExpressionLock:
+			if cacheKey in self._differentialExpression:
+				self._differentialExpression.move_to_end(cacheKey)
+				return self._differentialExpression[cacheKey]
+
+		# position of the samples of each item within the columns of the expression matrix
+		columnItems = self._sampleRows(self.expressionColumns(key))[sampleGroup].values
+		positions = []
+		for item in (itemA, itemB):
+			positions.append(numpy.flatnonzero(columnItems==item))
+			if len(positions[-1])<2:
+				raise ValueError("%s needs at least 2 samples in %s" % (item, sampleGroup))
+
+		stats = {'meanA':[], 'meanB':[], 'varA':[], 'varB':[], 'nA':[], 'nB':[]}
+		for df in self.iterExpressionRows(self.featureIds(key), expression_data_key=key, chunkSize=5000):
+			values = df.values
+			for suffix, itemPositions in zip('AB', positions):
+				chunk = numpy.log2(values[:,itemPositions].astype(numpy.float64) + 1)
+				n = numpy.sum(~numpy.isnan(chunk), axis=1)
+				with warnings.catch_warnings():
+					warnings.simplefilter('ignore', RuntimeWarning)	# rows with fewer than 2 values
+					stats['mean' + suffix].append(numpy.nanmean(chunk, axis=1))
+					stats['var' + suffix].append(numpy.nanvar(chunk, axis=1, ddof=1))
+				stats['n' + suffix].append(n)
+		stats = dict([(name, numpy.concatenate(values) if values else numpy.empty(0)) for name, values in stats.items()])
+
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			errorA, errorB = stats['varA'] / stats['nA'], stats['varB'] / stats['nB']
+			standardError = numpy.sqrt(errorA + errorB)
+			logFC = stats['meanA'] - stats['meanB']
+			t = logFC / standardError
+			df = (errorA + errorB)**2 / (errorA**2 / (stats['nA'] - 1) + errorB**2 / (stats['nB'] - 1))
+			usable = numpy.isfinite(standardError) & (standardError>0)
+			offset = numpy.median(standardError[usable]) if usable.any() else 0
+			moderatedT = logFC / (standardError + offset)
+		pValues = studentPValues(t, df)
+
+		result = pandas.DataFrame({'meanA':stats['meanA'], 'meanB':stats['meanB'], 'logFC':logFC, 't':t, 'df':df,
+								   'moderatedT':moderatedT, 'pValue':pValues, 'adjPValue':benjaminiHochberg(pValues)},
+								  index=pandas.Index(self.matchingFeatureIds(self.featureIds(key), key), name='featureId'))
+		with self._differentialExpressionLock:
+			self._differentialExpression[cacheKey] = result
+			while len(self._differentialExpression)>16:
+				self._differentialExpression.popitem(last=False)
+		return result
+
+	def groupSummaries(self, featureIds, sampleGroup, expression_data_key=None):
+		"""
+		Return {featureId: pandas.DataFrame} of summary statistics of the log2(x+1) expression values of each of
+		featureIds over the samples of each item of sampleGroup, with items as index (in the order of
+		sampleGroupItems(sampleGroup)) and groupSummaryStats as columns (mean, min, q1, median, q3, max).
+		Feature ids not found in the dataset are left out. Summaries stored in the dataset file (see
+		writeGroupSummaries()) are used if the file has them, otherwise they are computed from the expression
+		values of featureIds and kept in memory for the most recently used features.
+		"""
+		key = self._expressionKey(expression_data_key)
+		items = self.sampleGroupItems(sampleGroup=sampleGroup)
+		featureIds = self.matchingFeatureIds(featureIds, expression_data_key=key)
+		path = '/matrix/groupsummary/%s/%s' % (key, sampleGroup)
+
+		values = None
+		if self.featureIndex(key) is not None:
+			with openStore(self.filepath) as store:
+				storedItems = list(store._handle.get_node(path).attrs.items) if path in store._handle else None
+			if storedItems is not None:
+				matched = self._matchedRows(self.featureIndex(key), featureIds)
+				values = self._readMatrixRows(path, matched.values)
+				# the ordering of items may have changed since the summaries were written
+				positions = pandas.Index(storedItems).get_indexer(items)
+				values = numpy.where((positions>=0)[numpy.newaxis,:,numpy.newaxis], values[:,positions], numpy.nan)
+
+		if values is None:
+			values = self._computeGroupSummaries(featureIds, sampleGroup, key, items)
+		return dict([(featureId, pandas.DataFrame(values[i], index=items, columns=groupSummaryStats)) \
+					 for i,featureId in enumerate(featureIds)])
+
+	def _computeGroupSummaries(self, featureIds, sampleGroup, key, items, maxsize=10000):
+		"""Return numpy array of group summaries of featureIds, see groupSummaries(), computing those not in memory.
+		"""
+		with self._groupSummariesLock:
+			missing = [featureId for featureId in featureIds if (key, sampleGroup, featureId) not in self._groupSummaries]
+		if missing:
+			df = self.expressionMatrix(expression_data_key=key, featureIds=missing)
+			codes = self._sampleGroupCodes(sampleGroup, key, columns=df.columns.tolist())
+			values = groupSummaryValues(df.values, codes, len(items))
+			with self._groupSummariesLock:
+				for i,featureId in enumerate(df.index):
+					self._groupSummaries[(key, sampleGroup, featureId)] = values[i]
+				while len(self._groupSummaries)>maxsize:
+					self._groupSummaries.popitem(last=False)
+
+		empty = numpy.full((len(items), len(groupSummaryStats)), numpy.nan, dtype=numpy.float32)
+		with self._groupSummariesLock:
+			result = [self._groupSummaries.get((key, sampleGroup, featureId), empty) for featureId in featureIds]
+		return numpy.array(result).reshape((len(featureIds), len(items), len(groupSummaryStats)))
+
+	def _sampleGroupCodes(self, sampleGroup, expression_data_key=None, columns=None):
+		"""Return numpy array giving the position of the item of sampleGroup (in sampleGroupItems(sampleGroup)) of each 
+		column of the expression matrix, or of columns if specified, which is -1 for samples without an item.
+		"""
+		if columns is None:
+			columns = self.expressionColumns(expression_data_key)
+		items = self.sampleGroupItems(sampleGroup=sampleGroup)
+		return numpy.asarray(pandas.Categorical(self._sampleRows(columns)[sampleGroup], categories=items).codes)
+
+	def sampleGroupMetadata(self):
+		"""
+		Return a dictionary with the sample group information used to display the samples of this dataset, 
+		keyed on sample group for each sample group for display (see sampleGroups(returnType="display")):
+			sampleIds: list of sample ids, eg: ['sample1','sample2',...]
+			sampleGroups: list of sample groups for display, eg: ['celltype','cell_lineage']
+			sampleGroupItems: {'celltype':['B1','B2',...], ...}, see sampleGroupItems()
+			sampleGroupColours: {'celltype':{'B1':'#cccccc',...}, ...}, see sampleGroupColours()
+			sampleIdsAsGroupItems: {'celltype':['B1','B1','B2',...], ...}, see sampleGroupItems(duplicates=True)
+
+		This is computed once and then returned from memory, so it should be treated as read only.
+		"""
+		if self._sampleGroupMetadata is None:
+			sampleGroups = self.sampleGroups(returnType="display")
+			self._sampleGroupMetadata = {
+				'sampleIds': self.sampleIds(),
+				'sampleGroups': sampleGroups,
+				'sampleGroupItems': dict([(item, self.sampleGroupItems(sampleGroup=item)) for item in sampleGroups]),
+				'sampleGroupColours': dict([(item, self.sampleGroupColours(sampleGroup=item)) for item in sampleGroups]),
+				'sampleIdsAsGroupItems': dict([(item, self.sampleGroupItems(sampleGroup=item, duplicates=True)) for item in sampleGroups])}
+		return self._sampleGroupMetadata
 			
 	def sampleGroupColours(self, sampleGroup=None):
 		"""Return colour dictionary given sampleGroup, eg: {'Stem Cell':'#cccccc', ...}
@@ -228,4 +1363,20 @@ class BPDataset(genedataset.dataset.Dataset):
 		df = self.samples
 		df.index.name = 'sampleId'
 		return df
-	
\ No newline at end of file
+	
+
+class ExpressionMatrices(dict):
+	"""
+	Dictionary of expression matrices (pandas.DataFrame) keyed on expression_data_key, used as BPDataset.expressions.
+	Each matrix is read from the dataset file when it is first accessed rather than when the dataset is opened.
+	"""
+	def __init__(self, dataset):
+		super(ExpressionMatrices, self).__init__()
+		self.dataset = dataset
+
+	def __missing__(self, key):
+		if key not in self.dataset.expression_data_keys:
+			raise KeyError(key)
+		df = self.dataset._readExpressionMatrix(key)
+		self[key] = df
+		return df
@@ -0,0 +1,139 @@
+"""
+This module holds a catalogue of the datasets found in a directory, which keeps the attributes of each
+dataset file in memory so that listing datasets does not require opening every HDF file.
+
+The directory is scanned when the catalogue is created, after which a refresh only looks at the size and
+modification time of each .h5 file, and only files which have been added or modified are opened again.
+Refreshing happens at most once every refreshInterval seconds, so calling attributes() on every request is cheap.
+
+The attributes can also be saved to a small index file (json), so that a new process starting up does not
+need to open every dataset file either, as long as the files have not changed since the index was written.
+
+Example:
+	catalogue = DatasetCatalogue('/path/to/datasets', indexFile='/path/to/datasets/.catalogue.json')
+	[item['name'] for item in catalogue.attributes()]
+"""
+import os, json, time, threading, logging
+
+from biopyramid.models import bpdataset
+from biopyramid.models.registry import fileSignature
+
+log = logging.getLogger(__name__)
+
+class DatasetCatalogue(object):
+	"""
+	Catalogue of dataset files in a directory. This object is thread safe and is meant to be shared by all
+	requests within a process.
+
+	Parameters
+	----------
+	datadir: (string) directory containing the dataset files, which end in .h5
+	indexFile: (string) path to a json file used to persist the catalogue between restarts. Optional.
+	refreshInterval: (float) minimum number of seconds between checks of the directory for changes.
+	"""
+	def __init__(self, datadir, indexFile=None, refreshInterval=2):
+		self.datadir = datadir
+		self.indexFile = indexFile
+		self.refreshInterval = refreshInterval
+		self._entries = {}	# {filepath: {'signature':(mtime,size), 'attributes':{...}}}
+		self._lastRefresh = None
+		self._modified = 0	# see lastModified()
+		self._lock = threading.Lock()
+		self._readIndexFile()
+		self.refresh(force=True)
+
+	def attributes(self):
+		"""Return a list of attribute dictionaries, one for each dataset in the directory, ordered by filepath.
+		"filepath" key is included in each dictionary. See bpdataset.datasetAttributes() for other keys.
+		"""
+		self.refresh()
+		with self._lock:
+			return [dict(self._entries[filepath]['attributes']) for filepath in sorted(self._entries)]
+
+	def lastModified(self):
+		"""Return the latest modification time (seconds since the epoch) of the directory and its dataset files, 
+		which changes whenever a dataset is added, removed, renamed or modified.
+		"""
+		self.refresh()
+		with self._lock:
+			return self._modified
+
+	def filepath(self, name):
+		"""Return the filepath of the dataset with name, or None if there is no such dataset.
+		"""
+		for attributes in self.attributes():
+			if attributes.get('name')==name:
+				return attributes['filepath']
+		return None
+
+	def refresh(self, force=False):
+		"""Bring the catalogue up to date with the directory, reading attributes from new or modified
+		files and removing entries for files which no longer exist. Unless force is True, nothing is done
+		if the last refresh was less than refreshInterval seconds ago. Returns True if anything changed.
+		"""
+		with self._lock:
+			now = time.time()
+			if not force and self._lastRefresh is not None and now - self._lastRefresh < self.refreshInterval:
+				return False
+			self._lastRefresh = now
+
+			signatures = {}
+			for filepath in self._datasetFiles():
+				signature = fileSignature(filepath)
+				if signature is not None:
+					signatures[filepath] = signature
+			directory = fileSignature(self.datadir)	# modified when files are added to or removed from it
+			self._modified = max([signature[0] for signature in signatures.values()] + [directory[0] if directory else 0])
+
+			changed = False
+			for filepath in [key for key in self._entries if key not in signatures]:	# removed files
+				del self._entries[filepath]
+				changed = True
+
+			for filepath, signature in signatures.items():	# new or modified files
+				entry = self._entries.get(filepath)
+				if entry is not None and entry['signature']==signature:
+					continue
+				try:
+					attributes = bpdataset.datasetAttributes(filepath, includeFilepath=True)
+				except Exception:	# file may be in the middle of being copied - try again next time
+					log.warning("Could not read attributes from %s", filepath, exc_info=True)
+					self._entries.pop(filepath, None)
+					continue
+				self._entries[filepath] = {'signature':signature, 'attributes':attributes}
+				changed = True
+
+			if changed:
+				self._writeIndexFile()
+			return changed
+
+	def _datasetFiles(self):
+		try:
+			filenames = os.listdir(self.datadir)
+		except OSError:
+			return []
+		return [os.path.join(self.datadir, filename) for filename in filenames if filename.endswith(".h5")]
+
+	def _readIndexFile(self):
+		if not self.indexFile or not os.path.exists(self.indexFile):
+			return
+		try:
+			with open(self.indexFile) as f:
+				entries = json.load(f)
+			self._entries = dict([(filepath, {'signature':tuple(entry['signature']), 'attributes':entry['attributes']}) \
+								  for filepath, entry in entries.items()])
+		except (ValueError, KeyError, TypeError, IOError):
+			log.warning("Ignoring unreadable catalogue index file %s", self.indexFile)
+			self._entries = {}
+
+	def _writeIndexFile(self):
+		if not self.indexFile:
+			return
+		# write to a temporary file first, so other processes never read a partially written index
+		tmpfile = "%s.%s.tmp" % (self.indexFile, os.getpid())
+		try:
+			with open(tmpfile, 'w') as f:
+				json.dump(self._entries, f, default=str)
+			os.rename(tmpfile, self.indexFile)
+		except (IOError, OSError):
+			log.warning("Could not write catalogue index file %s", self.indexFile, exc_info=True)
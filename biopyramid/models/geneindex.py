@@ -0,0 +1,149 @@
+"""
+This module holds a search index over the gene annotation of genedataset.geneset, so that searching for genes
+does not scan the whole annotation table on every request.
+
+Each gene is indexed on its gene symbol, Ensembl id, Entrez id and synonyms. All terms are kept in one sorted
+list in lower case, so exact and prefix matches are found with a binary search, taking the same time
+regardless of the size of the annotation. When no term starts with the search string, genes are matched on
+any part of these columns or of their description instead, as the search of genedataset.geneset does, which
+scans every gene. Searches return at most searchLimit genes unless told otherwise.
+Build one index per process and share it between requests.
+
+Example:
+	index = GeneIndex()
+	index.search('ccr')		# ['ENSMUSG00000032184', 'ENSG00000163823', ...]
+	index.search('Ccr3', matchType='exact', caseSensitive=True)	# ['ENSMUSG00000035448']
+"""
+import bisect, logging, time
+
+import pandas
+from genedataset import geneset
+
+log = logging.getLogger(__name__)
+
+# Columns which are indexed, in the order their matches are returned for the same term
+searchColumns = ['GeneSymbol', 'EnsemblId', 'EntrezId', 'Synonyms']
+
+# Columns matched on any part of their value when no term starts with the search string
+substringColumns = searchColumns + ['Description']
+
+# Default maximum number of genes returned by GeneIndex.search()
+searchLimit = 500
+
+class GeneIndex(object):
+	"""
+	Search index over a geneset.Geneset. This object is read only once created, so it can be used by many threads.
+
+	Parameters
+	----------
+	gs: (geneset.Geneset) genes to index. The full geneset is read from genedataset if None.
+	"""
+	def __init__(self, gs=None):
+		start = time.time()
+		self.geneset = gs if gs is not None else geneset.Geneset()
+		df = self.geneset.dataframe()
+		self.geneIds = df.index.tolist()
+		self.geneSymbols = df['GeneSymbol'].tolist() if 'GeneSymbol' in df.columns else [None] * len(df)
+		self.species = df['Species'].tolist() if 'Species' in df.columns else [None] * len(df)
+
+		# (lower case term, priority of column, term, row position of gene) for every term of every gene
+		entries = []
+		for priority, column in enumerate(searchColumns):
+			values = df.index if column=='EnsemblId' else df[column] if column in df.columns else []
+			for row, value in enumerate(values):
+				if not isinstance(value, str) or not value:
+					continue
+				for term in (value.split('|') if column=='Synonyms' else [value]):
+					term = term.strip()
+					if term and term!='-':
+						entries.append((term.lower(), priority, term, row))
+		entries.sort()
+
+		self._keys = [entry[0] for entry in entries]
+		self._terms = [entry[2] for entry in entries]
+		self._rows = [entry[3] for entry in entries]
+		# all values of substringColumns of each gene in one string, separated by tabs so matches can't span values
+		text = pandas.Series(df.index, index=df.index, dtype=object)
+		for column in substringColumns:
+			if column!='EnsemblId' and column in df.columns:
+				text = text + '\t' + df[column].fillna('').astype(str)
+		self._text = text.values
+		log.info("Indexed %s genes (%s terms) in %.2f seconds", len(self.geneIds), len(entries), time.time() - start)
+
+	def __len__(self):
+		return len(self.geneIds)
+
+	def search(self, searchString, limit=searchLimit, matchType='prefix', caseSensitive=False, species=None):
+		"""
+		Return a list of gene ids matching searchString, with exact matches first, then prefix matches in
+		alphabetical order of the matching term. Each gene id appears once. If there are no prefix matches,
+		genes whose indexed values or description contain searchString are returned, in the order of the annotation.
+
+		Parameters
+		----------
+		searchString: (string) eg. 'ccr3', 'ENSMUSG00000035448', '12771', 'chemokine'
+		limit: (int) maximum number of gene ids to return (searchLimit by default), all matches if None.
+		matchType: 'prefix' to match terms starting with searchString (or containing it, see above), or 'exact'.
+		caseSensitive: (boolean) if True, the case of searchString must match the term.
+		species: one of ['MusMusculus','HomoSapiens'] to restrict matches to one species, all species if None.
+		"""
+		return [self.geneIds[row] for row in self._searchRows(searchString, limit, matchType, caseSensitive, species)]
+
+	def matches(self, searchString, limit=10, **kwargs):
+		"""
+		Return a list of dictionaries for the top limit genes matching searchString, for use by autocomplete, eg:
+			[{'geneId':'ENSMUSG00000035448', 'geneSymbol':'Ccr3', 'species':'MusMusculus'}, ...]
+		Any other keyword argument is passed on to search().
+		"""
+		return [{'geneId':self.geneIds[row], 'geneSymbol':self.geneSymbols[row], 'species':self.species[row]} \
+				for row in self._searchRows(searchString, limit, **kwargs)]
+
+	def dataframe(self, geneIds, dropColumns=('TranscriptLengths',)):
+		"""Return pandas.DataFrame of annotation for geneIds, in the same order, with 'EnsemblId' as a column rather
+		than the index and dropColumns left out. Gene ids not in the index are ignored.
+		"""
+		df = self.geneset.dataframe()
+		geneIds = pandas.Index(pandas.unique(pandas.Series(list(geneIds), dtype=object)))
+		df = df.loc[geneIds[geneIds.isin(df.index)]].drop(columns=[column for column in dropColumns if column in df.columns])
+		df.index.name = 'EnsemblId'
+		return df.reset_index()
+
+	def records(self, geneIds, dropColumns=('TranscriptLengths',)):
+		"""Return annotation for geneIds as a list of dictionaries, eg: [{'EnsemblId':'ENSMUSG00000035448', 
+		'GeneSymbol':'Ccr3', 'EntrezId':'12771', ...}, ...]. See dataframe().
+		"""
+		return self.dataframe(geneIds, dropColumns=dropColumns).to_dict(orient="records")
+
+	def _searchRows(self, searchString, limit=None, matchType='prefix', caseSensitive=False, species=None):
+		"""See search(). Returns row positions of matching genes instead of gene ids.
+		"""
+		searchString = (searchString or '').strip()
+		if not searchString:
+			return []
+		key = searchString.lower()
+		start = bisect.bisect_left(self._keys, key)
+		end = bisect.bisect_right(self._keys, key) if matchType=='exact' else bisect.bisect_left(self._keys, key + '\uffff')
+
+		rows, seen = [], set()
+		for i in range(start, end):
+			if caseSensitive and not (self._terms[i]==searchString if matchType=='exact' else self._terms[i].startswith(searchString)):
+				continue
+			row = self._rows[i]
+			if row in seen or (species and self.species[row]!=species):
+				continue
+			seen.add(row)
+			rows.append(row)
+			if limit is not None and len(rows)>=limit:
+				break
+		if not rows and matchType=='prefix':
+			rows = self._substringRows(searchString, limit, caseSensitive, species)
+		return rows
+
+	def _substringRows(self, searchString, limit, caseSensitive, species):
+		"""Return row positions of genes with searchString in any value of substringColumns, see search().
+		"""
+		found = pandas.Series(self._text).str.contains(searchString, case=caseSensitive, regex=False).values
+		if species:
+			found &= pandas.Series(self.species).values==species
+		rows = found.nonzero()[0]
+		return rows[:limit].tolist() if limit is not None else rows.tolist()
@@ -0,0 +1,335 @@
+"""
+This module creates dataset files from raw count tables too big to hold in memory. bpdataset.createDatasetFile()
+needs every expression matrix, and the PCA coordinates, as pandas objects in memory; ingestDataset() instead reads
+the counts table a block of lines at a time and computes everything else from the stored matrices:
+
+	1. Blocks of lines of the counts table are parsed by a pool of worker processes, and their values appended
+	   in order to /matrix/expression/[countsKey] (see bpdataset.writeExpressionRows() for this layout).
+	2. Derived expression matrices (see derivedMatrices) are computed from the stored counts, a block of rows at a time.
+	3. PCA coordinates, and optionally group summaries and normalised matrices for co-expression searches, are
+	   computed with the functions of bpdataset, which also read a block of rows at a time.
+
+Only a few blocks are held in memory at once, however big the table is. The file is written to a temporary file
+in the destination directory, which is renamed to the dataset's file name once complete, so that a server reading
+the directory never sees a partially written dataset (memory mapped matrices are also written next to the
+temporary file, then renamed with it). Progress is recorded in the temporary file, so calling
+ingestDataset() again with the same parameters after it was interrupted carries on from the last completed block
+or stage. Expression matrices are stored under /matrix/expression, and copied to the /dataframe/expression objects
+read by genedataset a block of rows at a time (see bpdataset.writeExpressionFrame()) unless dropFrames is True.
+
+Example:
+	ingest.ingestDataset('data/datasets', 'counts.tsv.gz', 'samples.tsv',
+						 attributes={'name':'haemopedia', 'version':'2.7', 'fullname':'Haemopedia', 'species':'MusMusculus'},
+						 sampleGroupsDisplayed=['celltype', 'cell_lineage'], derivedKeys=['cpm'], groupSummaries=True)
+"""
+import os, io, gzip, json, glob, logging, collections, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy, pandas, tables
+
+from biopyramid.models import bpdataset
+import biopyramid.views.mutex as mutex
+
+log = logging.getLogger(__name__)
+
+def countsPerMillion(counts, librarySizes):
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		values = counts / librarySizes * 1e6
+	values[:,librarySizes==0] = 0
+	return values
+
+# Functions computing derived expression matrices from a block of counts (features as rows, samples as columns)
+# and the library size (sum of counts over all features) of each sample, keyed on expression data key.
+# Note that views show log2(x+1) of stored values, so logcpm is meant for downloads and analysis.
+derivedMatrices = {
+	'cpm': countsPerMillion,
+	'logcpm': lambda counts, librarySizes: numpy.log2(countsPerMillion(counts, librarySizes) + 1),
+}
+
+def tableSeparator(filepath):
+	"""Return the field separator of a table file from its extension: ',' for .csv (or .csv.gz), otherwise tab.
+	"""
+	return ',' if filepath.lower().replace('.gz', '').endswith('.csv') else '\t'
+
+def _openTable(filepath):
+	return gzip.open(filepath, 'rb') if filepath.lower().endswith('.gz') else open(filepath, 'rb')
+
+def _parseBlock(data, separator, numberOfColumns, dtype):
+	"""Return (list of feature ids, numpy array of values) from data, a block of lines of a counts table.
+	Called in worker processes of ingestDataset().
+	"""
+	if not data.strip():
+		return [], numpy.empty((0, numberOfColumns), dtype=dtype)
+	df = pandas.read_csv(io.BytesIO(data), sep=separator, header=None, index_col=0, dtype={0:str})
+	if df.shape[1]!=numberOfColumns:
+		raise ValueError("Expected %s values in each line of the counts table but found %s" % (numberOfColumns, df.shape[1]))
+	return df.index.tolist(), df.values.astype(dtype)
+
+def _signature(countsPath, samplesPath, **params):
+	"""Return a string identifying the input files and parameters of an ingestion, used to decide whether
+	an existing temporary file can be resumed.
+	"""
+	files = [(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in (countsPath, samplesPath)]
+	return json.dumps([files, params], sort_keys=True, default=str)
+
+def _resumableFile(tmppath, signature):
+	"""Return the progress recorded in tmppath as a dictionary, or None if it does not exist or was written
+	from other input files or parameters, in which case it is removed.
+	"""
+	if not os.path.exists(tmppath):
+		return None
+	try:
+		h5 = tables.open_file(tmppath, mode='r')
+		try:
+			attrs = h5.get_node('/ingest')._v_attrs
+			if attrs.signature==signature:
+				return {'offset':int(attrs.offset), 'rows':int(attrs.rows), 'blocks':int(attrs.blocks),
+						'columnSums':numpy.array(attrs.columnSums), 'stages':json.loads(attrs.stages)}
+		finally:
+			h5.close()
+	except Exception:	# left incomplete when the process stopped
+		log.warning("Could not resume from %s, starting again", tmppath)
+	os.remove(tmppath)
+	return None
+
+def ingestDataset(destDir, countsPath, samplesPath, attributes, sampleGroupsDisplayed=None, sampleGroupOrdering=None,
+				  sampleGroupColours=None, countsKey='counts', derivedKeys=('cpm',), pcaKey=None, separator=None,
+				  dtype='float32', processes=None, blockBytes=8 * 1024**2, blockSize=5000, compression=None, complevel=5,
+				  groupSummaries=False, correlation=False, memmap=False, dropFrames=False):
+	"""
+	Create a dataset file in destDir from a counts table and a samples table, without reading either matrix into
+	memory (see module docstring), and return its BPDataset instance.
+
+	Parameters
+	----------
+	destDir: directory of the dataset file, which is named [name].[version].h5 as with bpdataset.createDatasetFile().
+	countsPath: path of a csv or tsv file (optionally gzip compressed, eg. counts.tsv.gz) with a header line
+		of sample ids, and a line per feature holding its id then its counts. The first field of the header
+		names the feature id column, eg. 'geneId'.
+	samplesPath: path of a csv or tsv file with sample ids as the first column and a column for each sample group.
+		It must have every sample of the counts table.
+	attributes: (dict) attributes of the dataset, see genedataset.dataset.createDatasetFile(). expression_data_keys
+		is set by this function.
+	sampleGroupsDisplayed, sampleGroupOrdering, sampleGroupColours: see bpdataset.createDatasetFile(). All sample
+		groups are displayed by default.
+	countsKey: expression data key of the counts matrix.
+	derivedKeys: keys of derivedMatrices to compute from the counts and store.
+	pcaKey: expression data key of the matrix used for PCA, 'cpm' if derived, otherwise countsKey.
+	separator: field separator of the tables, found from their extensions by default (see tableSeparator()).
+	dtype: numpy dtype of the stored matrices.
+	processes: number of worker processes parsing the counts table, number of cpus by default.
+	blockBytes: size of the blocks of lines parsed by each worker process. About 2 x processes blocks are held
+		in memory at once.
+	blockSize: number of rows processed at a time when computing derived matrices and PCA.
+	compression, complevel: if compression is specified, eg. 'blosc' or 'zlib', all matrices are compressed
+		(see bpdataset.repackDatasetFile()).
+	groupSummaries, correlation, memmap, dropFrames: see bpdataset.createDatasetFile().
+	"""
+	unknownKeys = [key for key in derivedKeys if key not in derivedMatrices]
+	if unknownKeys:
+		raise ValueError("Unknown derived expression keys %s, should be one of %s" % (unknownKeys, sorted(derivedMatrices)))
+	derivedKeys = list(derivedKeys)
+	expressionKeys = [countsKey] + derivedKeys
+	pcaKey = pcaKey or ('cpm' if 'cpm' in derivedKeys else countsKey)
+	processes = processes or os.cpu_count() or 1
+	attributes = dict(attributes, expression_data_keys=expressionKeys)
+
+	filepath = os.path.join(destDir.rstrip('/'), '%s.%s.h5' % (attributes.get('name'), attributes.get('version')))
+	tmppath = '%s.ingest.tmp' % filepath
+	signature = _signature(countsPath, samplesPath, attributes=attributes, sampleGroupsDisplayed=sampleGroupsDisplayed,
+						   sampleGroupOrdering=sampleGroupOrdering, sampleGroupColours=sampleGroupColours, pcaKey=pcaKey,
+						   separator=separator, dtype=dtype, compression=compression, complevel=complevel)
+	progress = _resumableFile(tmppath, signature)
+	if progress is not None:
+		log.info("Resuming %s from line block %s, stages done: %s", tmppath, progress['blocks'], progress['stages'])
+
+	# Header and samples table, which are small
+	samplesSeparator = separator or tableSeparator(samplesPath)
+	separator = separator or tableSeparator(countsPath)
+	with _openTable(countsPath) as f:
+		header = f.readline().decode('utf-8').rstrip('\r\n').split(separator)
+	featureIdName, sampleIds = header[0] or 'featureId', header[1:]
+	samples = pandas.read_csv(samplesPath, sep=samplesSeparator, index_col=0)
+	samples.index = samples.index.astype(str)
+	samples.index.name = 'sampleId'
+	missing = [sampleId for sampleId in sampleIds if sampleId not in samples.index]
+	if missing:
+		raise ValueError("%s sample ids of the counts table are missing in the samples table, eg. %s" % (len(missing), missing[:5]))
+
+	if progress is None:
+		progress = {'offset':0, 'rows':0, 'blocks':0, 'columnSums':numpy.zeros(len(sampleIds)), 'stages':[]}
+		h5 = tables.open_file(tmppath, mode='w')
+		try:
+			h5.create_group('/', 'ingest')
+			h5.root.ingest._v_attrs.signature = signature
+			_saveProgress(h5, progress)
+		finally:
+			h5.close()
+
+	filters = bpdataset.compressionFilters(compression, complevel) if compression else None
+	if 'parse' not in progress['stages']:
+		_parseCounts(tmppath, countsPath, countsKey, separator, len(sampleIds), dtype, filters, processes, blockBytes, progress)
+	featureIds = _featureIds(tmppath)
+
+	if 'derived' not in progress['stages']:
+		_writeDerivedMatrices(tmppath, countsKey, derivedKeys, dtype, filters, blockSize, progress)
+
+	if 'objects' not in progress['stages']:
+		with pandas.HDFStore(tmppath, mode='a', complevel=complevel if compression else 0,
+							 complib=filters.complib if compression else None) as store:
+			store['/series/attributes'] = pandas.Series(attributes)
+			store['/dataframe/samples'] = samples
+			store['/series/sampleGroupsDisplayed'] = pandas.Series(samples.columns.tolist() if sampleGroupsDisplayed is None \
+																	else list(sampleGroupsDisplayed), dtype=object)
+			store['/series/sampleGroupOrdering'] = pandas.Series(sampleGroupOrdering or {}, dtype=object)
+			store['/series/sampleGroupColours'] = pandas.Series(sampleGroupColours or {}, dtype=object)
+			featureIndex = pandas.Series(numpy.arange(len(featureIds)), index=pandas.Index(featureIds, name=featureIdName))
+			for key in expressionKeys:
+				store['/series/featureIndex/%s' % key] = featureIndex
+				store['/series/matrixColumns/%s' % key] = pandas.Series(sampleIds)
+		_stageDone(tmppath, progress, 'objects')
+
+	if 'pca' not in progress['stages']:
+		pca = bpdataset.BPDataset(tmppath).computePCA(expression_data_key=pcaKey, numberOfGenes=1000)
+		with mutex.writing(tmppath):
+			pca.to_hdf(tmppath, '/dataframe/pca')
+		_stageDone(tmppath, progress, 'pca')
+
+	for key in expressionKeys:
+		if not dropFrames and 'frame/%s' % key not in progress['stages']:
+			bpdataset.writeExpressionFrame(tmppath, key, blockSize=blockSize)
+			_stageDone(tmppath, progress, 'frame/%s' % key)
+		if groupSummaries and 'groupsummary/%s' % key not in progress['stages']:
+			bpdataset.writeGroupSummaries(tmppath, key, blockSize=blockSize)
+			_stageDone(tmppath, progress, 'groupsummary/%s' % key)
+		if correlation and 'correlation/%s' % key not in progress['stages']:
+			bpdataset.writeCorrelationMatrices(tmppath, key, blockSize=blockSize)
+			_stageDone(tmppath, progress, 'correlation/%s' % key)
+		if memmap and 'memmap/%s' % key not in progress['stages']:
+			bpdataset.writeExpressionMemmap(tmppath, key, blockSize=blockSize)
+			_stageDone(tmppath, progress, 'memmap/%s' % key)
+
+	with mutex.writing(tmppath):
+		h5 = tables.open_file(tmppath, mode='a')
+		try:
+			h5.remove_node('/ingest', recursive=True)
+		finally:
+			h5.close()
+
+	with mutex.writing(filepath):
+		# memory mapped files left from a previous version of this file would not match the new file
+		for path in glob.glob(bpdataset.expressionMemmapPath(filepath, '*')):
+			os.remove(path)
+		# those of the new file are in place before it is, so readers never see the file without them
+		if memmap:
+			for key in expressionKeys:
+				os.rename(bpdataset.expressionMemmapPath(tmppath, key), bpdataset.expressionMemmapPath(filepath, key))
+		os.rename(tmppath, filepath)
+	if os.path.exists('%s.lock' % tmppath):	# left by process locks on the temporary file, see biopyramid.views.mutex
+		os.remove('%s.lock' % tmppath)
+	log.info("Created %s with %s features and %s samples", filepath, len(featureIds), len(sampleIds))
+	return bpdataset.BPDataset(filepath)
+
+def _saveProgress(h5, progress):
+	attrs = h5.root.ingest._v_attrs
+	attrs.offset, attrs.rows, attrs.blocks = progress['offset'], progress['rows'], progress['blocks']
+	attrs.columnSums = progress['columnSums']
+	attrs.stages = json.dumps(progress['stages'])
+	h5.flush()
+
+def _stageDone(tmppath, progress, stage):
+	progress['stages'].append(stage)
+	with mutex.writing(tmppath):
+		h5 = tables.open_file(tmppath, mode='a')
+		try:
+			_saveProgress(h5, progress)
+		finally:
+			h5.close()
+
+def _createRowArray(h5, key, dtype, numberOfColumns, filters):
+	"""Create an empty extendable array for expression matrix key in the layout of bpdataset.writeExpressionRows().
+	"""
+	path = '/matrix/expression/%s' % key
+	if path in h5:
+		h5.remove_node(path)
+	atom = tables.Atom.from_dtype(numpy.dtype(dtype))
+	chunkshape = bpdataset.rowChunkshape((numpy.inf, numberOfColumns), atom.itemsize) if filters else (1, numberOfColumns)
+	return h5.create_earray('/matrix/expression', key, atom=atom, shape=(0, numberOfColumns), chunkshape=chunkshape,
+							filters=filters, createparents=True)
+
+def _parseCounts(tmppath, countsPath, countsKey, separator, numberOfColumns, dtype, filters, processes, blockBytes, progress):
+	"""Append the values of the counts table to /matrix/expression/[countsKey] of tmppath, and the feature ids
+	of each block of lines to /ingest/featureIds, continuing from progress. See ingestDataset().
+	"""
+	h5 = tables.open_file(tmppath, mode='a')
+	try:
+		if progress['blocks']==0:
+			array = _createRowArray(h5, countsKey, dtype, numberOfColumns, filters)
+			if '/ingest/featureIds' in h5:
+				h5.remove_node('/ingest/featureIds')
+			featureIds = h5.create_vlarray('/ingest', 'featureIds', tables.VLStringAtom())
+		else:	# values appended after the last recorded block are written again
+			array = h5.get_node('/matrix/expression/%s' % countsKey)
+			array.truncate(progress['rows'])
+			featureIds = h5.get_node('/ingest/featureIds')
+			featureIds.truncate(progress['blocks'])
+
+		def append(result, offset):
+			ids, values = result
+			array.append(values)
+			featureIds.append('\n'.join(ids).encode('utf-8'))
+			progress['columnSums'] += numpy.nansum(values, axis=0, dtype=float)
+			progress['offset'], progress['rows'], progress['blocks'] = offset, progress['rows'] + len(ids), progress['blocks'] + 1
+			_saveProgress(h5, progress)
+
+		with _openTable(countsPath) as f:
+			if progress['offset']:
+				f.seek(progress['offset'])
+			else:
+				f.readline()	# header
+			blocks = iter(lambda: b''.join(f.readlines(blockBytes)), b'')
+			if processes==1:
+				for data in blocks:
+					append(_parseBlock(data, separator, numberOfColumns, dtype), f.tell())
+			else:
+				# spawn rather than fork, as this may run in a multi-threaded process
+				with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+					pending = collections.deque()	# (future, offset after the block), in order of the table
+					for data in blocks:
+						pending.append((executor.submit(_parseBlock, data, separator, numberOfColumns, dtype), f.tell()))
+						if len(pending)>=2 * processes:	# so that only a few blocks are in memory
+							future, offset = pending.popleft()
+							append(future.result(), offset)
+					while pending:
+						future, offset = pending.popleft()
+						append(future.result(), offset)
+		progress['stages'].append('parse')
+		_saveProgress(h5, progress)
+	finally:
+		h5.close()
+
+def _featureIds(tmppath):
+	h5 = tables.open_file(tmppath, mode='r')
+	try:
+		featureIds = []
+		for block in h5.get_node('/ingest/featureIds'):
+			if block:
+				featureIds.extend(block.decode('utf-8').split('\n'))
+		return featureIds
+	finally:
+		h5.close()
+
+def _writeDerivedMatrices(tmppath, countsKey, derivedKeys, dtype, filters, blockSize, progress):
+	"""Compute the expression matrices of derivedKeys from the counts stored in tmppath, blockSize rows at a time.
+	"""
+	librarySizes = progress['columnSums']
+	h5 = tables.open_file(tmppath, mode='a')
+	try:
+		counts = h5.get_node('/matrix/expression/%s' % countsKey)
+		for key in derivedKeys:
+			array = _createRowArray(h5, key, dtype, counts.shape[1], filters)
+			for start in range(0, counts.shape[0], blockSize):
+				array.append(derivedMatrices[key](counts[start:start + blockSize].astype(float), librarySizes).astype(dtype))
+		progress['stages'].append('derived')
+		_saveProgress(h5, progress)
+	finally:
+		h5.close()
@@ -0,0 +1,190 @@
+"""
+This module runs expensive dataset computations (eg. PCA on a subset of samples) in a pool of worker processes,
+so that they don't hold up request threads of the web server, and several computations can use separate cores.
+
+A job is a function registered under a name with the @job decorator. It is called in a worker process with
+the BPDataset instance of a dataset file and keyword parameters, and should return something which can be
+converted to json. As it only needs a dataset, a job can also be called directly (see runJob()).
+Jobs should be defined in this module, so that they are registered when a worker process imports it.
+Jobs are identified by their name, parameters and the state of the dataset file, so submitting the same job
+again returns the existing job (and its result, once finished) rather than computing it again.
+
+Example:
+	queue = JobQueue(workers=2)
+	jobId = queue.submit('pca', '/path/to/haemopedia.2.7.h5', {'sampleIds':['sample1','sample2','sample3']})
+	queue.status(jobId)['status']	# 'pending', 'running', 'finished' or 'failed'
+	queue.result(jobId)
+"""
+import json, time, hashlib, threading, collections, multiprocessing
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from pyramid.settings import asbool
+
+from biopyramid.models.registry import DatasetRegistry, fileSignature
+
+# Functions which can be run as jobs, keyed on name
+jobFunctions = {}
+
+def job(name):
+	"""Decorator to register a module level function as a job called name.
+	"""
+	def register(func):
+		jobFunctions[name] = func
+		return func
+	return register
+
+# Datasets opened by jobs within a worker process, so consecutive jobs on the same dataset don't reopen it
+_datasets = DatasetRegistry(maxsize=4)
+
+def openDataset(filepath):
+	"""Return the BPDataset instance for filepath, for use inside job functions.
+	"""
+	return _datasets.dataset(filepath, filepath)
+
+def runJob(name, dataset, params=None):
+	"""Run job called name on dataset (BPDataset instance) in this process and return its result.
+	"""
+	if name not in jobFunctions:
+		raise ValueError("No job called %s" % name)
+	return jobFunctions[name](dataset, **(params or {}))
+
+def _runJob(name, filepath, params):
+	return runJob(name, openDataset(filepath), params)
+
+def listValue(value):
+	"""Return value as a list, where value may be a list or a comma separated string. None stays None.
+	"""
+	if value is None or isinstance(value, list):
+		return value
+	return [item.strip() for item in str(value).split(',') if item.strip()]
+
+
+class JobNotFound(KeyError):
+	"""Raised when a job id is not known to the queue.
+	"""
+
+
+class JobQueue(object):
+	"""
+	Queue of jobs run by a pool of worker processes, with a table of submitted jobs and their results.
+	This object is thread safe and is meant to be shared by all requests within a process.
+
+	Parameters
+	----------
+	workers: (int) number of worker processes.
+	maxJobs: (int) maximum number of finished jobs to remember. The oldest finished jobs are forgotten first.
+	"""
+	def __init__(self, workers=2, maxJobs=1000):
+		self.workers = workers
+		self.maxJobs = maxJobs
+		self._executor = None	# created when the first job is submitted
+		self._jobs = collections.OrderedDict()	# {jobId: dict of job details including 'future'}
+		self._lock = threading.Lock()
+
+	def submit(self, name, filepath, params=None):
+		"""Submit job called name for the dataset at filepath with params (dict of keyword parameters of the job)
+		and return its id. If the same job has been submitted before and has not failed, the id of the existing
+		job is returned.
+		"""
+		if name not in jobFunctions:
+			raise ValueError("No job called %s" % name)
+		params = dict(params or {})
+		jobId = hashlib.sha1(json.dumps([name, filepath, fileSignature(filepath), params], sort_keys=True, default=str) \
+							 .encode('utf-8')).hexdigest()
+
+		with self._lock:
+			existing = self._jobs.get(jobId)
+			if existing is not None and not (existing['future'].done() and existing['future'].exception() is not None):
+				self._jobs.move_to_end(jobId)
+				return jobId
+
+			if self._executor is None:
+				# spawn rather than fork, as forking a multi-threaded server process is not safe
+				self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+			future = self._executor.submit(_runJob, name, filepath, params)
+			self._jobs[jobId] = {'jobId':jobId, 'name':name, 'params':params, 'submitted':time.time(), 'finished':None, 'future':future}
+			future.add_done_callback(lambda f, jobId=jobId: self._finished(jobId))
+			self._removeOldJobs()
+		return jobId
+
+	def status(self, jobId):
+		"""Return a dictionary describing job with jobId, with keys: jobId, name, params, status, submitted, finished
+		and error. status is one of 'pending', 'running', 'finished' or 'failed'.
+		"""
+		entry = self._entry(jobId)
+		future = entry['future']
+		if future.done():
+			error = future.exception()
+			status = 'failed' if error is not None else 'finished'
+		else:
+			error = None
+			status = 'running' if future.running() else 'pending'
+		details = dict([(key, value) for key, value in entry.items() if key!='future'])
+		details.update({'status':status, 'error':str(error) if error is not None else None})
+		return details
+
+	def result(self, jobId, timeout=None):
+		"""Return the result of job with jobId, waiting up to timeout seconds (forever if None) for it to finish.
+		Raises the job's exception if it failed, or concurrent.futures.TimeoutError if it is not finished in time.
+		"""
+		return self._entry(jobId)['future'].result(timeout=timeout)
+
+	def shutdown(self):
+		"""Stop the worker processes, waiting for running jobs to finish.
+		"""
+		with self._lock:
+			if self._executor is not None:
+				self._executor.shutdown()
+				self._executor = None
+
+	def _entry(self, jobId):
+		with self._lock:
+			if jobId not in self._jobs:
+				raise JobNotFound(jobId)
+			return self._jobs[jobId]
+
+	def _finished(self, jobId):
+		with self._lock:
+			if jobId in self._jobs:
+				self._jobs[jobId]['finished'] = time.time()
+
+	def _removeOldJobs(self):
+		finished = [jobId for jobId, entry in self._jobs.items() if entry['future'].done()]
+		for jobId in finished[:max(0, len(self._jobs) - self.maxJobs)]:
+			del self._jobs[jobId]
+
+
+# ------------------------------------------------------------
+# Jobs
+# ------------------------------------------------------------
+def _finite(value):
+	return float(value) if numpy.isfinite(value) else None
+
+@job('pca')
+def pcaJob(dataset, sampleIds=None, expressionKey=None, numberOfGenes=1000, store=False):
+	"""PCA coordinates of sampleIds, see BPDataset.computePCA(). Returns {'sampleIds':[...], 'coords':[[x,...],[y,...]]}.
+	"""
+	pca = dataset.computePCA(sampleIds=listValue(sampleIds), expression_data_key=expressionKey,
+							 numberOfGenes=int(numberOfGenes), store=asbool(store))
+	return {'sampleIds':pca.index.tolist(), 'coords':pca.values.T[:2].tolist()}
+
+@job('coexpression')
+def coexpressionJob(dataset, geneId=None, expressionKey=None, method='pearson', top=20, negative=False):
+	"""Genes best correlated with geneId, see BPDataset.correlatedFeatures(). Returns [{'geneId':..., 'correlation':0.95}, ...].
+	"""
+	result = dataset.correlatedFeatures(geneId, expression_data_key=expressionKey, method=method, top=int(top),
+										negative=asbool(negative))
+	return [{'geneId':featureId, 'correlation':float(value)} for featureId,value in result.items()]
+
+@job('differentialExpression')
+def differentialExpressionJob(dataset, sampleGroup=None, itemA=None, itemB=None, expressionKey=None, direction='up', top=50):
+	"""Top genes differentially expressed between itemA and itemB of sampleGroup, ranked by moderated t statistic in
+	direction 'up' (higher in itemA), 'down' or 'both', see BPDataset.differentialExpression().
+	Returns [{'geneId':..., 'logFC':2.1, 'meanA':..., 'meanB':..., 't':..., 'moderatedT':..., 'pValue':..., 'adjPValue':...}, ...].
+	"""
+	df = dataset.differentialExpression(sampleGroup, itemA, itemB, expression_data_key=expressionKey)
+	score = df['moderatedT'].fillna(0)
+	score = score if direction=='up' else -score if direction=='down' else score.abs()
+	df = df.loc[score.sort_values(ascending=False, kind='mergesort').index[:int(top)]]
+	columns = ['logFC', 'meanA', 'meanB', 't', 'moderatedT', 'pValue', 'adjPValue']
+	return [dict([('geneId', featureId)] + [(column, _finite(row[column])) for column in columns]) for featureId, row in df.iterrows()]
@@ -0,0 +1,104 @@
+"""
+This module holds a process-wide registry of opened BPDataset instances, so that each dataset file is read
+once and then served from memory, rather than being re-read from its HDF file on every request.
+
+An entry is kept until the size or modification time of its file changes, at which point the dataset is
+opened again on next access. Optionally the number of datasets kept in memory can be limited, in which case
+the least recently used datasets are dropped first.
+
+Example:
+	registry = DatasetRegistry(maxsize=10)
+	ds = registry.dataset('haemopedia', '/path/to/haemopedia.2.7.h5')
+"""
+import os, threading, collections
+
+from biopyramid.models import bpdataset
+
+def fileSignature(filepath):
+	"""Return (modification time, size) of filepath, which is used to detect changes made to the file.
+	Returns None if the file does not exist.
+	"""
+	try:
+		stat = os.stat(filepath)
+	except OSError:
+		return None
+	return (stat.st_mtime, stat.st_size)
+
+
+class DatasetRegistry(object):
+	"""
+	Keep opened BPDataset instances in memory keyed on dataset name. This object is thread safe and is
+	meant to be shared by all requests within a process.
+
+	Parameters
+	----------
+	maxsize: (int) maximum number of datasets to keep in memory. If more datasets are opened, the least
+		recently used ones are removed from the registry. None (default) means there is no limit.
+	"""
+	def __init__(self, maxsize=None):
+		self.maxsize = maxsize
+		self._entries = collections.OrderedDict()	# {name: (filepath, signature, BPDataset instance)}
+		self._lock = threading.Lock()
+		self._loadingLocks = {}	# {name: Lock}, so that a dataset is only opened by one thread at a time
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, name):
+		return name in self._entries
+
+	def names(self):
+		"""Return a list of dataset names currently held in the registry, least recently used first.
+		"""
+		with self._lock:
+			return list(self._entries.keys())
+
+	def dataset(self, name, filepath):
+		"""Return the BPDataset instance for name, opening filepath only if the dataset is not already
+		in the registry or its file has changed since it was opened.
+		"""
+		ds = self._cached(name, filepath, fileSignature(filepath))
+		if ds is not None:
+			return ds
+
+		with self._lock:
+			loadingLock = self._loadingLocks.setdefault(name, threading.Lock())
+
+		with loadingLock:
+			# another thread may have opened the dataset while we were waiting
+			signature = fileSignature(filepath)
+			ds = self._cached(name, filepath, signature)
+			if ds is None:
+				ds = bpdataset.BPDataset(filepath)
+				self._store(name, filepath, signature, ds)
+			return ds
+
+	def invalidate(self, name=None):
+		"""Remove dataset with name from the registry, or all datasets if name is None.
+		"""
+		with self._lock:
+			if name is None:
+				removed = list(self._entries.values())
+				self._entries.clear()
+			else:
+				removed = [self._entries.pop(name)] if name in self._entries else []
+		for entry in removed:
+			bpdataset.closeStore(entry[0])
+
+	def _cached(self, name, filepath, signature):
+		with self._lock:
+			entry = self._entries.get(name)
+			if entry is None or entry[0]!=filepath or entry[1]!=signature:
+				return None
+			self._entries.move_to_end(name)
+			return entry[2]
+
+	def _store(self, name, filepath, signature, ds):
+		removed = []
+		with self._lock:
+			self._entries[name] = (filepath, signature, ds)
+			self._entries.move_to_end(name)
+			while self.maxsize and len(self._entries)>self.maxsize:
+				removed.append(self._entries.popitem(last=False)[1])
+		for entry in removed:	# close the file handle of datasets no longer held in memory
+			bpdataset.closeStore(entry[0])
@@ -0,0 +1,49 @@
+"""
+Synthetic datasets of any size, and the application serving them, used by the benchmarks (see 
+biopyramid.scripts.benchmark) and the tests.
+"""
+import numpy, pandas
+
+from biopyramid.models import bpdataset
+
+def createSyntheticDataset(destDir, genes=1000, samples=50, groups=3, itemsPerGroup=5, name='benchmark', seed=0, **kwargs):
+	"""
+	Create a dataset file in destDir with random counts for genes x samples and the given number of sample groups,
+	each with itemsPerGroup items, and return the BPDataset instance. Sample groups are called group0, group1, ...
+	where group0 items are nested inside group1 items, so that groupBy can be used. Any keyword argument is passed on
+	to bpdataset.createDatasetFile(), eg. compression='blosc'.
+	"""
+	rng = numpy.random.RandomState(seed)
+	sampleIds = ['sample%05d' % i for i in range(samples)]
+	geneIds = ['ENSMUSG%011d' % i for i in range(genes)]
+
+	sampleTable = pandas.DataFrame(index=pandas.Index(sampleIds, name='sampleId'))
+	for group in range(groups):
+		# fewer items in each following group, with items of group0 nested in items of group1, and so on
+		numberOfItems = max(1, itemsPerGroup // (group + 1))
+		sampleTable['group%s' % group] = ['group%s_item%s' % (group, (i % itemsPerGroup) % numberOfItems) for i in range(samples)]
+
+	counts = pandas.DataFrame(rng.negative_binomial(2, 0.02, size=(genes, samples)), index=pandas.Index(geneIds, name='geneId'), columns=sampleIds)
+	cpm = counts * 1e6 / counts.sum().replace(0, 1)
+	sampleGroups = sampleTable.columns.tolist()
+	attributes = {"name": name,
+				  "fullname": "Benchmark dataset",
+				  "version": "1.0",
+				  "description": "Synthetic dataset of %s genes and %s samples" % (genes, samples),
+				  "expression_data_keys": ["counts", "cpm"],
+				  "pubmed_id": None,
+				  "species": "MusMusculus"}
+	return bpdataset.createDatasetFile(destDir, attributes=attributes, samples=sampleTable, expressions=[counts, cpm],
+									   sampleGroupsDisplayed=sampleGroups,
+									   sampleGroupOrdering=dict([(group, sorted(set(sampleTable[group]), reverse=True)) for group in sampleGroups]),
+									   sampleGroupColours=dict([(group, {}) for group in sampleGroups]),
+									   pca=pandas.DataFrame(rng.normal(size=(samples, 2)), index=sampleTable.index, columns=['x', 'y']),
+									   **kwargs)
+
+def createApp(datadir, **settings):
+	"""Return the WSGI application of biopyramid serving datasets from datadir, with in-memory sessions.
+	"""
+	from biopyramid import main
+	params = {'biopyramid.model.datadir':datadir, 'session.type':'memory', 'session.key':'biopyramid', 'session.secret':'biopyramid'}
+	params.update(settings)
+	return main({}, **params)
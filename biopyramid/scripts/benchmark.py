@@ -0,0 +1,219 @@
+"""
+Benchmarks of the hot paths of BPDataset and of the views which use it, run against synthetic dataset files.
+Results are written as json, so that runs can be compared to catch performance regressions.
+
+Usage:
+	biopyramid_benchmark --genes 20000 --samples 300 --groups 4 --output results.json
+	biopyramid_benchmark --compare results.json	# exits with 1 if anything got slower
+
+Each benchmark reports the minimum, median, mean and maximum time in milliseconds over --repeat runs.
+The views are measured end to end through WebTest, and with --clients > 0 also by concurrent clients sending
+requests over http to the application served by waitress. WebTest is needed for the view benchmarks.
+"""
+import os, sys, json, time, logging, argparse, tempfile, shutil, threading, platform, datetime
+
+import numpy, pandas, tables
+
+from biopyramid.models import bpdataset
+from biopyramid.models.synthetic import createSyntheticDataset, createApp
+
+# --------------------------------------------------
+# Timing
+# --------------------------------------------------
+def timeit(func, repeat=5, setup=None):
+	"""Call func() repeat times and return a dictionary of timings in milliseconds: min, median, mean, max, repeat.
+	If setup is specified, it is called before each call of func() and its result is passed to func, without being timed.
+	"""
+	times = []
+	for i in range(repeat):
+		arg = setup() if setup else None
+		start = time.perf_counter()
+		func(arg) if setup else func()
+		times.append((time.perf_counter() - start) * 1000)
+	return summary(times)
+
+def summary(times):
+	times = numpy.asarray(times, dtype=float)
+	return {'min':round(times.min(), 4), 'median':round(float(numpy.median(times)), 4), 'mean':round(times.mean(), 4),
+			'max':round(times.max(), 4), 'repeat':len(times)}
+
+def benchmarkDataset(filepath, repeat=5, batchSize=100):
+	"""Return a dictionary of timings for BPDataset methods on the dataset file at filepath.
+	"""
+	ds = bpdataset.BPDataset(filepath)
+	geneIds = ds.featureIds()
+	rng = numpy.random.RandomState(1)
+	sampleGroups = ds.sampleGroups()
+	fresh = lambda: bpdataset.BPDataset(filepath)
+
+	results = {}
+	results['construction'] = timeit(fresh, repeat)
+	results['datasetAttributes'] = timeit(lambda: bpdataset.datasetAttributes(filepath), repeat)
+	# first call on a new instance computes the items, later calls return them from memory
+	results['sampleGroupItems'] = timeit(lambda ds: ds.sampleGroupItems(sampleGroup=sampleGroups[0]), repeat, setup=fresh)
+	results['sampleGroupItems_cached'] = timeit(lambda: ds.sampleGroupItems(sampleGroup=sampleGroups[0]), repeat)
+	if len(sampleGroups)>1:
+		results['sampleGroupItems_groupBy'] = timeit(lambda ds: ds.sampleGroupItems(sampleGroup=sampleGroups[0], groupBy=sampleGroups[1]),
+													 repeat, setup=fresh)
+	results['sampleGroupMetadata'] = timeit(lambda ds: ds.sampleGroupMetadata(), repeat, setup=fresh)
+	results['expressionMatrix_single'] = timeit(lambda: ds.expressionMatrix(featureIds=[geneIds[rng.randint(len(geneIds))]]), repeat)
+	results['expressionMatrix_batch'] = timeit(lambda: ds.expressionMatrix(featureIds=list(rng.choice(geneIds, min(batchSize, len(geneIds)), replace=False))),
+											   repeat)
+	results['expressionMatrix_full'] = timeit(lambda ds: ds.expressionMatrix(), repeat, setup=fresh)
+	return results
+
+# --------------------------------------------------
+# Views
+# --------------------------------------------------
+def viewUrls(ds):
+	"""Return {benchmark name: url} of the views benchmarked for dataset ds.
+	"""
+	geneId = ds.featureIds()[0]
+	return {'view_pca':'/pca?dataset=%s' % ds.name,
+			'view_expression':'/expression?dataset=%s&geneId=%s' % (ds.name, geneId)}
+
+def benchmarkViews(app, urls, repeat=5):
+	"""Return a dictionary of timings of GET requests of urls ({benchmark name: url}) through WebTest.
+	The first request of each url is timed separately as '<name>_first', as it includes opening the dataset.
+	"""
+	from webtest import TestApp
+	testApp = TestApp(app)
+	results = {}
+	for name, url in sorted(urls.items()):
+		results['%s_first' % name] = timeit(lambda: testApp.get(url), 1)
+		results[name] = timeit(lambda: testApp.get(url), repeat)
+	return results
+
+def benchmarkConcurrent(app, urls, clients=4, requestsPerClient=20):
+	"""Serve app with waitress on a free local port and send requestsPerClient GET requests of each url from
+	each of clients threads at the same time. Returns {name: timings of requests plus 'requests_per_second'}.
+	"""
+	import waitress
+	from waitress import wasyncore
+	from urllib.request import urlopen
+	logging.getLogger('waitress.queue').setLevel(logging.ERROR)	# a full task queue is expected here, not worth a warning
+	serverMap, stopping = {}, threading.Event()
+	server = waitress.create_server(app, map=serverMap, host='127.0.0.1', port=0, threads=clients)
+	def serve():
+		while not stopping.is_set():
+			wasyncore.loop(timeout=0.1, map=serverMap, count=1)
+		wasyncore.close_all(serverMap)	# in this thread, so sockets are not closed while the loop uses them
+	thread = threading.Thread(target=serve)
+	thread.daemon = True
+	thread.start()
+	baseUrl = 'http://127.0.0.1:%s' % server.effective_port
+
+	results = {}
+	try:
+		for name, url in sorted(urls.items()):
+			urlopen(baseUrl + url).read()	# open the dataset before timing
+			times, errors = [], []
+			def client():
+				for i in range(requestsPerClient):
+					start = time.perf_counter()
+					try:
+						urlopen(baseUrl + url).read()
+					except Exception as e:
+						errors.append(str(e))
+						continue
+					times.append((time.perf_counter() - start) * 1000)
+			start = time.perf_counter()
+			threads = [threading.Thread(target=client) for i in range(clients)]
+			for item in threads:
+				item.start()
+			for item in threads:
+				item.join()
+			elapsed = time.perf_counter() - start
+
+			result = summary(times) if times else {}
+			result.update({'clients':clients, 'errors':len(errors), 'requests_per_second':round(len(times) / elapsed, 2)})
+			results['%s_concurrent' % name] = result
+	finally:
+		stopping.set()	# all requests have been answered, so the server threads are idle
+		thread.join(10)
+	return results
+
+# --------------------------------------------------
+# Running and comparing
+# --------------------------------------------------
+def runBenchmarks(genes=1000, samples=50, groups=3, itemsPerGroup=5, repeat=5, clients=4, requestsPerClient=20, views=True, **datasetOptions):
+	"""Create a synthetic dataset in a temporary directory, run all benchmarks on it and return the results as
+	a dictionary with 'parameters', 'environment' and 'results' keys.
+	"""
+	datadir = tempfile.mkdtemp()
+	try:
+		start = time.perf_counter()
+		ds = createSyntheticDataset(datadir, genes=genes, samples=samples, groups=groups, itemsPerGroup=itemsPerGroup, **datasetOptions)
+		results = {'createDatasetFile':summary([(time.perf_counter() - start) * 1000])}
+		results.update(benchmarkDataset(ds.filepath, repeat=repeat))
+		if views:
+			app = createApp(datadir)
+			urls = viewUrls(ds)
+			results.update(benchmarkViews(app, urls, repeat=repeat))
+			if clients>0:
+				results.update(benchmarkConcurrent(app, urls, clients=clients, requestsPerClient=requestsPerClient))
+		fileSize = os.path.getsize(ds.filepath)
+	finally:
+		bpdataset.closeStore()
+		shutil.rmtree(datadir)
+
+	return {'parameters':dict(genes=genes, samples=samples, groups=groups, itemsPerGroup=itemsPerGroup, repeat=repeat,
+							  clients=clients, requestsPerClient=requestsPerClient, fileSize=fileSize, **datasetOptions),
+			'environment':{'date':datetime.datetime.now().isoformat(), 'python':platform.python_version(), 'platform':platform.platform(),
+						   'numpy':numpy.__version__, 'pandas':pandas.__version__, 'tables':tables.__version__},
+			'results':results}
+
+def compare(current, baseline, threshold=0.2):
+	"""Return a list of (name, baseline median, current median) for benchmarks whose median time is more than
+	threshold (fraction) slower in current than in baseline, where both are dictionaries returned by runBenchmarks().
+	"""
+	slower = []
+	for name, result in sorted(current['results'].items()):
+		previous = baseline['results'].get(name)
+		if previous and 'median' in previous and 'median' in result and result['median']>previous['median'] * (1 + threshold):
+			slower.append((name, previous['median'], result['median']))
+	return slower
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Benchmark BPDataset and views on a synthetic dataset.")
+	parser.add_argument('--genes', type=int, default=1000, help="number of genes (default: 1000)")
+	parser.add_argument('--samples', type=int, default=50, help="number of samples (default: 50)")
+	parser.add_argument('--groups', type=int, default=3, help="number of sample groups (default: 3)")
+	parser.add_argument('--items', type=int, default=5, help="number of items in the first sample group (default: 5)")
+	parser.add_argument('--repeat', type=int, default=5, help="number of times each benchmark is run (default: 5)")
+	parser.add_argument('--clients', type=int, default=4, help="number of concurrent clients, 0 to skip (default: 4)")
+	parser.add_argument('--requests', type=int, default=20, help="number of requests per concurrent client (default: 20)")
+	parser.add_argument('--no-views', action='store_true', help="only benchmark BPDataset methods")
+	parser.add_argument('--compression', help="create the dataset file with this compression, eg. blosc")
+	parser.add_argument('--memmap', action='store_true', help="create memory mapped expression matrices")
+	parser.add_argument('--output', help="file to write the json results to (default: standard output)")
+	parser.add_argument('--compare', help="json results of a previous run to compare against")
+	parser.add_argument('--threshold', type=float, default=0.2, help="fraction by which a median may grow before it is reported (default: 0.2)")
+	args = parser.parse_args(argv[1:])
+
+	datasetOptions = {}
+	if args.compression:
+		datasetOptions['compression'] = args.compression
+	if args.memmap:
+		datasetOptions['memmap'] = True
+	results = runBenchmarks(genes=args.genes, samples=args.samples, groups=args.groups, itemsPerGroup=args.items, repeat=args.repeat,
+							clients=args.clients, requestsPerClient=args.requests, views=not args.no_views, **datasetOptions)
+
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text)
+	else:
+		print(text)
+
+	if args.compare:
+		with open(args.compare) as f:
+			slower = compare(results, json.load(f), threshold=args.threshold)
+		for name, previous, current in slower:
+			sys.stderr.write("%s: %.3f ms -> %.3f ms\n" % (name, previous, current))
+		return 1 if slower else 0
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
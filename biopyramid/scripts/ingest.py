@@ -0,0 +1,60 @@
+"""
+Command line tool to create a dataset file from a counts table and a samples table, reading the counts a block
+of lines at a time with several processes, so that tables bigger than memory can be ingested. The file appears in
+the dataset directory only once complete, and running the same command again after it was interrupted resumes
+where it stopped. See biopyramid.models.ingest.
+
+Usage:
+	biopyramid_ingest data/datasets counts.tsv.gz samples.tsv --name haemopedia --version 2.7
+	biopyramid_ingest data/datasets counts.csv samples.csv --name haemopedia --version 2.7 --derived cpm,logcpm \
+		--displayed celltype,cell_lineage --metadata haemopedia.json --processes 8 --compression blosc --group-summaries
+
+The optional metadata file is a json object with any of the keys fullname, description, species, pubmed_id,
+sampleGroupOrdering and sampleGroupColours (see bpdataset.createDatasetFile()).
+As the dataset directory may be served while the file is created, the lock taken to put the new file in place
+extends to other processes (see biopyramid.views.mutex), as with servers setting biopyramid.model.process_locks.
+"""
+import os, sys, json, logging, argparse
+
+from biopyramid.models import ingest
+from biopyramid.views import mutex
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Create a dataset file from count tables.")
+	parser.add_argument('destDir', help="directory of the dataset file, eg. data/datasets")
+	parser.add_argument('counts', help="csv or tsv file (optionally gzip compressed) of counts, with features as rows and samples as columns")
+	parser.add_argument('samples', help="csv or tsv file with sample ids as rows and sample groups as columns")
+	parser.add_argument('--name', required=True, help="name of the dataset")
+	parser.add_argument('--version', required=True, help="version of the dataset")
+	parser.add_argument('--metadata', help="json file of other attributes, sample group ordering and colours")
+	parser.add_argument('--displayed', help="comma separated list of sample groups to display (default: all)")
+	parser.add_argument('--derived', default='cpm', help="comma separated list of expression matrices to compute from the counts, from %s (default: cpm)" % \
+						', '.join(sorted(ingest.derivedMatrices)))
+	parser.add_argument('--processes', type=int, help="number of processes parsing the counts (default: number of cpus)")
+	parser.add_argument('--dtype', default='float32', help="type of the stored values (default: float32)")
+	parser.add_argument('--compression', help="compress matrices with this library, eg. blosc or zlib")
+	parser.add_argument('--group-summaries', action='store_true', help="store summary statistics of sample groups")
+	parser.add_argument('--correlation', action='store_true', help="store matrices used for co-expression searches")
+	parser.add_argument('--memmap', action='store_true', help="write memory mapped expression matrices")
+	parser.add_argument('--drop-frames', action='store_true', help="leave out /dataframe/expression objects, which genedataset needs to read the file")
+	args = parser.parse_args(argv[1:])
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+	mutex.manager.processLocks = True
+
+	metadata = {}
+	if args.metadata:
+		with open(args.metadata) as f:
+			metadata = json.load(f)
+	attributes = dict([(key, value) for key, value in metadata.items() if key not in ('sampleGroupOrdering', 'sampleGroupColours')])
+	attributes.update({'name':args.name, 'version':args.version})
+
+	ds = ingest.ingestDataset(args.destDir, args.counts, args.samples, attributes,
+							  sampleGroupsDisplayed=args.displayed.split(',') if args.displayed else None,
+							  sampleGroupOrdering=metadata.get('sampleGroupOrdering'), sampleGroupColours=metadata.get('sampleGroupColours'),
+							  derivedKeys=[key for key in args.derived.split(',') if key], dtype=args.dtype, processes=args.processes,
+							  compression=args.compression, groupSummaries=args.group_summaries, correlation=args.correlation, memmap=args.memmap,
+							  dropFrames=args.drop_frames)
+	print("%s: %s features, %s samples, expression data keys %s" % (ds.filepath, len(ds.featureIds()), len(ds.expressionColumns()), ds.expression_data_keys))
+
+if __name__ == '__main__':
+	main()
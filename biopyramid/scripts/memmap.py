@@ -0,0 +1,63 @@
+"""
+Command line tool to add (or remove) memory mapped expression matrices to existing dataset files, so that
+BPDataset serves their expression values through numpy.memmap. See bpdataset.writeExpressionMemmap().
+
+Usage:
+	biopyramid_memmap data/datasets/haemopedia.2.7.h5
+	biopyramid_memmap data/datasets --keys normalised
+	biopyramid_memmap data/datasets --remove
+
+As the dataset directory may be served while the files are converted, the locks taken to change them extend to
+other processes (see biopyramid.views.mutex), as with servers setting biopyramid.model.process_locks.
+"""
+import os, sys, argparse
+
+from biopyramid.models import bpdataset
+from biopyramid.views import mutex
+
+def datasetFilepaths(paths):
+	"""Return a list of .h5 files given a list of files and directories.
+	"""
+	filepaths = []
+	for path in paths:
+		if os.path.isdir(path):
+			filepaths.extend(sorted(os.path.join(path, filename) for filename in os.listdir(path) if filename.endswith(".h5")))
+		else:
+			filepaths.append(path)
+	return filepaths
+
+def convert(filepath, keys=None, remove=False):
+	"""Write memory mapped files for expression matrices of the dataset at filepath, or remove them if remove
+	is True. keys is a list of expression_data_keys to convert, all keys if None.
+	"""
+	ds = bpdataset.BPDataset(filepath)
+	for key in keys or ds.expression_data_keys:
+		if key not in ds.expression_data_keys:
+			print("%s: no expression matrix with key %s" % (filepath, key))
+			continue
+		if remove:
+			path = bpdataset.expressionMemmapPath(filepath, key)
+			with mutex.writing(filepath):	# so that no reader has the file open without its memory mapped matrix
+				if os.path.exists(path):
+					os.remove(path)
+					os.utime(filepath, None)
+			continue
+		if ds.featureIndex(key) is None:	# file created before the row layout existed
+			bpdataset.writeExpressionRows(filepath, key, ds.expressions[key])
+		bpdataset.writeExpressionMemmap(filepath, key)
+		print("%s: wrote %s" % (filepath, bpdataset.expressionMemmapPath(filepath, key)))
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Add memory mapped expression matrices to dataset files.")
+	parser.add_argument('paths', nargs='+', help="dataset files or directories containing them")
+	parser.add_argument('--keys', help="comma separated list of expression data keys (default: all)")
+	parser.add_argument('--remove', action='store_true', help="remove memory mapped files instead of writing them")
+	args = parser.parse_args(argv[1:])
+	mutex.manager.processLocks = True
+
+	keys = args.keys.split(',') if args.keys else None
+	for filepath in datasetFilepaths(args.paths):
+		convert(filepath, keys=keys, remove=args.remove)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,276 @@
+"""
+Command line tool to serve the application with several worker processes, so that requests can use all cores
+rather than contend for the GIL of a single waitress process.
+
+The application is loaded and all datasets are opened and warmed in the parent process (see
+datasets.warmDatasets()), which then forks the workers. The workers share these objects with the parent
+(copy-on-write) and accept connections on the same listening socket, each serving them with its own waitress
+threads. The parent watches the dataset directory, and when dataset files are added, changed or removed it
+warms the datasets again and forks new workers, before asking the old ones to finish their current requests
+and exit. Workers which die are replaced.
+
+Usage:
+	biopyramid_prefork production.ini
+	biopyramid_prefork production.ini --workers 8 --threads 4 --port 6545
+
+Host and port are read from the [server:main] section of the config file unless given, and the number of
+workers, threads per worker and seconds between checks of the dataset directory from biopyramid.prefork.*
+settings. Send SIGHUP to the parent process to restart the workers, and SIGTERM or SIGINT to stop.
+As several processes serve the same files, file locks are extended across processes (biopyramid.model.process_locks).
+Only works on systems with os.fork (not Windows).
+"""
+import os, sys, gc, time, signal, socket, logging, argparse, configparser, threading
+
+import waitress
+from waitress import wasyncore
+from pyramid.paster import bootstrap, setup_logging
+
+from biopyramid.views import datasets, genes, mutex
+from biopyramid.models import bpdataset
+
+log = logging.getLogger(__name__)
+
+class RequestCounter(object):
+	"""
+	WSGI middleware keeping count of the requests being handled by an application, from the call of the
+	application until its response has been sent, so that a stopping worker knows when it is idle.
+	"""
+	def __init__(self, app):
+		self.app = app
+		self.active = 0
+		self._lock = threading.Lock()
+
+	def __call__(self, environ, start_response):
+		with self._lock:
+			self.active += 1
+		try:
+			result = self.app(environ, start_response)
+		except BaseException:
+			self._done()
+			raise
+		return _CountedResult(result, self._done)
+
+	def _done(self):
+		with self._lock:
+			self.active -= 1
+
+class _CountedResult(object):
+	"""Iterable of a WSGI response which calls done once it has been closed by the server.
+	"""
+	def __init__(self, result, done):
+		self.result = result
+		self.done = done
+
+	def __iter__(self):
+		return iter(self.result)
+
+	def close(self):
+		try:
+			if hasattr(self.result, 'close'):
+				self.result.close()
+		finally:
+			done, self.done = self.done, None
+			if done:
+				done()
+
+class PreforkServer(object):
+	"""
+	Parent process of the workers, see module docstring.
+
+	Parameters
+	----------
+	app: WSGI application to serve.
+	request: pyramid request from bootstrap(), used to reach the objects shared by all requests.
+	sock: listening socket.
+	workers: (int) number of worker processes.
+	threads: (int) number of waitress threads in each worker process.
+	checkInterval: (float) seconds between checks of the dataset directory for changes, 0 to not check.
+	gracefulTimeout: (float) seconds a stopping worker has to finish its current requests.
+	"""
+	def __init__(self, app, request, sock, workers=2, threads=4, checkInterval=5, gracefulTimeout=30):
+		self.app = app
+		self.request = request
+		self.sock = sock
+		self.workers = workers
+		self.threads = threads
+		self.checkInterval = checkInterval
+		self.gracefulTimeout = gracefulTimeout
+		self._workers = {}	# {pid: generation}
+		self._generation = 0
+		self._stopping = False
+		self._reload = False
+
+	def run(self):
+		"""Start the workers and look after them until SIGTERM or SIGINT is received.
+		"""
+		signal.signal(signal.SIGTERM, self._stop)
+		signal.signal(signal.SIGINT, self._stop)
+		signal.signal(signal.SIGHUP, self._restart)
+
+		self.warm()
+		self.spawnWorkers()
+		lastCheck = time.time()
+		while not self._stopping:
+			self.reapWorkers()
+			if self.checkInterval and time.time() - lastCheck>=self.checkInterval:
+				lastCheck = time.time()
+				if datasets.datasetCatalogue(self.request).refresh(force=True):
+					log.info("Dataset files have changed")
+					self._reload = True
+			if self._reload:
+				self._reload = False
+				self.restartWorkers()
+			time.sleep(0.5)
+
+		log.info("Stopping %s workers", len(self._workers))
+		self.stopWorkers(list(self._workers))
+		while self._workers:
+			self.reapWorkers(block=True)
+
+	def warm(self):
+		"""Open and warm all datasets and the gene index in this process, before workers are forked from it.
+		"""
+		start = time.time()
+		datasets.datasetRegistry(self.request).invalidate()	# so that removed datasets don't stay in memory
+		names = datasets.warmDatasets(self.request)
+		try:
+			genes.geneIndex(self.request)
+		except Exception:
+			log.exception("Could not build the gene index")
+
+		# Workers open their own handles, as HDF5 file handles can't be shared across processes
+		bpdataset.closeStore()
+		# Objects created so far live as long as the workers, so keep the garbage collector from touching
+		# (and so copying) the memory pages holding them
+		if hasattr(gc, 'freeze'):
+			gc.collect()
+			gc.freeze()
+		log.info("Warmed %s datasets in %.2f seconds", len(names), time.time() - start)
+
+	def spawnWorkers(self):
+		for i in range(self.workers - len(self._current())):
+			self.spawnWorker()
+
+	def spawnWorker(self):
+		pid = os.fork()
+		if pid==0:
+			status = 0
+			try:
+				self.serveWorker()
+			except BaseException:
+				log.exception("Worker %s failed", os.getpid())
+				status = 1
+			finally:
+				os._exit(status)
+		self._workers[pid] = self._generation
+		log.info("Started worker %s", pid)
+
+	def restartWorkers(self):
+		"""Warm datasets again and replace all workers, stopping the old ones once the new ones are running.
+		"""
+		old = list(self._workers)
+		if hasattr(gc, 'unfreeze'):
+			gc.unfreeze()
+		self.warm()
+		self._generation += 1
+		self.spawnWorkers()
+		self.stopWorkers(old)
+
+	def stopWorkers(self, pids):
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:	# already exited
+				pass
+
+	def reapWorkers(self, block=False):
+		"""Remove workers which have exited, replacing those of the current generation unless stopping.
+		"""
+		while self._workers:
+			try:
+				pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+			except ChildProcessError:
+				self._workers.clear()
+				return
+			if pid==0:
+				return
+			generation = self._workers.pop(pid, None)
+			if generation==self._generation and not self._stopping:
+				log.warning("Worker %s exited with status %s, starting a new one", pid, status)
+				self.spawnWorker()
+			if block:
+				return
+
+	def serveWorker(self):
+		"""Serve requests in a worker process until SIGTERM, then finish current requests and return.
+		"""
+		gc.enable()
+		stopping = []
+		signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(time.time()))
+		signal.signal(signal.SIGINT, signal.SIG_IGN)	# the parent stops workers on Ctrl-C
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+		serverMap = {}
+		counter = RequestCounter(self.app)
+		server = waitress.create_server(counter, map=serverMap, sockets=[self.sock], threads=self.threads)
+		try:
+			while True:
+				wasyncore.loop(timeout=1, map=serverMap, count=1)
+				if not stopping:
+					continue
+				if server.accepting:	# leave new connections to other workers
+					server.close()
+				# done once no request is being handled and no response is still being sent
+				if (counter.active==0 and not any(channel.writable() for channel in list(serverMap.values()))) or \
+				   time.time() - stopping[0]>self.gracefulTimeout:
+					break
+		finally:
+			wasyncore.close_all(serverMap)	# also closes idle keep-alive connections
+
+	def _current(self):
+		return [pid for pid, generation in self._workers.items() if generation==self._generation]
+
+	def _stop(self, signum, frame):
+		self._stopping = True
+
+	def _restart(self, signum, frame):
+		self._reload = True
+
+def serverAddress(configUri):
+	"""Return (host, port) from the [server:main] section of the config file, with defaults of 0.0.0.0 and 6543.
+	"""
+	parser = configparser.ConfigParser(interpolation=None)
+	parser.read(configUri.split('#')[0])
+	section = parser['server:main'] if parser.has_section('server:main') else {}
+	return section.get('host', '0.0.0.0'), int(section.get('port', 6543))
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Serve biopyramid with several worker processes.")
+	parser.add_argument('config', help="config file, eg. production.ini")
+	parser.add_argument('--workers', type=int, help="number of worker processes (default: biopyramid.prefork.workers, or number of cpus)")
+	parser.add_argument('--threads', type=int, help="number of threads in each worker (default: biopyramid.prefork.threads, or 4)")
+	parser.add_argument('--host', help="address to listen on (default: host of [server:main])")
+	parser.add_argument('--port', type=int, help="port to listen on (default: port of [server:main])")
+	args = parser.parse_args(argv[1:])
+
+	setup_logging(args.config)
+	env = bootstrap(args.config)
+	settings = env['registry'].settings
+	mutex.manager.processLocks = True
+
+	host, port = serverAddress(args.config)
+	sock = socket.create_server((args.host or host, args.port or port), backlog=1024)
+
+	server = PreforkServer(env['app'], env['request'], sock,
+						   workers=args.workers or int(settings.get('biopyramid.prefork.workers', 0)) or os.cpu_count() or 1,
+						   threads=args.threads or int(settings.get('biopyramid.prefork.threads', 4)),
+						   checkInterval=float(settings.get('biopyramid.prefork.check_interval', 5)))
+	log.info("Serving on http://%s:%s with %s workers", args.host or host, args.port or port, server.workers)
+	try:
+		server.run()
+	finally:
+		sock.close()
+		env['closer']()
+
+if __name__ == '__main__':
+	main()
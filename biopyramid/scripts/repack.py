@@ -0,0 +1,33 @@
+"""
+Command line tool to rewrite existing dataset files with compressed objects and expression matrices chunked
+for reading rows, which makes the files smaller. See bpdataset.repackDatasetFile().
+
+Usage:
+	biopyramid_repack data/datasets/haemopedia.2.7.h5
+	biopyramid_repack data/datasets --compression zlib --complevel 9
+	biopyramid_repack data/datasets --drop-frames
+
+As for biopyramid_memmap, the locks taken to replace the files extend to other processes (see biopyramid.views.mutex).
+"""
+import os, sys, argparse
+
+from biopyramid.models import bpdataset
+from biopyramid.views import mutex
+from biopyramid.scripts.memmap import datasetFilepaths
+
+def main(argv=sys.argv):
+	parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]), description="Compress dataset files.")
+	parser.add_argument('paths', nargs='+', help="dataset files or directories containing them")
+	parser.add_argument('--compression', default='blosc', help="compression library, eg. blosc, blosc:lz4 or zlib (default: blosc)")
+	parser.add_argument('--complevel', type=int, default=5, help="compression level from 1 to 9 (default: 5)")
+	parser.add_argument('--drop-frames', action='store_true', help="leave out /dataframe/expression objects, which genedataset needs to read the files")
+	args = parser.parse_args(argv[1:])
+	mutex.manager.processLocks = True
+
+	for filepath in datasetFilepaths(args.paths):
+		size = os.path.getsize(filepath)
+		bpdataset.repackDatasetFile(filepath, compression=args.compression, complevel=args.complevel, dropFrames=args.drop_frames)
+		print("%s: %.1f MB -> %.1f MB" % (filepath, size / 1e6, os.path.getsize(filepath) / 1e6))
+
+if __name__ == '__main__':
+	main()
@@ -12,6 +12,9 @@ Required inputs:
 	sampleGroupColours: dict of sample group colours keyed on sample group, {'celltype':['#cccccc',...], 'cell_lineage':['#f2f2f2',...]}
 	sampleIdsAsGroupItems: dict of sample group items in the same matching order as sampleIds, keyed on sample group,
 		{'celltype':['B','B','T','B',...], 'cell_lineage':['B-Cell Lineage','B-Cell Lineage',...]}
+	expressionSummaries: dict of summary statistics of expression values keyed on sample group, used instead of
+		expressionValues, sampleIds and sampleIdsAsGroupItems (which are then empty) if not empty, with one value
+		for each item of sampleGroupItems, {'celltype':{'mean':[4.1,...], 'min':[...], 'q1':[...], 'median':[...], 'q3':[...], 'max':[...]}, ...}
 '''
 import json
 
@@ -42,12 +45,45 @@ import json
 		sampleGroups: ${json.dumps(sampleGroups) |n},
 		sampleGroupItems: ${json.dumps(sampleGroupItems) |n},
 		sampleGroupColours: ${json.dumps(sampleGroupColours) |n},
-		sampleIdsAsGroupItems: ${json.dumps(sampleIdsAsGroupItems) |n}
+		sampleIdsAsGroupItems: ${json.dumps(sampleIdsAsGroupItems) |n},
+		expressionSummaries: ${json.dumps(expressionSummaries) |n}
 	};
 	
 	// This is default selected sample group, which can just be the first element of sample groups.
 	dataFromPython.selectedSampleGroup = dataFromPython.sampleGroups[0];
 
+	// Return plotly traces drawing a box for item i of summary (see expressionSummaries), using only trace types of the
+	// bundled plotly.js (v1.29), which can't draw box traces from precomputed statistics: a marker at the median with
+	// thin error bars from min to max, and thick error bars from q1 to q3 for the box itself.
+	function summaryTraces(groupItem, i, summary, colour) {
+		var text = ['max: ' + summary.max[i] + '<br>q3: ' + summary.q3[i] + '<br>median: ' + summary.median[i] + 
+					'<br>q1: ' + summary.q1[i] + '<br>min: ' + summary.min[i] + '<br>mean: ' + summary.mean[i]];
+		var whiskers = {
+			x: [groupItem], y: [summary.median[i]], text: text, hoverinfo: 'x+text',
+			name: groupItem, legendgroup: groupItem, type: 'scatter', mode: 'markers',
+			marker: { symbol: 'line-ew-open', size: 30, line: { width: 2 } },
+			error_y: { type: 'data', symmetric: false, array: [summary.max[i] - summary.median[i]], 
+					   arrayminus: [summary.median[i] - summary.min[i]], thickness: 1.5, width: 10 },
+		};
+		var box = {
+			x: [groupItem], y: [summary.median[i]], hoverinfo: 'none',
+			name: groupItem, legendgroup: groupItem, showlegend: false, type: 'scatter', mode: 'markers',
+			marker: { size: 0, opacity: 0 }, opacity: 0.5,
+			error_y: { type: 'data', symmetric: false, array: [summary.q3[i] - summary.median[i]], 
+					   arrayminus: [summary.median[i] - summary.q1[i]], thickness: 30, width: 0 },
+		};
+		var mean = {
+			x: [groupItem], y: [summary.mean[i]], hoverinfo: 'none',
+			name: groupItem, legendgroup: groupItem, showlegend: false, type: 'scatter', mode: 'markers',
+			marker: { symbol: 'diamond-open', size: 8 },
+		};
+		if (colour) {
+			whiskers.marker.color = whiskers.marker.line.color = whiskers.error_y.color = colour;
+			box.error_y.color = mean.marker.color = colour;
+		}
+		return [box, whiskers, mean];
+	}
+
 	var vm;	// This will be assigned to a Vue instance below. Having this as a global makes it easy to access it from console.
 	</script>
 </head>
@@ -96,20 +132,25 @@ import json
 				var self = this;	// this refers to the Vue instance, and it's safer to map it to another variable
 				var traces = [];
 				var selectedSampleGroup = self.data.selectedSampleGroup;
+				var summary = self.data.expressionSummaries[selectedSampleGroup];
 				// Each sample group item is a trace (eg. ['B','T'] if celltype was the sample group)
 				for (var i=0; i<self.data.sampleGroupItems[selectedSampleGroup].length; i++) {
 					var groupItem = self.data.sampleGroupItems[selectedSampleGroup][i];
-					var sampleIdsInThisGroupItem = self.data.sampleIds.filter(function(item,index) { return self.data.sampleIdsAsGroupItems[selectedSampleGroup][index]==groupItem });
+					var colour = (selectedSampleGroup in self.data.sampleGroupColours && groupItem in self.data.sampleGroupColours[selectedSampleGroup])?
+								 self.data.sampleGroupColours[selectedSampleGroup][groupItem] : null;
+					if (summary) {	// box drawn from precomputed statistics rather than from the value of each sample
+						if (summary.median[i]==null) continue;	// item without values
+						traces = traces.concat(summaryTraces(groupItem, i, summary, colour));
+						continue;
+					}
 					var trace = {
 						y: self.data.expressionValues.filter(function(item,index) { return self.data.sampleIdsAsGroupItems[selectedSampleGroup][index]==groupItem }),
-						//y:[1,2,3],
 						name: groupItem,
 						marker: {},
 						boxpoints: 'all',
 						type: "box",
 					};
-					if (selectedSampleGroup in self.data.sampleGroupColours && groupItem in self.data.sampleGroupColours[selectedSampleGroup])
-						trace.marker.color = self.data.sampleGroupColours[selectedSampleGroup][groupItem];
+					if (colour) trace.marker.color = colour;
 					traces.push(trace);
 				}
 				Plotly.newPlot("mainPlotDiv", traces, { title: self.data.geneId });
@@ -3,13 +3,13 @@
 This mako template renders the Genes page, which shows a search field and a list of genes in a table after the search is done.
 
 Required input:
-genes: json version of a geneset.Geneset instance, ie. a list of dictionaries, eg:
+genes: gene annotation of the last search (see GeneIndex.records()), ie. a list of dictionaries, eg:
 	[{'GeneId':'ENSG00000183625', 
 	  'GeneSymbol':'CCR3', 
 	  'EntrezId':'1232', 
 	  'Synonyms':'CC-CKR-3|CD193|CKR3|CMKBR3',
 	  'Description':'C-C motif chemokine receptor 3'}, ...]
-name: (string) geneset.Geneset name, which is the same as the last term used for search
+name: (string) the last term used for search
 '''
 import json
 %>
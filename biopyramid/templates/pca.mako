@@ -24,7 +24,22 @@ import json
 
 	<!-- javascript specific to this page -->
 	<script type="text/javascript" src="/js/plotly-latest.min.js"></script>
+	<script type="text/javascript" src="/js/axios.min.js"></script>
 	
+	<style>
+	.spinner {
+		display: inline-block;
+		width: 1em;
+		height: 1em;
+		vertical-align: middle;
+		border: 2px solid #cccccc;
+		border-top-color: #333333;
+		border-radius: 50%;
+		animation: spin 1s linear infinite;
+	}
+	@keyframes spin { to { transform: rotate(360deg); } }
+	</style>
+
 	<script>
 	// Define all the variables which come from python. Even though it's possible to inject these variables anywhere
 	// using the template variable syntax, mapping them all to one javascript variable here is recommended, 
@@ -43,6 +58,10 @@ import json
 	// This is default selected sample group, which can just be the first element of sample groups.
 	dataFromPython.selectedSampleGroup = dataFromPython.sampleGroups[0];
 
+	// PCA of large datasets runs in the job queue, and /pca_coords answers with 202 if it takes too long: its result
+	// is then polled every pollSeconds, up to maxPolls times.
+	var pollSeconds = 2, maxPolls = 150;
+
 	var vm;	// This will be assigned to a Vue instance below. Having this as a global makes it easy to access it from console.
 	</script>
 </head>
@@ -61,6 +80,14 @@ import json
 						dataset: <select v-model="data.selectedDatasetName" @change="reloadPage"><option v-for="item in data.datasetNames">{{item}}</option></select>
 						<select v-model="data.selectedSampleGroup" @change="updatePlot"><option v-for="item in data.sampleGroups">{{item}}</option></select>
 					</p>
+					<p>
+						recompute PCA using samples from: 
+						<select multiple v-model="selectedItems"><option v-for="item in data.sampleGroupItems[data.selectedSampleGroup]">{{item}}</option></select>
+						<button @click="computePCA" :disabled="selectedItems.length==0 || computing">compute</button>
+						<button @click="resetPCA" :disabled="computing">show all samples</button>
+						<span v-if="computing"><span class="spinner"></span> computing...</span>
+						<span v-if="message">{{message}}</span>
+					</p>
 				</div>
 				<div id="mainPlotDiv"></div>
 			</div>
@@ -83,6 +110,10 @@ import json
 		el: '.content',
 		data: {	// define all variables used by the Vue instance
 			data: dataFromPython,
+			selectedItems: [],	// sample group items selected for recomputing PCA
+			computing: false,	// true while waiting for recomputed PCA
+			message: '',	// shown if recomputing PCA failed
+			allSamples: {coords: dataFromPython.coords, sampleIds: dataFromPython.sampleIds, sampleIdsAsGroupItems: dataFromPython.sampleIdsAsGroupItems},
 		},
 		methods: {	// define all methods used by the Vue instance
 			// Function to perform the plot.
@@ -112,6 +143,83 @@ import json
 			reloadPage: function() {
 				window.location.href = 'pca?dataset=' + this.data.selectedDatasetName;
 			},
+
+			// Recompute PCA on the server using only the samples belonging to selected sample group items
+			computePCA: function() {
+				this.computing = true;
+				this.message = '';
+				axios.get('/pca_coords', {
+					params: {
+						dataset: this.data.selectedDatasetName,
+						sampleGroup: this.data.selectedSampleGroup,
+						sampleGroupItems: this.selectedItems.join(',')
+					}
+				}).then(response => {
+					if (response.status==202)	// still running in the job queue
+						this.pollJob(response.data.jobId, 0);
+					else
+						this.showPCA(response.data);
+				}).catch(error => { this.showError(error); });
+			},
+
+			// Fetch the result of PCA job with jobId from the job queue, trying again until it's finished or maxPolls is reached
+			pollJob: function(jobId, polls) {
+				if (polls>=maxPolls) {
+					this.computing = false;
+					this.message = 'PCA is taking too long, please try again later.';
+					return;
+				}
+				setTimeout(() => {
+					axios.get('/jobs/result', { params: { jobId: jobId } }).then(response => {
+						var job = response.data;
+						if (job.status=='finished')
+							this.showPCA({coords: job.result.sampleIds.length>0? job.result.coords : [[], []], 
+										  sampleIds: job.result.sampleIds,
+										  sampleIdsAsGroupItems: this.sampleGroupItemsOf(job.result.sampleIds)});
+						else if (job.status=='failed') {
+							this.computing = false;
+							this.message = 'PCA failed: ' + job.error;
+						}
+						else
+							this.pollJob(jobId, polls + 1);
+					}).catch(error => { this.showError(error); });
+				}, pollSeconds * 1000);
+			},
+
+			// Return sample group items of sampleIds keyed on sample group, in the same format as sampleIdsAsGroupItems,
+			// from those of all samples which came with the page (job results only have sample ids and coordinates)
+			sampleGroupItemsOf: function(sampleIds) {
+				var positions = {};
+				this.allSamples.sampleIds.forEach(function(sampleId, index) { if (!(sampleId in positions)) positions[sampleId] = index; });
+				var result = {};
+				for (var group in this.allSamples.sampleIdsAsGroupItems) {
+					var items = this.allSamples.sampleIdsAsGroupItems[group];
+					result[group] = sampleIds.map(function(sampleId) { return sampleId in positions? items[positions[sampleId]] : null; });
+				}
+				return result;
+			},
+
+			showPCA: function(pca) {
+				this.computing = false;
+				this.data.coords = pca.coords;
+				this.data.sampleIds = pca.sampleIds;
+				this.data.sampleIdsAsGroupItems = pca.sampleIdsAsGroupItems;
+				this.updatePlot();
+			},
+
+			showError: function(error) {
+				this.computing = false;
+				this.message = 'PCA failed: ' + (error.response? error.response.statusText : error.message);
+			},
+
+			// Go back to PCA coordinates of all samples, which came with the page
+			resetPCA: function() {
+				this.selectedItems = [];
+				this.data.coords = this.allSamples.coords;
+				this.data.sampleIds = this.allSamples.sampleIds;
+				this.data.sampleIdsAsGroupItems = this.allSamples.sampleIdsAsGroupItems;
+				this.updatePlot();
+			},
 		},
 		mounted() {	// Vue runs this section after loading the page
 			this.updatePlot();
@@ -0,0 +1,12 @@
+import unittest
+
+from biopyramid.scripts import benchmark
+
+class BenchmarkTest(unittest.TestCase):
+	"""Run the benchmarks on a tiny dataset, so that they keep working as the code changes.
+	"""
+	def test_runBenchmarks(self):
+		result = benchmark.runBenchmarks(genes=20, samples=6, groups=2, itemsPerGroup=3, repeat=1, clients=2, requestsPerClient=2)
+		self.assertIn('expressionMatrix_single', result['results'])
+		self.assertEqual(result['results']['view_pca_concurrent']['errors'], 0)
+		self.assertEqual(benchmark.compare(result, result), [])
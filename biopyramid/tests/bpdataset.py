@@ -0,0 +1,297 @@
+import unittest, tempfile, shutil, os
+
+import numpy, pandas
+
+from biopyramid.models import bpdataset
+from biopyramid.tests.fixtures import createTestDataset
+
+
+class DatasetRegistryTest(unittest.TestCase):
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp()
+		self.filepath = createTestDataset(self.datadir).filepath
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_dataset_is_reused(self):
+		from biopyramid.models.registry import DatasetRegistry
+		registry = DatasetRegistry()
+		ds = registry.dataset('test', self.filepath)
+		self.assertIs(registry.dataset('test', self.filepath), ds)
+
+	def test_dataset_is_reopened_when_file_changes(self):
+		from biopyramid.models.registry import DatasetRegistry
+		registry = DatasetRegistry()
+		ds = registry.dataset('test', self.filepath)
+		stat = os.stat(self.filepath)
+		os.utime(self.filepath, (stat.st_atime, stat.st_mtime + 10))
+		self.assertIsNot(registry.dataset('test', self.filepath), ds)
+
+	def test_maxsize(self):
+		from biopyramid.models.registry import DatasetRegistry
+		otherFilepath = createTestDataset(self.datadir, name='other').filepath
+		registry = DatasetRegistry(maxsize=1)
+		registry.dataset('test', self.filepath)
+		registry.dataset('other', otherFilepath)
+		self.assertEqual(registry.names(), ['other'])
+
+
+class DatasetCatalogueTest(unittest.TestCase):
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp()
+		createTestDataset(self.datadir)
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_refresh(self):
+		from biopyramid.models.catalogue import DatasetCatalogue
+		catalogue = DatasetCatalogue(self.datadir, refreshInterval=0)
+		self.assertEqual([item['name'] for item in catalogue.attributes()], ['test'])
+		otherFilepath = createTestDataset(self.datadir, name='other').filepath
+		self.assertEqual(catalogue.filepath('other'), otherFilepath)
+		os.remove(otherFilepath)
+		self.assertEqual(catalogue.filepath('other'), None)
+
+	def test_indexFile(self):
+		from biopyramid.models.catalogue import DatasetCatalogue
+		indexFile = os.path.join(self.datadir, 'catalogue.json')
+		DatasetCatalogue(self.datadir, indexFile=indexFile)
+		self.assertTrue(os.path.exists(indexFile))
+		catalogue = DatasetCatalogue(self.datadir, indexFile=indexFile)
+		self.assertEqual(catalogue.attributes()[0]['name'], 'test')
+		self.assertFalse(catalogue.refresh(force=True))
+
+
+class BPDatasetTest(unittest.TestCase):
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createTestDataset(self.datadir)
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_lazyLoading(self):
+		ds = bpdataset.BPDataset(self.ds.filepath)
+		self.assertEqual(ds._storedObjects, {})
+		self.assertEqual(ds.pca.shape, (4, 2))
+		self.assertEqual(list(ds._storedObjects.keys()), ['/dataframe/pca'])
+		ds.computePCA(store=True)
+		self.assertEqual(ds.sampleGroupOrdering('celltype'), ['T1', 'B2', 'B1'])
+
+	def test_openStore(self):
+		import threading
+		other = createTestDataset(self.datadir, name='other')
+		holding, release, done = threading.Event(), threading.Event(), threading.Event()
+		def readOther():
+			with bpdataset.openStore(other.filepath) as store:
+				with bpdataset.openStore(other.filepath) as nested:
+					self.assertIs(nested, store)	# nested blocks of a thread use its handle
+				holding.set()
+				release.wait(5)
+		def read(filepath):
+			with bpdataset.openStore(filepath) as store:
+				store['/series/attributes']
+			done.set()
+		for filepath in [self.ds.filepath, other.filepath]:
+			holding.clear(); release.clear(); done.clear()
+			threads = [threading.Thread(target=readOther), threading.Thread(target=read, args=(filepath,))]
+			threads[0].start()
+			holding.wait(5)
+			threads[1].start()
+			self.assertTrue(done.wait(5))	# reading a file does not wait for another reader, of the same file or not
+			release.set()
+			for thread in threads:
+				thread.join()
+
+		# handles are reused by later reads, and those in use when the file is closed are not
+		with bpdataset.openStore(other.filepath) as store:
+			bpdataset.closeStore(other.filepath)
+		self.assertFalse(store.is_open)
+		with bpdataset.openStore(other.filepath) as store:
+			pass
+		with bpdataset.openStore(other.filepath) as again:
+			self.assertIs(again, store)
+
+	def test_expressionMatrix(self):
+		ds = self.ds
+		self.assertEqual(ds.featureIndex('counts').to_dict(), {'gene1':0, 'gene2':1, 'gene3':2})
+		df = ds.expressionMatrix(featureIds=['gene3', 'gene1', 'missing'])
+		self.assertEqual(df.index.tolist(), ['gene3', 'gene1'])
+		self.assertEqual(df.loc['gene3'].tolist(), [0, 0, 39, 73])
+		self.assertEqual(ds.expressionMatrix(featureIds='gene2', sampleGroupForMean='celltype').at['gene2','B1'], 25)
+		self.assertEqual(len(ds.expressionMatrix(featureIds=['missing'])), 0)
+
+	def test_expressionMemmap(self):
+		from biopyramid.scripts import memmap
+		from biopyramid.views import mutex
+		self.assertIsNone(self.ds.expressionMemmap('counts'))
+		try:
+			memmap.main(['biopyramid_memmap', self.ds.filepath, '--keys', 'counts'])
+			ds = bpdataset.BPDataset(self.ds.filepath)
+			self.assertIsNotNone(ds.expressionMemmap('counts'))
+			self.assertEqual(ds.expressionMatrix('counts', featureIds=['gene3']).loc['gene3'].tolist(), [0, 0, 39, 73])
+			self.assertEqual(ds.expressionMatrix('counts').values.dtype, 'float32')
+			self.assertEqual(ds.expressionMatrix('cpm').shape, (3, 4))
+
+			# memory mapped files are removed under the writer lock, which extends to other processes
+			locks = []
+			mutex.manager.timingHooks.append(lambda filepath, exclusive, waited, held: locks.append((filepath, exclusive)))
+			try:
+				memmap.main(['biopyramid_memmap', self.ds.filepath, '--remove'])
+			finally:
+				mutex.manager.timingHooks.pop()
+			self.assertIn((self.ds.filepath, True), locks)
+			self.assertTrue(os.path.exists('%s.lock' % self.ds.filepath))
+			self.assertFalse(os.path.exists(bpdataset.expressionMemmapPath(self.ds.filepath, 'counts')))
+		finally:
+			mutex.manager.processLocks = False
+
+	def test_iterExpressionRows(self):
+		chunks = list(self.ds.iterExpressionRows(['gene3', 'missing', 'gene1', 'gene3'], chunkSize=1))
+		self.assertEqual([df.index.tolist() for df in chunks], [['gene3'], ['gene1']])
+		chunks = self.ds.iterExpressionRows(['gene3', 'gene1'], chunkSize=1)
+		os.utime(self.ds.filepath, (0, 0))	# as if the file was written after the rows were asked for
+		self.assertRaises(bpdataset.DatasetFileChanged, next, chunks)
+		self.assertEqual(self.ds.expressionColumns(), ['s01', 's02', 's03', 's04'])
+
+	def test_sampleGroupItems(self):
+		ds = self.ds
+		self.assertEqual(ds.sampleGroupItems(sampleGroup='celltype'), ['T1', 'B2', 'B1'])
+		self.assertEqual(ds.sampleGroupItems(sampleGroup='celltype', groupBy='cell_lineage'),
+						 {'B Cell Lineage':['B2', 'B1'], 'T Cell Lineage':['T1']})
+		self.assertEqual(ds.sampleGroupItems(sampleGroup='celltype', duplicates=True), ['B1', 'B1', 'T1', 'B2'])
+		ds.sampleGroupItems(sampleGroup='celltype').append('X')	# cached value is not affected
+		self.assertEqual(ds.sampleGroupMetadata()['sampleGroupItems']['celltype'], ['T1', 'B2', 'B1'])
+
+		# a sample id listed more than once in the sample table takes the item of its first row
+		samples = pandas.DataFrame({'celltype':['B1', 'B1', 'T1', 'B2', 'T1']}, index=pandas.Index(['s01', 's02', 's03', 's04', 's04'], name='sampleId'))
+		ds = createTestDataset(self.datadir, name='duplicates', samples=samples, sampleGroupsDisplayed=['celltype'])
+		self.assertEqual(ds.sampleGroupItems(sampleGroup='celltype', duplicates=True), ['B1', 'B1', 'T1', 'B2'])
+		self.assertAlmostEqual(ds.groupSummaries(['gene1'], 'celltype')['gene1'].at['B2','mean'], numpy.log2(102), places=5)
+
+	def test_computePCA(self):
+		ds = self.ds
+		signature = bpdataset._fileSignature(ds.filepath)
+		pca = ds.computePCA(sampleIds=['s04', 's01', 's03', 'missing'], store=True)
+		self.assertEqual(bpdataset._fileSignature(ds.filepath), signature)	# saved next to the dataset file, not in it
+		self.assertEqual(len(os.listdir(bpdataset.pcaCachePath(ds.filepath))), 1)
+		self.assertEqual(pca.index.tolist(), ['s04', 's01', 's03'])
+		self.assertEqual(pca.columns.tolist(), ['PC1', 'PC2'])
+		self.assertIs(ds.computePCA(sampleIds=['s04', 's01', 's03']), pca)
+		stored = bpdataset.BPDataset(ds.filepath).computePCA(sampleIds=['s04', 's01', 's03'])
+		self.assertTrue((stored.values==pca.values).all())
+
+		# too few samples for a PCA, without warnings about the variance of no values
+		import warnings
+		with warnings.catch_warnings():
+			warnings.simplefilter('error', RuntimeWarning)
+			self.assertEqual(len(ds.computePCA(sampleIds=['missing'])), 0)
+			self.assertEqual(ds.computePCA(sampleIds=['s01']).index.tolist(), ['s01'])
+
+	def test_correlatedFeatures(self):
+		ds = self.ds
+		computed = ds.correlatedFeatures('gene1', top=5)
+		self.assertEqual(sorted(computed.index), ['gene2', 'gene3'])
+		values = numpy.log2(ds.expressionMatrix(featureIds=['gene1', 'gene3']).values.astype(float) + 1)
+		self.assertAlmostEqual(computed['gene3'], numpy.corrcoef(values)[0,1], places=5)
+		self.assertEqual(len(ds.correlatedFeatures('missing')), 0)
+
+		bpdataset.writeCorrelationMatrices(ds.filepath, 'counts')
+		stored = bpdataset.BPDataset(ds.filepath).correlatedFeatures('gene1', method='spearman', top=1, negative=True)
+		expected = ds.expressionMatrix('counts').T.astype(float).corr(method='spearman')['gene1'].drop('gene1')
+		self.assertEqual(stored.index.tolist(), [expected.idxmin()])
+		self.assertAlmostEqual(stored.iloc[0], expected.min(), places=5)
+
+	def test_correlationMatricesWithMissingValues(self):
+		counts = pandas.DataFrame([[35, numpy.nan, 21, 101], [numpy.nan]*4, [0, 0, 39, 73]],
+								  index=pandas.Index(['gene1', 'gene2', 'gene3'], name='geneId'), columns=['s01', 's02', 's03', 's04'])
+		ds = createTestDataset(self.datadir, name='missing', expressions=[counts, counts])
+		computed = ds._correlationMatrix('counts', 'pearson')
+		self.assertTrue(numpy.allclose(computed, bpdataset.normalisedRows(counts.values, log=True)))	# missing values are not negative
+		bpdataset.writeCorrelationMatrices(ds.filepath, 'counts', blockSize=1)	# a block of missing values only
+		stored = bpdataset.BPDataset(ds.filepath)._correlationMatrix('counts', 'pearson')
+		self.assertTrue(numpy.allclose(stored, computed))
+
+	def test_differentialExpression(self):
+		self.assertRaises(ValueError, self.ds.differentialExpression, 'celltype', 'B1', 'T1')	# T1 has a single sample
+		self.assertRaises(ValueError, self.ds.differentialExpression, 'missing', 'B1', 'T1')
+
+		samples = pandas.DataFrame({'celltype':['B1', 'B1', 'T1', 'T1']}, index=pandas.Index(['s01', 's02', 's03', 's04'], name='sampleId'))
+		ds = createTestDataset(self.datadir, name='de', samples=samples, sampleGroupsDisplayed=['celltype'])
+		df = ds.differentialExpression('celltype', 'B1', 'T1')
+		self.assertEqual(df.index.tolist(), ['gene1', 'gene2', 'gene3'])
+		a, b = numpy.log2(numpy.array([35, 44]) + 1), numpy.log2(numpy.array([21, 101]) + 1)
+		self.assertAlmostEqual(df.at['gene1','logFC'], a.mean() - b.mean(), places=5)
+		self.assertAlmostEqual(df.at['gene1','t'], (a.mean() - b.mean()) / numpy.sqrt(a.var(ddof=1) / 2 + b.var(ddof=1) / 2), places=5)
+		self.assertIs(ds.differentialExpression('celltype', 'B1', 'T1'), df)
+
+		# a sample id repeated in the sample table keeps the item of its first row
+		samples = pandas.DataFrame({'celltype':['B1', 'B1', 'T1', 'T1', 'B1']}, index=pandas.Index(['s01', 's02', 's03', 's04', 's04'], name='sampleId'))
+		ds = createTestDataset(self.datadir, name='duplicates', samples=samples, sampleGroupsDisplayed=['celltype'])
+		self.assertAlmostEqual(ds.differentialExpression('celltype', 'B1', 'T1').at['gene1','logFC'], a.mean() - b.mean(), places=5)
+
+	def test_studentPValues(self):
+		# values of scipy.stats.t.sf(abs(t), df) * 2
+		self.assertTrue(numpy.allclose(bpdataset.studentPValues([2.0, -3.5, 0, numpy.nan], [10, 3.3, 5, 4]), 
+									   [0.0733880, 0.0339488, 1, 1], atol=1e-6))
+		self.assertTrue(numpy.allclose(bpdataset.benjaminiHochberg([0.01, 0.04, 0.03, 0.5]), [0.04, 0.16 / 3, 0.16 / 3, 0.5]))
+
+	def test_groupSummaries(self):
+		expected = numpy.log2(numpy.array([35, 44]) + 1)
+		computed = self.ds.groupSummaries(['gene1', 'missing'], 'celltype')
+		self.assertEqual(list(computed.keys()), ['gene1'])
+		self.assertEqual(computed['gene1'].index.tolist(), ['T1', 'B2', 'B1'])
+		self.assertAlmostEqual(computed['gene1'].at['B1','mean'], expected.mean(), places=5)
+		self.assertAlmostEqual(computed['gene1'].at['B1','min'], expected.min(), places=5)
+
+		bpdataset.writeGroupSummaries(self.ds.filepath, 'counts')
+		bpdataset.repackDatasetFile(self.ds.filepath)
+		stored = bpdataset.BPDataset(self.ds.filepath).groupSummaries(['gene3', 'gene1'], 'celltype')
+		self.assertTrue(numpy.allclose(stored['gene1'].values, computed['gene1'].values))
+		self.assertAlmostEqual(stored['gene3'].at['T1','median'], numpy.log2(40), places=5)
+
+	def test_repackDatasetFile(self):
+		from biopyramid.scripts import repack
+		bpdataset.writeCorrelationMatrices(self.ds.filepath, 'counts')
+		from biopyramid.views import mutex
+		try:
+			repack.main(['biopyramid_repack', self.ds.filepath, '--drop-frames'])
+		finally:
+			mutex.manager.processLocks = False
+		ds = bpdataset.BPDataset(self.ds.filepath)
+		self.assertEqual(ds.expressionMatrix('counts', featureIds=['gene3']).loc['gene3'].tolist(), [0, 0, 39, 73])
+		self.assertEqual(ds.expressions['cpm'].shape, (3, 4))
+		self.assertEqual(ds.sampleGroupOrdering('celltype'), ['T1', 'B2', 'B1'])
+		self.assertEqual(len(ds.correlatedFeatures('gene1')), 2)
+		store = pandas.HDFStore(ds.filepath, mode='r')
+		try:
+			self.assertNotIn('/dataframe/expression/counts', store.keys())
+		finally:
+			store.close()
+
+	def test_createDatasetFile(self):
+		# expression matrices are also stored as /dataframe/expression objects, which genedataset reads, unless dropFrames is True
+		import genedataset.dataset
+		for dropFrames in (True, False):
+			ds = createTestDataset(self.datadir, name='frames', dropFrames=dropFrames)
+			store = pandas.HDFStore(ds.filepath, mode='r')
+			try:
+				self.assertEqual('/dataframe/expression/counts' in store.keys(), not dropFrames)
+			finally:
+				store.close()
+			self.assertEqual(ds.expressions['counts'].loc['gene3'].tolist(), [0, 0, 39, 73])
+			bpdataset.closeStore(ds.filepath)
+		self.assertEqual(genedataset.dataset.Dataset(ds.filepath).expressions['counts'].loc['gene3'].tolist(), [0, 0, 39, 73])
+
+		# the objects can be added to a file without them, a block of rows at a time
+		ds = createTestDataset(self.datadir, name='frames', dropFrames=True)
+		for key in ds.expression_data_keys:
+			bpdataset.writeExpressionFrame(ds.filepath, key, blockSize=2)
+		expressions = genedataset.dataset.Dataset(ds.filepath).expressions
+		self.assertTrue(expressions['counts'].equals(ds.expressionMatrix('counts')))
+		self.assertTrue(expressions['cpm'].equals(ds.expressionMatrix('cpm')))
@@ -0,0 +1,74 @@
+import io, gzip, json, struct, unittest, tempfile, shutil
+
+import numpy, pandas, tables
+
+from biopyramid.models import bpdataset
+
+class DownloadTest(unittest.TestCase):
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createSyntheticDataset, createApp
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createSyntheticDataset(self.datadir, genes=2500, samples=12)
+		self.app = TestApp(createApp(self.datadir))
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_csv(self):
+		response = self.app.get('/download?dataset=%s' % self.ds.name)
+		self.assertIn('attachment', response.headers['Content-Disposition'])
+		df = pandas.read_csv(io.StringIO(response.text), index_col=0)
+		expected = self.ds.expressionMatrix()
+		self.assertEqual(df.index.tolist(), expected.index.tolist())
+		self.assertTrue(numpy.allclose(df.values, expected.values))
+
+	def test_subset(self):
+		geneIds = self.ds.featureIds()[:3] + ['notAGene']
+		sampleGroup = self.ds.sampleGroups()[0]
+		items = self.ds.samples[sampleGroup].unique()[:1].tolist()
+		response = self.app.get('/download', {'dataset':self.ds.name, 'geneIds':','.join(geneIds), 'format':'tsv', 'gzip':'true',
+											  'sampleGroup':sampleGroup, 'sampleGroupItems':','.join(items)})
+		self.assertEqual(response.content_type, 'application/gzip')
+		df = pandas.read_csv(io.StringIO(gzip.decompress(response.body).decode('utf-8')), sep='\t', index_col=0)
+		sampleIds = self.ds.samples.index[self.ds.samples[sampleGroup].isin(items)].tolist()
+		self.assertEqual(df.index.tolist(), geneIds[:3])
+		self.assertEqual(sorted(df.columns), sorted(sampleIds))
+
+	def test_binary(self):
+		body = self.app.get('/download', {'dataset':self.ds.name, 'format':'binary', 'sampleIds':'sample00000,sample00003'}).body
+		length = struct.unpack('<I', body[:4])[0]
+		header = json.loads(body[4:4 + length].decode('utf-8'))
+		values = numpy.frombuffer(body[4 + length:], dtype='<f4').reshape(header['shape'])
+		self.assertEqual(header['sampleIds'], ['sample00000', 'sample00003'])
+		self.assertTrue(numpy.allclose(values, self.ds.expressionMatrix()[['sample00000', 'sample00003']].values, rtol=1e-5))
+
+	def test_fileReplaced(self):
+		import os, webob
+		from biopyramid.tests.fixtures import createSyntheticDataset
+		status, headers, chunks = webob.Request.blank('/download?dataset=%s' % self.ds.name).call_application(self.app.app)
+		chunks = iter(chunks)
+		next(chunks)	# header
+		next(chunks)	# first chunk of rows
+		otherdir = tempfile.mkdtemp(dir=self.datadir)
+		other = createSyntheticDataset(otherdir, genes=2500, samples=12, seed=1)
+		os.rename(other.filepath, self.ds.filepath)
+		# rows of the new file are not sent after those of the old one
+		self.assertRaises(bpdataset.DatasetFileChanged, next, chunks)
+
+	def test_badRequest(self):
+		self.app.get('/download?dataset=notADataset', status=404)
+		self.app.get('/download?dataset=%s&format=xls' % self.ds.name, status=400)
+
+	def test_withoutRowLayout(self):
+		from biopyramid.tests.fixtures import createTestDataset
+		ds = createTestDataset(self.datadir, name='frames', dropFrames=False)
+		bpdataset.closeStore(ds.filepath)
+		h5 = tables.open_file(ds.filepath, mode='a')
+		try:
+			for path in ('/matrix', '/series/featureIndex', '/series/matrixColumns'):
+				h5.remove_node(path, recursive=True)
+		finally:
+			h5.close()
+		self.app.get('/download?dataset=frames', status=409)
@@ -0,0 +1,81 @@
+import unittest, tempfile, shutil, json, struct
+
+import numpy, pandas
+
+from biopyramid.models import bpdataset
+from biopyramid.tests.fixtures import createTestDataset
+
+class ExpressionValuesTest(unittest.TestCase):
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		self.datadir = tempfile.mkdtemp()
+		counts = pandas.DataFrame([[35, 44, 21, 101], [50, numpy.nan, 14, 62], [0, 0, 39, 73]],
+								  index=pandas.Index(['gene1', 'gene2', 'gene3'], name='geneId'), columns=['s01', 's02', 's03', 's04'])
+		createTestDataset(self.datadir, expressions=[counts, counts])
+		self.app = TestApp(createApp(self.datadir))
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_json(self):
+		response = self.app.get('/expression_values?dataset=test&geneIds=gene2,missing,gene1')
+		result = json.loads(response.body.decode('utf-8'), parse_constant=self.fail)	# NaN and Infinity are not valid json
+		self.assertEqual(result['sampleIds'], ['s01', 's02', 's03', 's04'])
+		self.assertEqual([row[0] for row in result['rows']], ['gene2', 'gene1'])
+		self.assertIsNone(result['rows'][0][1][1])
+		self.assertAlmostEqual(result['rows'][1][1][0], numpy.log2(36), places=5)
+
+	def test_binary(self):
+		body = self.app.get('/expression_values?dataset=test&geneIds=gene2,gene1&format=binary').body
+		length = struct.unpack('<I', body[:4])[0]
+		header = json.loads(body[4:4 + length].decode('utf-8'))
+		self.assertEqual(header['geneIds'], ['gene2', 'gene1'])
+		self.assertEqual(header['shape'], [2, 4])
+		values = numpy.frombuffer(body[4 + length:], dtype='<f4').reshape(header['shape'])
+		self.assertTrue(numpy.isnan(values[0,1]))
+		self.assertAlmostEqual(float(values[1,0]), numpy.log2(36), places=5)
+
+class ExpressionPageTest(unittest.TestCase):
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createTestDataset(self.datadir, groupSummaries=True)
+		self.app = TestApp(createApp(self.datadir))
+		self.read = []
+		bpdataset.readHooks.append(self.objectRead)
+
+	def tearDown(self):
+		bpdataset.readHooks.remove(self.objectRead)
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def objectRead(self, filepath, obj):
+		self.read.append(obj)
+
+	def test_summary(self):
+		self.app.get('/expression?dataset=test&geneId=gene1&summary=true')
+		# only the stored summaries are read, not the values of every sample
+		self.assertTrue(any(getattr(obj, 'shape', None)==(1, 3, 6) for obj in self.read))
+		self.assertFalse(any(getattr(obj, 'shape', None)==(1, 4) for obj in self.read))
+		self.read = []
+		self.app.get('/expression?dataset=test&geneId=gene1')
+		self.assertTrue(any(getattr(obj, 'shape', None)==(1, 4) for obj in self.read))
+
+	def test_summaryPayload(self):
+		# every statistic the template draws from must be in the page, with a value for each sample group item
+		import re, os
+		template = open(os.path.join(os.path.dirname(bpdataset.__file__), '..', 'templates', 'expression.mako')).read()
+		used = set(re.findall(r'summary\.(\w+)\[i\]', template))
+		self.assertTrue(used)
+		body = self.app.get('/expression?dataset=test&geneId=gene1&summary=true').text
+		data = dict((name, json.loads(value)) for name, value in re.findall(r'^\t\t(\w+): (.*?),?$', body, re.M)
+					if name in ('sampleGroupItems', 'expressionSummaries'))
+		self.assertTrue(data['expressionSummaries'])
+		for sampleGroup, summary in data['expressionSummaries'].items():
+			self.assertTrue(used <= set(summary))
+			for stat in used:
+				self.assertEqual(len(summary[stat]), len(data['sampleGroupItems'][sampleGroup]))
+			self.assertTrue(all(value is not None for value in summary['median']))
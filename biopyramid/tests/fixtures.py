@@ -0,0 +1,34 @@
+"""
+Functions creating dataset files and applications shared by the tests. Synthetic datasets and the application
+come from biopyramid.models.synthetic, which the benchmarks also use.
+"""
+import pandas
+
+from biopyramid.models import bpdataset
+from biopyramid.models.synthetic import createSyntheticDataset, createApp
+
+def createTestDataset(destDir, name='test', **kwargs):
+	"""Create a small BPDataset file in destDir and return the BPDataset instance.
+	Any keyword argument is passed on to bpdataset.createDatasetFile().
+	"""
+	attributes = {"name": name,
+				  "fullname": "Test Dataset",
+				  "version": "1.0",
+				  "description": "Created for biopyramid tests",
+				  "expression_data_keys": ["counts", "cpm"],
+				  "pubmed_id": None,
+				  "species": "MusMusculus"}
+	samples = pandas.DataFrame([['B1', 'B Cell Lineage'], ['B1', 'B Cell Lineage'], ['T1', 'T Cell Lineage'], ['B2', 'B Cell Lineage']],
+							   index=['s01', 's02', 's03', 's04'], columns=['celltype', 'cell_lineage'])
+	samples.index.name = "sampleId"
+	counts = pandas.DataFrame([[35, 44, 21, 101], [50, 0, 14, 62], [0, 0, 39, 73]],
+							  index=['gene1', 'gene2', 'gene3'], columns=['s01', 's02', 's03', 's04'])
+	counts.index.name = "geneId"
+	cpm = counts * 1e6 / counts.sum()
+	params = dict(attributes=attributes, samples=samples, expressions=[counts, cpm],
+				  sampleGroupsDisplayed=['celltype', 'cell_lineage'],
+				  sampleGroupOrdering={'celltype': ['T1', 'B2', 'B1']},
+				  sampleGroupColours={'celltype': {'B1': '#ff0000'}},
+				  pca=pandas.DataFrame([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0], [7.0, 8.0]], index=samples.index, columns=['x', 'y']))
+	params.update(kwargs)
+	return bpdataset.createDatasetFile(destDir, **params)
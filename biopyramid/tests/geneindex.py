@@ -0,0 +1,39 @@
+import unittest
+
+from biopyramid.models.geneindex import GeneIndex
+
+class GeneIndexTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.index = GeneIndex()
+
+	def test_search(self):
+		index = self.index
+		self.assertEqual(set(index.search('ccr3', matchType='exact')), set(['ENSG00000183625', 'ENSMUSG00000035448']))
+		self.assertEqual(index.search('Ccr3', matchType='exact', caseSensitive=True), ['ENSMUSG00000035448'])
+		self.assertEqual(index.search('ENSMUSG00000035448'), ['ENSMUSG00000035448'])
+		self.assertEqual(index.search('ccr3', species='HomoSapiens', limit=1), ['ENSG00000183625'])
+		self.assertEqual(index.search(''), [])
+
+	def test_prefix(self):
+		geneIds = self.index.search('ccr1')
+		self.assertEqual(set(geneIds[:2]), set(self.index.search('ccr1', matchType='exact')))	# exact matches first
+		self.assertTrue(set(self.index.search('ccr10')).issubset(geneIds))
+		self.assertEqual(len(self.index.matches('ccr', limit=5)), 5)
+
+	def test_substring(self):
+		from biopyramid.models import geneindex
+		geneIds = self.index.search('chemokine receptor 3')	# no term starts with it, so descriptions are searched
+		self.assertIn('ENSMUSG00000044337', geneIds)
+		self.assertIn('ENSG00000183625', geneIds)
+		self.assertEqual(self.index.search('chemokine receptor 3', species='HomoSapiens'), [geneId for geneId in geneIds if geneId.startswith('ENSG')])
+		self.assertEqual(len(self.index.search('chemokine receptor 3', limit=1)), 1)
+		self.assertEqual(self.index.search('chemokine receptor 3', matchType='exact'), [])
+		self.assertEqual(len(self.index.search('c')), geneindex.searchLimit)
+		self.assertGreater(len(self.index.search('c', limit=None)), geneindex.searchLimit)
+
+	def test_records(self):
+		records = self.index.records(['ENSMUSG00000035448', 'missing', 'ENSG00000183625'])
+		self.assertEqual([item['EnsemblId'] for item in records], ['ENSMUSG00000035448', 'ENSG00000183625'])
+		self.assertEqual(records[0]['GeneSymbol'], 'Ccr3')
+		self.assertNotIn('TranscriptLengths', records[0])
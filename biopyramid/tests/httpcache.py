@@ -0,0 +1,73 @@
+import unittest, tempfile, shutil, os
+
+from biopyramid.models import bpdataset
+from biopyramid.views.httpcache import ResponseCache
+from biopyramid.tests.fixtures import createTestDataset
+
+class ResponseCacheTest(unittest.TestCase):
+	def test_lru(self):
+		cache = ResponseCache(maxBytes=100)
+		for etag in ['a', 'b', 'c', 'd']:
+			cache.put(etag, b'0' * 25, 'text/html', 'UTF-8')
+		cache.get('a')
+		cache.put('e', b'1' * 25, 'application/json', None)
+		self.assertEqual(cache.get('b'), None)	# least recently used
+		self.assertEqual(cache.get('a')[0], b'0' * 25)
+		self.assertEqual(cache.get('e')[1], 'application/json')
+		cache.put('f', b'0' * 26, 'text/html', None)	# bigger than a quarter of maxBytes
+		self.assertEqual(cache.get('f'), None)
+
+class CachedViewTest(unittest.TestCase):
+	"""Conditional requests to a route using the cached decorator.
+	"""
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		self.datadir = tempfile.mkdtemp()
+		self.filepath = createTestDataset(self.datadir).filepath
+		self.app = TestApp(createApp(self.datadir))
+		self.url = '/pca_coords?dataset=test&sampleIds=s01,s02,s03'
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_etag(self):
+		response = self.app.get(self.url)
+		etag = response.headers['ETag']
+		self.assertTrue(response.headers.get('Last-Modified'))
+		self.assertEqual(self.app.get(self.url).headers['ETag'], etag)
+		self.assertNotEqual(self.app.get(self.url + ',s04').headers['ETag'], etag)
+
+		response = self.app.get(self.url, headers={'If-None-Match':etag}, status=304)
+		self.assertEqual(response.headers['ETag'], etag)
+		self.assertEqual(response.body, b'')
+		self.app.get(self.url, headers={'If-None-Match':'"other"'}, status=200)
+
+	def test_ifModifiedSince(self):
+		lastModified = self.app.get(self.url).headers['Last-Modified']
+		self.app.get(self.url, headers={'If-Modified-Since':lastModified}, status=304)
+		self.app.get(self.url, headers={'If-Modified-Since':'Thu, 01 Jan 1970 00:00:00 GMT'}, status=200)
+
+	def test_fileChange(self):
+		response = self.app.get(self.url)
+		etag, lastModified = response.headers['ETag'], response.headers['Last-Modified']
+		# a new version of the dataset file invalidates responses browsers have kept
+		stat = os.stat(self.filepath)
+		os.utime(self.filepath, (stat.st_atime, stat.st_mtime + 60))
+		response = self.app.get(self.url, headers={'If-None-Match':etag}, status=200)
+		self.assertNotEqual(response.headers['ETag'], etag)
+		self.app.get(self.url, headers={'If-Modified-Since':lastModified}, status=200)
+
+	def test_catalogueChange(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		other = createTestDataset(self.datadir, name='other').filepath
+		app = TestApp(createApp(self.datadir, **{'biopyramid.model.catalogue_refresh':'0'}))
+		lastModified = app.get(self.url).headers['Last-Modified']
+		app.get(self.url, headers={'If-Modified-Since':lastModified}, status=304)
+		# removing another dataset changes the list of datasets shown by the page, but not the file of this one
+		os.remove(other)
+		stat = os.stat(self.datadir)
+		os.utime(self.datadir, (stat.st_atime, stat.st_mtime + 60))
+		app.get(self.url, headers={'If-Modified-Since':lastModified}, status=200)
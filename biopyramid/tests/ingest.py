@@ -0,0 +1,76 @@
+import os, unittest, tempfile, shutil
+
+import numpy, pandas, tables
+
+from biopyramid.models import bpdataset, ingest
+
+class IngestTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		rng = numpy.random.RandomState(0)
+		self.counts = pandas.DataFrame(rng.poisson(20, size=(3000, 8)), columns=['s%s' % i for i in range(8)],
+									   index=pandas.Index(['gene%s' % i for i in range(3000)], name='geneId'))
+		self.counts.to_csv(os.path.join(self.dir, 'counts.tsv.gz'), sep='\t')
+		self.samples = pandas.DataFrame({'celltype':['B', 'T'] * 4}, index=pandas.Index(self.counts.columns, name='sampleId'))
+		self.samples.to_csv(os.path.join(self.dir, 'samples.csv'))
+		self.attributes = {'name':'ingested', 'version':'1.0', 'fullname':'Ingested', 'species':'MusMusculus'}
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.dir)
+
+	def ingest(self, **kwargs):
+		return ingest.ingestDataset(self.dir, os.path.join(self.dir, 'counts.tsv.gz'), os.path.join(self.dir, 'samples.csv'),
+									self.attributes, blockBytes=4096, blockSize=700, **kwargs)
+
+	def assertDataset(self, ds):
+		self.assertEqual(ds.expression_data_keys, ['counts', 'cpm'])
+		self.assertEqual(ds.featureIds(), self.counts.index.tolist())
+		self.assertTrue(numpy.array_equal(ds.expressionMatrix('counts').values, self.counts.values))
+		cpm = self.counts / self.counts.sum() * 1e6
+		self.assertTrue(numpy.allclose(ds.expressionMatrix('cpm').values, cpm.values, rtol=1e-5))
+		self.assertEqual(ds.pca.shape, (8, 2))
+		self.assertEqual(ds.sampleGroups(), ['celltype'])
+		self.assertFalse(os.path.exists(ds.filepath + '.ingest.tmp'))
+
+	def test_ingestDataset(self):
+		import genedataset.dataset
+		ds = self.ingest(processes=2, groupSummaries=True)
+		self.assertDataset(ds)
+		self.assertTrue(numpy.array_equal(genedataset.dataset.Dataset(ds.filepath).expressions['counts'].values, self.counts.values))
+		self.assertEqual(len(ds.groupSummaries(['gene0'], 'celltype')['gene0']), 2)
+
+	def test_memmap(self):
+		ds = self.ingest(processes=1, derivedKeys=(), memmap=True, dropFrames=True)
+		with pandas.HDFStore(ds.filepath, mode='r') as store:
+			self.assertNotIn('/dataframe/expression/counts', store.keys())
+		# memory mapped files are written next to the temporary file and put in place with it
+		self.assertTrue(os.path.exists(bpdataset.expressionMemmapPath(ds.filepath, 'counts')))
+		self.assertFalse(os.path.exists(bpdataset.expressionMemmapPath(ds.filepath + '.ingest.tmp', 'counts')))
+		self.assertTrue(numpy.array_equal(ds.expressionMemmap('counts'), self.counts.values))
+
+	def test_resume(self):
+		parseBlock, calls = ingest._parseBlock, []
+		def countingParseBlock(*args):
+			calls.append(1)
+			if len(calls)==4 and interrupt:
+				raise KeyboardInterrupt()
+			return parseBlock(*args)
+		ingest._parseBlock = countingParseBlock
+		try:
+			interrupt = True
+			self.assertRaises(KeyboardInterrupt, self.ingest, processes=1)
+			h5 = tables.open_file(os.path.join(self.dir, 'ingested.1.0.h5.ingest.tmp'), mode='r')
+			try:
+				self.assertEqual(h5.root.ingest._v_attrs.blocks, 3)
+			finally:
+				h5.close()
+
+			interrupt, calls[:] = False, []
+			self.assertDataset(self.ingest(processes=1))
+			resumedBlocks = len(calls)
+			calls[:] = []
+			self.ingest(processes=1)
+			self.assertEqual(resumedBlocks, len(calls) - 3)
+		finally:
+			ingest._parseBlock = parseBlock
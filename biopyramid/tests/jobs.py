@@ -0,0 +1,77 @@
+import unittest, tempfile, shutil
+
+from biopyramid.models import bpdataset
+from biopyramid.tests.fixtures import createTestDataset
+
+class JobQueueTest(unittest.TestCase):
+	def setUp(self):
+		from biopyramid.models.jobs import JobQueue
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createTestDataset(self.datadir)
+		self.queue = JobQueue(workers=1)
+
+	def tearDown(self):
+		self.queue.shutdown()
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_pca(self):
+		jobId = self.queue.submit('pca', self.ds.filepath, {'sampleIds':'s04,s01,s03'})
+		self.assertEqual(self.queue.submit('pca', self.ds.filepath, {'sampleIds':'s04,s01,s03'}), jobId)
+		result = self.queue.result(jobId, timeout=60)
+		self.assertEqual(result['sampleIds'], ['s04', 's01', 's03'])
+		self.assertEqual(self.queue.status(jobId)['status'], 'finished')
+		pca = self.ds.computePCA(sampleIds=['s04', 's01', 's03'])
+		self.assertAlmostEqual(result['coords'][0][0], pca.values[0][0], places=4)
+
+	def test_runJob(self):
+		from biopyramid.models.jobs import runJob
+		jobId = self.queue.submit('coexpression', self.ds.filepath, {'geneId':'gene1', 'top':'5'})
+		self.assertEqual(self.queue.result(jobId, timeout=60), runJob('coexpression', self.ds, {'geneId':'gene1', 'top':5}))
+		self.assertRaises(ValueError, runJob, 'missing', self.ds)
+
+class JobViewsTest(unittest.TestCase):
+	"""Views handing their computations to the job queue.
+	"""
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		self.datadir = tempfile.mkdtemp()
+		createTestDataset(self.datadir)
+		self.router = createApp(self.datadir, **{'biopyramid.jobs.min_values':'1', 'biopyramid.jobs.workers':'1'})
+		self.app = TestApp(self.router)
+		self.inline = TestApp(createApp(self.datadir))
+
+	def tearDown(self):
+		if getattr(self.router.registry, 'jobQueue', None) is not None:
+			self.router.registry.jobQueue.shutdown()
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_coexpression(self):
+		url = '/coexpression?dataset=test&geneId=gene1&top=5'
+		self.assertEqual(self.app.get(url).json_body, self.inline.get(url).json_body)
+		self.assertIsNotNone(getattr(self.router.registry, 'jobQueue', None))
+		# errors raised by the job in its worker process are reported as for jobs run in the request thread
+		self.app.get('/differential_expression?dataset=test&sampleGroup=celltype&itemA=B1&itemB=T1', status=400)
+
+	def test_pcaCoordsAccepted(self):
+		import time
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		router = createApp(self.datadir, **{'biopyramid.jobs.min_values':'1', 'biopyramid.jobs.workers':'1', 'biopyramid.jobs.wait':'0'})
+		try:
+			# the job is not finished straight away, so the client is given its id to poll for the result
+			response = TestApp(router).get('/pca_coords?dataset=test&sampleGroup=celltype&sampleGroupItems=B1,T1', status=202)
+			self.assertIn(response.json_body['status'], ('pending', 'running'))
+			for i in range(600):
+				result = TestApp(router).get('/jobs/result?jobId=%s' % response.json_body['jobId']).json_body
+				if result['status'] not in ('pending', 'running'):
+					break
+				time.sleep(0.1)
+			self.assertEqual(result['status'], 'finished')
+			expected = self.inline.get('/pca_coords?dataset=test&sampleGroup=celltype&sampleGroupItems=B1,T1').json_body
+			self.assertEqual(result['result']['sampleIds'], expected['sampleIds'])
+			self.assertEqual(len(result['result']['coords']), 2)
+		finally:
+			router.registry.jobQueue.shutdown()
@@ -0,0 +1,55 @@
+import os, unittest, tempfile, shutil
+
+from biopyramid.views import metrics, mutex
+from biopyramid.models import bpdataset
+
+class MetricsTest(unittest.TestCase):
+	def test_text(self):
+		collector = metrics.Metrics()
+		collector.observe('biopyramid_request_seconds', 0.003, route='/pca')
+		collector.observe('biopyramid_request_seconds', 20, route='/pca')
+		collector.increment('biopyramid_file_read_bytes_total', 100, file='a.h5')
+		lines = collector.text().splitlines()
+		self.assertIn('# TYPE biopyramid_request_seconds histogram', lines)
+		self.assertIn('biopyramid_request_seconds_bucket{route="/pca",le="0.0025"} 0', lines)
+		self.assertIn('biopyramid_request_seconds_bucket{route="/pca",le="0.005"} 1', lines)
+		self.assertIn('biopyramid_request_seconds_bucket{route="/pca",le="+Inf"} 2', lines)
+		self.assertIn('biopyramid_request_seconds_count{route="/pca"} 2', lines)
+		self.assertIn('biopyramid_file_read_bytes_total{file="a.h5"} 100', lines)
+
+class MetricsViewTest(unittest.TestCase):
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createSyntheticDataset, createApp
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createSyntheticDataset(self.datadir, genes=50, samples=10)
+		self.app = TestApp(createApp(self.datadir, **{'biopyramid.metrics.enabled':'true', 'biopyramid.metrics.server_timing':'true'}))
+		metrics.collector.clear()
+
+	def tearDown(self):
+		mutex.manager.timingHooks.remove(metrics.lockTimed)
+		bpdataset.readHooks.remove(metrics.objectRead)
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_metrics(self):
+		response = self.app.get('/expression?dataset=%s&geneId=%s' % (self.ds.name, self.ds.featureIds()[0]))
+		self.assertIn('lockhold;dur=', response.headers['Server-Timing'])
+		self.app.get('/metrics', extra_environ={'REMOTE_ADDR':'10.0.0.1'}, status=403)
+		text = self.app.get('/metrics', extra_environ={'REMOTE_ADDR':'127.0.0.1'}).text
+		self.assertIn('biopyramid_request_seconds_count{route="/expression",status="200"} 1', text)
+		self.assertIn('biopyramid_render_seconds_count{route="/expression"} 1', text)
+		self.assertIn('biopyramid_file_read_objects_total{file="%s"}' % os.path.basename(self.ds.filepath), text)
+
+	def test_failedRequest(self):
+		from pyramid import testing
+		def handler(request):
+			raise RuntimeError("failed")
+		request = testing.DummyRequest()
+		request.matched_route = None
+		tween = metrics.metricsTweenFactory(handler, testing.setUp().registry)
+		try:
+			self.assertRaises(RuntimeError, tween, request)
+		finally:
+			testing.tearDown()
+		self.assertIn('biopyramid_request_seconds_count{route="none",status="500"} 1', metrics.collector.text().splitlines())
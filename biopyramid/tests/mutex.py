@@ -0,0 +1,45 @@
+import unittest, threading
+
+from biopyramid.views import mutex
+
+class ReadWriteLockTest(unittest.TestCase):
+	def test_readers_share_lock(self):
+		manager = mutex.LockManager()
+		entered = threading.Event()
+		def read():
+			with manager.reading('/tmp/a.h5'):
+				entered.set()
+		with manager.reading('/tmp/a.h5'):
+			thread = threading.Thread(target=read)
+			thread.start()
+			self.assertTrue(entered.wait(5))
+		thread.join()
+
+	def test_writer_excludes_readers(self):
+		manager = mutex.LockManager()
+		entered = threading.Event()
+		def read():
+			with manager.reading('/tmp/a.h5'):
+				entered.set()
+		with manager.writing('/tmp/a.h5'):
+			thread = threading.Thread(target=read)
+			thread.start()
+			self.assertFalse(entered.wait(0.2))
+			with manager.reading('/tmp/b.h5'):	# other files are not affected
+				pass
+			with manager.reading('/tmp/a.h5'):	# writer can read its own file
+				pass
+		self.assertTrue(entered.wait(5))
+		thread.join()
+
+	def test_timingHooks(self):
+		manager = mutex.LockManager()
+		timings = []
+		manager.timingHooks.append(lambda *args: timings.append(args))
+		with manager.reading('/tmp/a.h5'):
+			with manager.reading('/tmp/a.h5'):	# nested reads are reported once
+				pass
+		with manager.writing('/tmp/a.h5'):
+			pass
+		self.assertEqual([item[:2] for item in timings], [('/tmp/a.h5', False), ('/tmp/a.h5', True)])
+		self.assertTrue(all(item[2]>=0 and item[3]>=0 for item in timings))
@@ -0,0 +1,26 @@
+import unittest, tempfile, shutil
+
+from biopyramid.models import bpdataset
+from biopyramid.tests.fixtures import createTestDataset
+
+class PCACoordsTest(unittest.TestCase):
+	def setUp(self):
+		from webtest import TestApp
+		from biopyramid.tests.fixtures import createApp
+		self.datadir = tempfile.mkdtemp()
+		createTestDataset(self.datadir)
+		self.app = TestApp(createApp(self.datadir))
+
+	def tearDown(self):
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_pcaCoords(self):
+		result = self.app.get('/pca_coords?dataset=test&sampleGroup=celltype&sampleGroupItems=B1,T1').json_body
+		self.assertEqual(result['sampleIds'], ['s01', 's02', 's03'])
+		self.assertEqual(len(result['coords']), 2)
+		result = self.app.get('/pca_coords?dataset=test&sampleGroup=celltype&sampleGroupItems=X').json_body
+		self.assertEqual(result['sampleIds'], [])
+		self.assertEqual(result['coords'], [[], []])
+		self.app.get('/pca_coords?dataset=test&numberOfGenes=many', status=400)
+		self.app.get('/pca_coords?dataset=test&sampleGroup=notAGroup', status=400)
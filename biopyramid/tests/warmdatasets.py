@@ -0,0 +1,26 @@
+import unittest, tempfile, shutil
+
+from pyramid import testing
+
+from biopyramid.models import bpdataset
+from biopyramid.tests.fixtures import createSyntheticDataset
+
+class WarmDatasetsTest(unittest.TestCase):
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp()
+		self.ds = createSyntheticDataset(self.datadir, genes=50, samples=10)
+		self.config = testing.setUp()
+		self.request = testing.DummyRequest()
+		self.request.registry.settings['biopyramid.model.datadir'] = self.datadir
+
+	def tearDown(self):
+		testing.tearDown()
+		bpdataset.closeStore()
+		shutil.rmtree(self.datadir)
+
+	def test_warmDatasets(self):
+		from biopyramid.views import datasets
+		self.assertEqual(datasets.warmDatasets(self.request), [self.ds.name])
+		ds = datasets.datasetFromName(self.request, self.ds.name)
+		self.assertIsNotNone(ds._sampleGroupMetadata)
+		self.assertIn('/dataframe/pca', ds._storedObjects)
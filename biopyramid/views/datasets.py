@@ -3,8 +3,14 @@ This view runs all the relevant code for the "Datasets" page, which displays a l
 """
 from pyramid.view import view_config
 
-import os, json
-from biopyramid.models import bpdataset
+import os, json, threading, logging
+from biopyramid.models.registry import DatasetRegistry
+from biopyramid.models.catalogue import DatasetCatalogue
+
+log = logging.getLogger(__name__)
+
+# Used to create the objects shared by all requests only once per application
+_sharedLock = threading.Lock()
 
 ###########################################
 # Utility methods - not mapped to URL
@@ -24,22 +30,91 @@ def datasetFiles(request):
 		if filename.endswith(".h5"):
 			filepaths.append(os.path.join(datadir, filename))
 	return filepaths
-	
+
+def listParameter(request, *names):
+	"""
+	Return a list of values from request parameters given by names, where each parameter may be repeated
+	and/or hold a comma separated list, eg: listParameter(request, 'geneId', 'geneIds').
+	"""
+	values = []
+	for name in names:
+		for value in request.params.getall(name):
+			values.extend([item.strip() for item in value.split(',') if item.strip()])
+	return values
+
+def sharedObject(request, key, factory):
+	"""
+	Return an object shared by all requests, which is stored as an attribute of the application registry
+	under key. factory(settings) is called to create the object the first time it is needed.
+	"""
+	obj = getattr(request.registry, key, None)
+	if obj is None:
+		with _sharedLock:
+			obj = getattr(request.registry, key, None)
+			if obj is None:
+				obj = factory(request.registry.settings)
+				setattr(request.registry, key, obj)
+	return obj
+
+def datasetCatalogue(request):
+	"""
+	Return the DatasetCatalogue shared by all requests, which keeps the attributes of all dataset files in memory.
+	'biopyramid.model.catalogue_index' in the config file can specify a file to persist the catalogue to, and
+	'biopyramid.model.catalogue_refresh' the minimum number of seconds between checks for changed files.
+	"""
+	def factory(settings):
+		return DatasetCatalogue(settings['biopyramid.model.datadir'], 
+								indexFile=settings.get('biopyramid.model.catalogue_index') or None,
+								refreshInterval=float(settings.get('biopyramid.model.catalogue_refresh', 2)))
+	return sharedObject(request, 'datasetCatalogue', factory)
+
+def datasetRegistry(request):
+	"""
+	Return the DatasetRegistry shared by all requests, which keeps opened BPDataset instances in memory.
+	The number of datasets kept in memory can be limited by 'biopyramid.model.max_datasets' in the config file.
+	"""
+	def factory(settings):
+		return DatasetRegistry(maxsize=int(settings.get('biopyramid.model.max_datasets', 0)) or None)
+	return sharedObject(request, 'datasetRegistry', factory)
+
 def datasetAttributes(request):
 	"""
 	Return a list of dictionaries, where each dictionary contains the attributes of the dataset.
 	"filepath" key is also added to the final dictionary, so that it can be used to instantiate a BPDataset instance.
 	"""
-	return [bpdataset.datasetAttributes(filepath, includeFilepath=True) for filepath in datasetFiles(request)]
+	return datasetCatalogue(request).attributes()
 
 def datasetFromName(request, name):
 	"""
 	Return BPDataset instance based on name. Returns None if there is no matching dataset with the name.
+	The instance is shared with other requests, so it should be treated as read only.
+	"""
+	filepath = datasetCatalogue(request).filepath(name)
+	if filepath is None:
+		return None
+	return datasetRegistry(request).dataset(name, filepath)
+
+def warmDatasets(request):
+	"""
+	Open every dataset in the catalogue and read the objects used by most pages (sample table, sample group
+	properties, PCA coordinates and feature indices), so that later requests find them in memory. Used before
+	forking worker processes, which then share these objects (see biopyramid.scripts.prefork).
+	Returns the names of the datasets opened. Datasets which can't be read are logged and skipped.
 	"""
-	for attribute in datasetAttributes(request):
-		if attribute['name']==name:
-			return bpdataset.BPDataset(attribute['filepath'])
-	return None
+	names = []
+	for attributes in datasetAttributes(request):
+		try:
+			ds = datasetRegistry(request).dataset(attributes['name'], attributes['filepath'])
+			ds.sampleGroupMetadata()	# reads the sample table and sample group properties
+			ds.pca
+			for key in ds.expression_data_keys:
+				ds.featureIndex(key)
+				ds.expressionMemmap(key)
+		except Exception:
+			log.exception("Could not read dataset file %s", attributes.get('filepath'))
+			continue
+		names.append(attributes['name'])
+	return names
 
 
 ###########################################
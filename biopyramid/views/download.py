@@ -0,0 +1,121 @@
+"""
+This view lets users download expression values of a dataset, for all or some of its genes and samples.
+
+The file is streamed to the browser a chunk of rows at a time as it is read from the dataset file (see
+BPDataset.iterExpressionRows()), so memory use of a download does not depend on the size of the dataset. If the
+dataset file changes during a download, the download is cut short rather than mixing values of both files.
+This needs the row layout of writeExpressionRows(): files without it would have their whole matrix read, so
+downloads from them are refused until the layout is added (eg. with biopyramid_repack).
+"""
+from pyramid.view import view_config
+from pyramid.response import Response
+from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest, HTTPConflict
+from pyramid.settings import asbool
+
+import io, json, zlib, struct
+import numpy
+
+from biopyramid.views import datasets, httpcache
+
+# Content type and file name extension of each format
+formats = {'csv':('text/csv', 'csv'), 'tsv':('text/tab-separated-values', 'tsv'), 'binary':('application/octet-stream', 'bin')}
+
+def selectedSampleIds(request, dataset, expressionKey=None):
+	"""Return the sample ids to download, in the order of the columns of the expression matrix, given by 'sampleId' or
+	'sampleIds' parameters, or by 'sampleGroup' and 'sampleGroupItem' (or 'sampleGroupItems') parameters, eg.
+	sampleGroup=celltype&sampleGroupItems=B1,T1. All samples if none of these are given.
+	"""
+	columns = dataset.expressionColumns(expression_data_key=expressionKey)
+	sampleIds = datasets.listParameter(request, 'sampleId', 'sampleIds')
+	sampleGroup = request.params.get("sampleGroup")
+	if sampleGroup:
+		if sampleGroup not in dataset.samples.columns:
+			raise HTTPBadRequest("No sample group called %s" % sampleGroup)
+		items = set(datasets.listParameter(request, 'sampleGroupItem', 'sampleGroupItems'))
+		sampleIds.extend(dataset.samples.index[dataset.samples[sampleGroup].isin(items)].tolist())
+	elif not sampleIds:
+		return columns
+	selected = set(sampleIds)
+	return [sampleId for sampleId in columns if sampleId in selected]
+
+def _textRows(chunks, sampleIds, separator, log):
+	"""Generator of csv or tsv text, with gene ids as rows and sampleIds as columns, one chunk of rows 
+	(from BPDataset.iterExpressionRows()) at a time.
+	"""
+	yield (separator.join(['geneId'] + sampleIds) + '\n').encode('utf-8')
+	for df in chunks:
+		df = df[sampleIds]
+		if log:
+			df = numpy.log2(df.astype(float) + 1)
+		buffer = io.StringIO()
+		df.to_csv(buffer, sep=separator, header=False)
+		yield buffer.getvalue().encode('utf-8')
+
+def _binaryRows(chunks, geneIds, sampleIds, log):
+	"""Generator of binary data in the format of expression.expressionValues(), one chunk of rows 
+	(from BPDataset.iterExpressionRows()) at a time.
+	The header lists every gene id before any value is sent, so its size grows with the number of genes.
+	"""
+	header = json.dumps({'geneIds':geneIds, 'sampleIds':sampleIds, 'shape':[len(geneIds), len(sampleIds)], 'dtype':'float32'}).encode('utf-8')
+	header += b' ' * (-len(header) % 4)	# so that the values start at a multiple of 4 bytes
+	yield struct.pack('<I', len(header)) + header
+	for df in chunks:
+		values = df[sampleIds].values.astype(numpy.float32)
+		if log:
+			values = numpy.log2(values + 1)
+		yield values.astype('<f4').tobytes()
+
+def _gzipped(chunks, level=6):
+	"""Generator of chunks compressed in gzip format.
+	"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if data:
+			yield data
+	yield compressor.flush()
+
+@view_config(route_name='/download', decorator=httpcache.cached)
+def download(request):
+	"""Return expression values of a dataset as a file to download. Parameters:
+		dataset: name of the dataset
+		geneIds: comma separated list of gene ids (and/or geneId parameter repeated), all genes if not given.
+			Use POST for long lists.
+		sampleIds, sampleGroup, sampleGroupItems: samples to include, see selectedSampleIds(). All samples by default.
+		expressionKey: expression data key of the matrix to use, first one of the dataset by default
+		format: 'csv' (default), 'tsv' or 'binary' (see expression.expressionValues() for this format). The json header
+			of the binary format holds all the gene ids, so it is built in memory first and is O(genes) in size.
+		gzip: if true, the file is compressed with gzip
+		log: if true, values are log2(x+1) of the stored values
+	Genes not found in the dataset are left out. Returns 409 if the dataset file has no row layout (see module docstring).
+	"""
+	dataset = datasets.datasetFromName(request, request.params.get("dataset"))
+	if dataset is None:
+		raise HTTPNotFound("No dataset named %s" % request.params.get("dataset"))
+	fileFormat = request.params.get("format", "csv")
+	if fileFormat not in formats:
+		raise HTTPBadRequest("format should be one of %s" % ', '.join(sorted(formats)))
+
+	expressionKey = dataset._expressionKey(request.params.get("expressionKey"))
+	if dataset.featureIndex(expressionKey) is None:
+		raise HTTPConflict("Dataset %s can't be downloaded until its file has the row layout (see biopyramid_repack)" % dataset.name)
+	geneIds = datasets.listParameter(request, 'geneId', 'geneIds')
+	geneIds = dataset.matchingFeatureIds(geneIds or dataset.featureIds(expressionKey), expression_data_key=expressionKey)
+	sampleIds = selectedSampleIds(request, dataset, expressionKey)
+	log = asbool(request.params.get("log", False))
+
+	rows = dataset.iterExpressionRows(geneIds, expression_data_key=expressionKey)
+	if fileFormat=='binary':
+		chunks = _binaryRows(rows, geneIds, sampleIds, log)
+	else:
+		chunks = _textRows(rows, sampleIds, '\t' if fileFormat=='tsv' else ',', log)
+	contentType, extension = formats[fileFormat]
+	filename = '%s.%s.%s' % (dataset.name, expressionKey, extension)
+	if asbool(request.params.get("gzip", False)):
+		chunks, contentType, filename = _gzipped(chunks), 'application/gzip', filename + '.gz'
+
+	response = Response(app_iter=chunks, content_type=contentType)
+	if contentType.startswith('text/'):
+		response.charset = 'utf-8'
+	response.content_disposition = 'attachment; filename="%s"' % filename
+	return response
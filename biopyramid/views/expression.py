@@ -2,14 +2,20 @@
 This view runs all the relevant code for the "Expression" page, which plots the expression profile of a gene.
 """
 from pyramid.view import view_config
+from pyramid.response import Response
+from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest
+from pyramid.settings import asbool
 
 from genedataset import geneset
-from biopyramid.views import datasets
-import numpy
+from biopyramid.views import datasets, httpcache, jobs
+import numpy, json, struct
 
-@view_config(route_name='/expression', renderer='biopyramid:templates/expression.mako')
+@view_config(route_name='/expression', renderer='biopyramid:templates/expression.mako', decorator=httpcache.cached)
 def showPage(request):
-	"""Show the page when the URL is called.
+	"""Show the page when the URL is called. With summary=true, or by default for datasets with more samples than
+	biopyramid.expression.summary_min_samples in the config file, the page gets summary statistics of each sample
+	group item (see BPDataset.groupSummaries()) instead of the value of every sample, so its size depends on the 
+	number of sample group items only.
 	"""
 	# Supply names of all datasets available for user to chooose from
 	datasetNames = [item['name'] for item in datasets.datasetAttributes(request)]
@@ -20,20 +26,26 @@ def showPage(request):
 		selectedDatasetName = datasetNames[0]
 	dataset = datasets.datasetFromName(request, selectedDatasetName)
 
-	# Fetch other required properties of the dataset
-	sampleIds = dataset.sampleIds()
-	sampleGroups = dataset.sampleGroups(returnType="display")
-	sampleGroupItems = dict([(item, dataset.sampleGroupItems(sampleGroup=item)) for item in sampleGroups])
-	sampleGroupColours = dict([(item, dataset.sampleGroupColours(sampleGroup=item)) for item in sampleGroups])	
-	sampleIdsAsGroupItems = dict([(group, dataset.sampleGroupItems(sampleGroup=group, duplicates=True)) for group in sampleGroups])
+	# Fetch other required properties of the dataset. These are computed once per dataset and kept in memory.
+	metadata = dataset.sampleGroupMetadata()
+	sampleIds = metadata['sampleIds']
+	sampleGroups = metadata['sampleGroups']
+	sampleGroupItems = metadata['sampleGroupItems']
+	sampleGroupColours = metadata['sampleGroupColours']
+	sampleIdsAsGroupItems = metadata['sampleIdsAsGroupItems']
 
-	# Fetch expression values of selected gene
 	geneId = request.params.get("geneId")
-	df = dataset.expressionMatrix(featureIds=[geneId])
-	if len(df)==1:	# found a unique match for the gene
-		expressionValues = numpy.log2(df[sampleIds]+1).to_dict(orient="split")['data'][0]
-	else:	# either no match or multiple matches
-		expressionValues = []
+	minSamples = int(request.registry.settings.get('biopyramid.expression.summary_min_samples', 0))
+	summary = asbool(request.params["summary"]) if "summary" in request.params else 0<minSamples<len(sampleIds)
+	expressionValues, expressionSummaries = [], {}
+	if summary:	# values of each sample are not read at all
+		if uniqueFeature(dataset, geneId):
+			expressionSummaries = groupSummaries(dataset, geneId, sampleGroups)
+		sampleIds, sampleIdsAsGroupItems = [], {}
+	else:	# fetch expression values of selected gene
+		df = dataset.expressionMatrix(featureIds=[geneId])
+		if len(df)==1:	# found a unique match for the gene
+			expressionValues = numpy.log2(df[sampleIds]+1).to_dict(orient="split")['data'][0]
 
 	return {'datasetNames':datasetNames, 
 			'selectedDatasetName':selectedDatasetName, 
@@ -43,4 +55,165 @@ def showPage(request):
 			'sampleGroups':sampleGroups, 
 			'sampleGroupItems':sampleGroupItems, 
 			'sampleGroupColours':sampleGroupColours, 
-			'sampleIdsAsGroupItems':sampleIdsAsGroupItems}
+			'sampleIdsAsGroupItems':sampleIdsAsGroupItems,
+			'expressionSummaries':expressionSummaries}
+
+def uniqueFeature(dataset, geneId):
+	"""Return True if geneId matches exactly one row of the expression matrix of dataset, found without reading
+	any expression values when the dataset file has a feature index.
+	"""
+	index = dataset.featureIndex()
+	index = index.index if index is not None else dataset.expressions[dataset._expressionKey()].index
+	try:
+		return isinstance(index.get_loc(geneId), int)
+	except (KeyError, TypeError):
+		return False
+
+def groupSummaries(dataset, geneId, sampleGroups):
+	"""Return summary statistics of the expression of geneId for each of sampleGroups, eg: {'celltype':{'mean':[4.1,...],
+	'min':[...], 'q1':[...], 'median':[...], 'q3':[...], 'max':[...]}, ...}, with one value per sample group item in the 
+	order of dataset.sampleGroupItems(sampleGroup), or None for items without values.
+	"""
+	result = {}
+	for sampleGroup in sampleGroups:
+		df = dataset.groupSummaries([geneId], sampleGroup).get(geneId)
+		if df is not None:
+			result[sampleGroup] = dict([(stat, [round(float(value), 4) if numpy.isfinite(value) else None for value in df[stat]]) \
+										for stat in df.columns])
+	return result
+
+def requestedGeneIds(request):
+	"""Return a list of gene ids from request parameters, which may be given as a comma separated
+	'geneIds' parameter, as repeated 'geneId' parameters, or both.
+	"""
+	return datasets.listParameter(request, 'geneId', 'geneIds')
+
+def _jsonRows(chunks, sampleIds):
+	"""Generator of the json response body for expressionValues(), one chunk of rows (from 
+	BPDataset.iterExpressionRows()) at a time. Missing (NaN) and infinite values become null, as json has no value for them.
+	"""
+	yield ('{"sampleIds": %s, "rows": [' % json.dumps(sampleIds)).encode('utf-8')
+	separator = ''
+	for df in chunks:
+		values = numpy.log2(df.values.astype(numpy.float32) + 1)
+		finite = numpy.isfinite(values)
+		rows = [values[i].tolist() if finite[i].all() else numpy.where(finite[i], values[i], None).tolist() for i in range(len(values))]
+		yield ''.join(['%s[%s, %s]' % (separator if i==0 else ', ', json.dumps(geneId), json.dumps(rows[i])) \
+					   for i,geneId in enumerate(df.index)]).encode('utf-8')
+		separator = ', '
+	yield b']}'
+
+def _binaryRows(chunks, geneIds, sampleIds):
+	"""Generator of the binary response body for expressionValues(), one chunk of rows (from 
+	BPDataset.iterExpressionRows()) at a time.
+	"""
+	header = json.dumps({'geneIds':geneIds, 'sampleIds':sampleIds, 'shape':[len(geneIds), len(sampleIds)], 'dtype':'float32'}).encode('utf-8')
+	header += b' ' * (-len(header) % 4)	# so that the values start at a multiple of 4 bytes
+	yield struct.pack('<I', len(header)) + header
+	for df in chunks:
+		yield numpy.log2(df.values.astype(numpy.float32) + 1).astype('<f4').tobytes()
+
+@view_config(route_name='/expression_values', decorator=httpcache.cached)
+def expressionValues(request):
+	"""Return log2(x+1) expression values of many genes from a dataset in one response. Parameters:
+		dataset: name of the dataset
+		geneIds: comma separated list of gene ids (and/or geneId parameter repeated). Use POST for long lists.
+		expressionKey: expression data key of the matrix to use, first one of the dataset by default
+		format: 'json' (default) or 'binary'
+	The response is streamed a chunk of rows at a time, so memory stays bounded for thousands of genes. If the dataset
+	file changes while the response is streamed, the response is cut short rather than mixing values of both files.
+
+	json format looks like {"sampleIds":["s1","s2",...], "rows":[["ENSG00000183625",[4.18,0.0,...]], ...]},
+	with genes not found in the dataset left out.
+
+	binary format is a 4 byte little-endian unsigned integer giving the length of a json header, the header
+	{"geneIds":[...], "sampleIds":[...], "shape":[rows, columns], "dtype":"float32"}, then the values as
+	little-endian float32 in row order. In javascript:
+		var length = new DataView(buffer).getUint32(0, true);
+		var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, length)));
+		var values = new Float32Array(buffer, 4 + length, header.shape[0] * header.shape[1]);
+	"""
+	dataset = datasets.datasetFromName(request, request.params.get("dataset"))
+	if dataset is None:
+		raise HTTPNotFound("No dataset named %s" % request.params.get("dataset"))
+
+	expressionKey = request.params.get("expressionKey")
+	geneIds = dataset.matchingFeatureIds(requestedGeneIds(request), expression_data_key=expressionKey)
+	sampleIds = dataset.expressionColumns(expression_data_key=expressionKey)
+
+	chunks = dataset.iterExpressionRows(geneIds, expression_data_key=expressionKey)
+
+	if request.params.get("format")=="binary":
+		return Response(app_iter=_binaryRows(chunks, geneIds, sampleIds), content_type='application/octet-stream')
+	return Response(app_iter=_jsonRows(chunks, sampleIds), content_type='application/json', charset='utf-8')
+
+@view_config(route_name='/coexpression', renderer='json', decorator=httpcache.cached)
+def coexpression(request):
+	"""Return genes whose expression correlates best with a gene across all samples of a dataset. Parameters:
+		dataset: name of the dataset
+		geneId: gene id to find correlated genes for
+		expressionKey: expression data key of the matrix to use, first one of the dataset by default
+		method: 'pearson' (default, of log2(x+1) values) or 'spearman'
+		top: number of genes to return (default 20, at most 1000)
+		negative: if true, return the most negatively correlated genes instead
+	Returns {"geneId":"ENSG00000183625", "method":"pearson", "genes":[{"geneId":..., "correlation":0.95}, ...]},
+	with genes sorted by correlation. genes is empty if geneId is not found in the dataset.
+	Large datasets are handled by the job queue, see jobs.runJob().
+	"""
+	dataset = datasets.datasetFromName(request, request.params.get("dataset"))
+	if dataset is None:
+		raise HTTPNotFound("No dataset named %s" % request.params.get("dataset"))
+
+	geneId = request.params.get("geneId")
+	method = request.params.get("method", "pearson")
+	if method not in ('pearson', 'spearman'):
+		raise HTTPBadRequest("method should be pearson or spearman")
+	try:
+		top = min(max(int(request.params.get("top", 20)), 0), 1000)
+	except ValueError:
+		raise HTTPBadRequest("top should be an integer")
+
+	genes = jobs.runJob(request, dataset, 'coexpression', {'geneId':geneId, 'expressionKey':request.params.get("expressionKey"),
+														   'method':method, 'top':top, 
+														   'negative':asbool(request.params.get("negative", False))})
+	return {'geneId':geneId, 
+			'method':method, 
+			'genes':genes}
+
+@view_config(route_name='/differential_expression', renderer='json', decorator=httpcache.cached)
+def differentialExpression(request):
+	"""Return the genes most differentially expressed between two items of a sample group, see 
+	BPDataset.differentialExpression(). Parameters:
+		dataset: name of the dataset
+		sampleGroup: sample group of the items, eg. 'celltype'
+		itemA, itemB: items of sampleGroup to compare, eg. 'B1' and 'T1'
+		expressionKey: expression data key of the matrix to use, first one of the dataset by default
+		direction: 'up' (default, genes higher in itemA), 'down' (genes higher in itemB) or 'both'
+		top: number of genes to return (default 50, at most 1000)
+	Genes are ranked by moderated t statistic, computed by the job queue for large datasets (see jobs.runJob()). Returns {"sampleGroup":"celltype", "itemA":"B1", "itemB":"T1",
+	"genes":[{"geneId":..., "logFC":2.1, "meanA":..., "meanB":..., "t":..., "moderatedT":..., "pValue":..., "adjPValue":...}, ...]}
+	"""
+	dataset = datasets.datasetFromName(request, request.params.get("dataset"))
+	if dataset is None:
+		raise HTTPNotFound("No dataset named %s" % request.params.get("dataset"))
+
+	sampleGroup, itemA, itemB = [request.params.get(name) for name in ("sampleGroup", "itemA", "itemB")]
+	direction = request.params.get("direction", "up")
+	if direction not in ('up', 'down', 'both'):
+		raise HTTPBadRequest("direction should be up, down or both")
+	try:
+		top = min(max(int(request.params.get("top", 50)), 0), 1000)
+	except ValueError:
+		raise HTTPBadRequest("top should be an integer")
+
+	try:
+		genes = jobs.runJob(request, dataset, 'differentialExpression', {'sampleGroup':sampleGroup, 'itemA':itemA, 'itemB':itemB,
+																		 'expressionKey':request.params.get("expressionKey"),
+																		 'direction':direction, 'top':top})
+	except ValueError as e:
+		raise HTTPBadRequest(str(e))
+
+	return {'sampleGroup':sampleGroup,
+			'itemA':itemA,
+			'itemB':itemB,
+			'genes':genes}
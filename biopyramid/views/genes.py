@@ -4,18 +4,24 @@ genes after a search has been done.
 """
 from pyramid.view import view_config
 
-from genedataset import geneset
+from biopyramid.models.geneindex import GeneIndex
+from biopyramid.views import datasets
+
+def geneIndex(request):
+	"""Return the GeneIndex shared by all requests, which is built the first time it is needed
+	(or when the application starts, see biopyramid.genes.preload_index in the config file).
+	"""
+	return datasets.sharedObject(request, 'geneIndex', lambda settings: GeneIndex())
 
 @view_config(route_name='/genes', renderer='biopyramid:templates/genes.mako')
 def showPage(request):
 	"""Show the page when the URL is called.
 	"""
-	if 'geneset' in request.session:	# restore previous list of genes
-		gs = request.session['geneset']
-		genes = []
-		for item in gs.dataframe().reset_index().to_dict(orient="records"):  # won't return TranscriptLengths
-			genes.append(dict([(key,val) for key,val in item.items() if key!="TranscriptLengths"]))
-		name = gs.name
+	request.session.pop('geneset', None)	# Geneset instance stored by older versions - too big for the session
+	search = request.session.get('geneSearch')
+	if search:	# restore previous list of genes
+		genes = geneIndex(request).records(search['geneIds'])
+		name = search['searchTerm']
 	else:
 		genes = []
 		name = None
@@ -23,11 +29,27 @@ def showPage(request):
 
 @view_config(route_name='/gene_search', renderer='json')
 def geneSearch(request):
-	"""Return a list of gene attributes given a search string.
+	"""Return a list of gene attributes given a search string. Genes whose symbol, Ensembl id, Entrez id or
+	synonym matches or starts with the search string are returned, using the shared GeneIndex, or if there are
+	none, genes with the search string in any of these or in their description. At most geneindex.searchLimit 
+	genes are returned.
+	Only the search string and matching gene ids are kept in the session, for the Genes page to show them again.
 	"""
 	searchString = 	request.params.get('searchTerm')
-	gs = geneset.Geneset().subset([searchString])
-	if gs.size()>0:
-		gs.name = searchString
-		request.session['geneset'] = gs
-	return gs.to_json()
+	index = geneIndex(request)
+	geneIds = index.search(searchString)
+	if geneIds:
+		request.session['geneSearch'] = {'searchTerm':searchString, 'geneIds':geneIds}
+	return index.dataframe(geneIds).to_json(orient="records")
+
+@view_config(route_name='/gene_autocomplete', renderer='json')
+def geneAutocomplete(request):
+	"""Return top matches for a partially typed search string, eg: /gene_autocomplete?searchTerm=ccr&limit=10
+	returns [{'geneId':'ENSMUSG00000032184', 'geneSymbol':'Ccr1', 'species':'MusMusculus'}, ...].
+	Optional species parameter restricts matches to 'MusMusculus' or 'HomoSapiens'.
+	"""
+	try:
+		limit = min(max(int(request.params.get('limit', 10)), 1), 100)
+	except ValueError:
+		limit = 10
+	return geneIndex(request).matches(request.params.get('searchTerm'), limit=limit, species=request.params.get('species') or None)
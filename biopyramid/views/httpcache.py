@@ -0,0 +1,149 @@
+"""
+HTTP caching of responses which depend only on a dataset file and the request parameters, such as the PCA and
+Expression pages and their json routes.
+
+Responses get an ETag made from the route, request parameters, the names of all datasets (listed by the pages) and
+the modification time, size and version of the dataset file, and a Last-Modified header from the latest modification
+time of the dataset file and of the catalogue of datasets (see DatasetCatalogue.lastModified()). A request whose If-None-Match
+(or If-Modified-Since) header shows that the browser already has the current response gets a 304 without
+the view being called. Rendered responses can also be kept in a size bounded in-process cache, so that other
+clients asking for the same thing get it without the view being called either.
+
+Apply it to a view with the decorator argument of view_config:
+
+	@view_config(route_name='/pca', renderer='biopyramid:templates/pca.mako', decorator=httpcache.cached)
+	def showPage(request):
+		...
+
+Settings in the config file:
+	biopyramid.cache.max_bytes: size of the in-process cache of rendered responses in bytes, 0 to disable it.
+	biopyramid.cache.max_age: number of seconds browsers may use a response without checking it again (default 0).
+	biopyramid.cache.version: part of every ETag - change it to invalidate cached responses after an upgrade.
+"""
+import hashlib, json, threading, collections, datetime
+
+from pyramid.httpexceptions import HTTPNotModified
+
+from biopyramid.models.registry import fileSignature
+from biopyramid.views import datasets
+
+class ResponseCache(object):
+	"""
+	Least recently used cache of response bodies keyed on ETag, holding at most maxBytes bytes of bodies.
+	This object is thread safe and is meant to be shared by all requests within a process.
+	"""
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self._entries = collections.OrderedDict()	# {etag: (body, content_type, charset)}
+		self._size = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, etag):
+		"""Return (body, content_type, charset) for etag, or None if it is not in the cache.
+		"""
+		with self._lock:
+			entry = self._entries.get(etag)
+			if entry is not None:
+				self._entries.move_to_end(etag)
+			return entry
+
+	def put(self, etag, body, content_type, charset):
+		"""Keep body for etag, removing the least recently used bodies if the cache is full.
+		Bodies bigger than a quarter of maxBytes are not kept.
+		"""
+		if len(body)>self.maxBytes / 4:
+			return
+		with self._lock:
+			if etag in self._entries:
+				return
+			self._entries[etag] = (body, content_type, charset)
+			self._size += len(body)
+			while self._size>self.maxBytes:
+				oldest = self._entries.popitem(last=False)[1]
+				self._size -= len(oldest[0])
+
+def responseCache(request):
+	"""Return the ResponseCache shared by all requests, or None if it is disabled in the config file.
+	"""
+	def factory(settings):
+		return ResponseCache(int(settings.get('biopyramid.cache.max_bytes', 0)))
+	cache = datasets.sharedObject(request, 'responseCache', factory)
+	return cache if cache.maxBytes>0 else None
+
+def selectedDatasetName(request, names):
+	"""Return the name of the dataset a request is for, which is the 'dataset' parameter if it is one of names,
+	otherwise the first of names, as used by the pages which show a dataset.
+	"""
+	name = request.params.get("dataset")
+	return name if name in names or not names else names[0]
+
+def validators(request):
+	"""Return (etag, last modified time as datetime or None) of the response for request. See module docstring.
+	"""
+	attributes = datasets.datasetAttributes(request)
+	names = [item['name'] for item in attributes]
+	name = selectedDatasetName(request, names)
+	selected = [item for item in attributes if item['name']==name]
+	signature = fileSignature(selected[0]['filepath']) if selected else None
+
+	key = [request.matched_route.name if request.matched_route else request.path,
+		   sorted(request.GET.items()),
+		   name, selected[0].get('version') if selected else None, signature, names,
+		   request.registry.settings.get('biopyramid.cache.version', '')]
+	etag = hashlib.sha1(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+	# the catalogue is refreshed every few seconds, so the dataset file may be more recent
+	modified = max(datasets.datasetCatalogue(request).lastModified(), signature[0] if signature else 0)
+	lastModified = datetime.datetime.fromtimestamp(int(modified), datetime.timezone.utc) if modified else None
+	return etag, lastModified
+
+def notModified(request, etag, lastModified):
+	"""Return True if the browser already has the response given by etag and lastModified.
+	"""
+	if request.if_none_match:
+		return etag in request.if_none_match
+	if request.if_modified_since and lastModified:
+		return lastModified<=request.if_modified_since
+	return False
+
+def cached(view):
+	"""View decorator which adds ETag and Last-Modified headers to responses, answers conditional requests with 304
+	and serves repeated requests from the ResponseCache. Only GET and HEAD requests are cached.
+	"""
+	def wrapper(context, request):
+		if request.method not in ('GET', 'HEAD'):
+			return view(context, request)
+
+		etag, lastModified = validators(request)
+		maxAge = int(request.registry.settings.get('biopyramid.cache.max_age', 0))
+		def addHeaders(response):
+			response.etag = etag
+			if lastModified:
+				response.last_modified = lastModified
+			response.cache_control.max_age = maxAge
+			return response
+
+		if notModified(request, etag, lastModified):
+			return addHeaders(HTTPNotModified())
+
+		cache = responseCache(request)
+		entry = cache.get(etag) if cache is not None else None
+		if entry is not None:
+			body, contentType, charset = entry
+			response = request.response
+			response.body = body
+			response.content_type = contentType
+			if charset:
+				response.charset = charset
+			return addHeaders(response)
+
+		response = view(context, request)
+		if response.status_int==200:
+			addHeaders(response)
+			# streamed responses (eg. /expression_values) are not kept, as that would read the whole stream into memory
+			if cache is not None and isinstance(response.app_iter, (list, tuple)):
+				cache.put(etag, response.body, response.content_type, response.charset)
+		return response
+	return wrapper
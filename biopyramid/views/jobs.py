@@ -0,0 +1,92 @@
+"""
+This view provides json routes to run expensive computations in the background (see biopyramid.models.jobs):
+submit a job, poll its status, then fetch its result. Other views hand their expensive computations to the
+same queue through runJob().
+"""
+from pyramid.view import view_config
+from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest, HTTPAccepted
+
+import concurrent.futures
+
+from biopyramid.models import jobs
+from biopyramid.models.jobs import JobQueue, JobNotFound, jobFunctions
+from biopyramid.views import datasets
+
+def jobQueue(request):
+	"""
+	Return the JobQueue shared by all requests. The number of worker processes is set by 'biopyramid.jobs.workers'
+	in the config file.
+	"""
+	def factory(settings):
+		return JobQueue(workers=int(settings.get('biopyramid.jobs.workers', 2)))
+	return datasets.sharedObject(request, 'jobQueue', factory)
+
+def runJob(request, dataset, name, params):
+	"""
+	Return the result of job called name with params (dict) for dataset. For datasets with at least
+	'biopyramid.jobs.min_values' expression values (genes x samples) the job runs in the job queue, so that it
+	uses a core of its own rather than holding the GIL of the web server's process, and the request waits up to
+	'biopyramid.jobs.wait' seconds for it. If it takes longer, HTTPAccepted is raised with the job's status, so
+	that the client can fetch the result from /jobs/result. Smaller datasets are computed in the request thread.
+	"""
+	settings = request.registry.settings
+	key = params.get('expressionKey')
+	if len(dataset.featureIds(key)) * len(dataset.expressionColumns(key))<int(settings.get('biopyramid.jobs.min_values', 10000000)):
+		return jobs.runJob(name, dataset, params)
+
+	queue = jobQueue(request)
+	jobId = queue.submit(name, dataset.filepath, params)
+	try:
+		return queue.result(jobId, timeout=float(settings.get('biopyramid.jobs.wait', 30)))
+	except concurrent.futures.TimeoutError:
+		raise HTTPAccepted(json_body=queue.status(jobId))
+
+def jobStatus(request):
+	"""Return status dictionary of the job given by jobId parameter, raising HTTPNotFound if there is no such job.
+	"""
+	try:
+		return jobQueue(request).status(request.params.get("jobId"))
+	except JobNotFound:
+		raise HTTPNotFound("No job with id %s" % request.params.get("jobId"))
+
+@view_config(route_name='/jobs/submit', renderer='json')
+def submit(request):
+	"""Submit a job and return its status (including 'jobId'). Parameters can be sent as a json body
+	{"name":"pca", "dataset":"haemopedia", "params":{"sampleIds":[...]}}, or as request parameters, in which case
+	any parameter other than name and dataset is passed on to the job as a string, eg: 
+	/jobs/submit?name=pca&dataset=haemopedia&sampleIds=sample1,sample2,sample3
+	"""
+	try:
+		body = request.json_body if request.body else {}
+	except ValueError:
+		body = {}
+	if body:
+		name, datasetName, params = body.get('name'), body.get('dataset'), body.get('params', {})
+	else:
+		name, datasetName = request.params.get('name'), request.params.get('dataset')
+		params = dict([(key, value) for key, value in request.params.items() if key not in ('name', 'dataset')])
+
+	if name not in jobFunctions:
+		raise HTTPBadRequest("No job called %s" % name)
+	if not isinstance(params, dict):
+		raise HTTPBadRequest("params should be a json object")
+	filepath = datasets.datasetCatalogue(request).filepath(datasetName)
+	if filepath is None:
+		raise HTTPNotFound("No dataset named %s" % datasetName)
+
+	jobId = jobQueue(request).submit(name, filepath, params)
+	return jobQueue(request).status(jobId)
+
+@view_config(route_name='/jobs/status', renderer='json')
+def status(request):
+	"""Return status of the job given by jobId parameter. status key is 'pending', 'running', 'finished' or 'failed'.
+	"""
+	return jobStatus(request)
+
+@view_config(route_name='/jobs/result', renderer='json')
+def result(request):
+	"""Return {'status':..., 'result':...} for the job given by jobId parameter, where result is None unless status is 'finished'.
+	"""
+	details = jobStatus(request)
+	details['result'] = jobQueue(request).result(details['jobId']) if details['status']=='finished' else None
+	return details
@@ -0,0 +1,229 @@
+"""
+Timing of requests and of the work done for them, so we can see where the time of a slow page goes:
+waiting for and holding dataset file locks (see biopyramid.views.mutex), reading objects from dataset files
+(see biopyramid.models.bpdataset) and rendering templates.
+
+A tween records these for each request and adds them to histograms labelled by route, which are served in the
+Prometheus text format at /metrics. Request times are also labelled by status code, with requests which fail
+with an exception counted as 500. Totals of bytes read from, and lock times of, each dataset file are also kept.
+Each process keeps its own metrics, so when several processes serve the application each one has to be scraped.
+
+Enable it in the config file:
+	biopyramid.metrics.enabled: true to collect metrics and serve /metrics.
+	biopyramid.metrics.server_timing: true to also add a Server-Timing header to each response, which browser
+		developer tools show against the request.
+	biopyramid.metrics.allowed_hosts: space separated client addresses allowed to read /metrics (default 127.0.0.1 ::1).
+"""
+import os, time, bisect, threading
+
+from pyramid.events import BeforeRender
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
+
+from biopyramid.views import mutex
+from biopyramid.models import bpdataset
+
+# Upper bounds of histogram buckets
+secondsBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+bytesBuckets = tuple(1024 * 4**i for i in range(11))	# 1KB to 1GB
+objectsBuckets = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Histogram(object):
+	"""Counts of observed values in buckets given by their upper bounds, with the sum and count of all values.
+	"""
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)	# last one counts values above the largest bound
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class Metrics(object):
+	"""
+	Histograms and counters keyed on metric name and labels. This object is thread safe and is meant
+	to be shared by all requests within a process.
+	"""
+	# name: (type, help text, histogram buckets)
+	definitions = {
+		'biopyramid_request_seconds': ('histogram', "Time taken to handle a request, by route and status code.", secondsBuckets),
+		'biopyramid_lock_wait_seconds': ('histogram', "Time a request waited for dataset file locks.", secondsBuckets),
+		'biopyramid_lock_hold_seconds': ('histogram', "Time a request held dataset file locks.", secondsBuckets),
+		'biopyramid_render_seconds': ('histogram', "Time a request spent rendering its template.", secondsBuckets),
+		'biopyramid_hdf5_read_bytes': ('histogram', "Bytes a request read from dataset files.", bytesBuckets),
+		'biopyramid_hdf5_read_objects': ('histogram', "Objects a request read from dataset files.", objectsBuckets),
+		'biopyramid_file_lock_wait_seconds_total': ('counter', "Time spent waiting for the lock of a dataset file.", None),
+		'biopyramid_file_lock_hold_seconds_total': ('counter', "Time the lock of a dataset file was held.", None),
+		'biopyramid_file_read_bytes_total': ('counter', "Bytes read from a dataset file.", None),
+		'biopyramid_file_read_objects_total': ('counter', "Objects read from a dataset file.", None),
+	}
+
+	def __init__(self):
+		self._values = {}	# {(name, labels as tuple of (label, value) pairs): Histogram or number}
+		self._lock = threading.Lock()
+
+	def observe(self, name, value, **labels):
+		"""Add value to histogram called name.
+		"""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			if key not in self._values:
+				self._values[key] = Histogram(self.definitions[name][2])
+			self._values[key].observe(value)
+
+	def increment(self, name, value=1, **labels):
+		"""Add value to counter called name.
+		"""
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + value
+
+	def clear(self):
+		with self._lock:
+			self._values.clear()
+
+	def text(self):
+		"""Return all metrics in the Prometheus text exposition format.
+		"""
+		with self._lock:
+			values = dict([(key, (value.buckets, list(value.counts), value.sum, value.count) if isinstance(value, Histogram) else value) \
+						   for key, value in self._values.items()])
+
+		lines = []
+		for name in sorted(self.definitions):
+			keys = sorted([key for key in values if key[0]==name])
+			if not keys:
+				continue
+			metricType, helpText = self.definitions[name][:2]
+			lines.extend(["# HELP %s %s" % (name, helpText), "# TYPE %s %s" % (name, metricType)])
+			for key in keys:
+				labels = list(key[1])
+				if metricType=='counter':
+					lines.append("%s%s %s" % (name, _labelText(labels), _number(values[key])))
+					continue
+				buckets, counts, total, count = values[key]
+				cumulative = 0
+				for bound, bucketCount in zip(list(buckets) + ['+Inf'], counts):
+					cumulative += bucketCount
+					lines.append("%s_bucket%s %s" % (name, _labelText(labels + [('le', _number(bound))]), cumulative))
+				lines.append("%s_sum%s %s" % (name, _labelText(labels), _number(total)))
+				lines.append("%s_count%s %s" % (name, _labelText(labels), count))
+		return "\n".join(lines) + "\n"
+
+def _labelText(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join(['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) \
+							  for label, value in labels])
+
+def _number(value):
+	return value if isinstance(value, str) else repr(float(value)) if isinstance(value, float) else str(value)
+
+collector = Metrics()
+
+# --------------------------------------------------
+# Timings of the current request
+# --------------------------------------------------
+_local = threading.local()
+
+def currentTimings():
+	"""Return dictionary of timings of the request being handled by the current thread, or None outside requests.
+	"""
+	return getattr(_local, 'timings', None)
+
+def lockTimed(filepath, exclusive, waited, held):
+	"""Called by mutex.manager whenever a dataset file lock is released, see LockManager.timingHooks.
+	"""
+	labels = {'file':os.path.basename(filepath), 'mode':'write' if exclusive else 'read'}
+	collector.increment('biopyramid_file_lock_wait_seconds_total', waited, **labels)
+	collector.increment('biopyramid_file_lock_hold_seconds_total', held, **labels)
+	timings = currentTimings()
+	if timings is not None:
+		timings['lockWait'] += waited
+		timings['lockHold'] += held
+
+def objectRead(filepath, obj):
+	"""Called whenever an object is read from a dataset file, see bpdataset.readHooks.
+	"""
+	nbytes = bpdataset.objectBytes(obj)
+	filename = os.path.basename(filepath)
+	collector.increment('biopyramid_file_read_bytes_total', nbytes, file=filename)
+	collector.increment('biopyramid_file_read_objects_total', 1, file=filename)
+	timings = currentTimings()
+	if timings is not None:
+		timings['readBytes'] += nbytes
+		timings['readObjects'] += 1
+
+def beforeRender(event):
+	"""Subscriber to BeforeRender, which marks the start of template rendering for the current request.
+	"""
+	timings = currentTimings()
+	if timings is not None:
+		timings['renderStart'] = time.perf_counter()
+
+def serverTiming(timings):
+	"""Return the value of the Server-Timing header for timings of a request.
+	"""
+	return 'total;dur=%.1f, lockwait;dur=%.1f, lockhold;dur=%.1f, render;dur=%.1f, hdf5;desc="%s objects, %s bytes"' % \
+		(timings['total'] * 1000, timings['lockWait'] * 1000, timings['lockHold'] * 1000, timings['render'] * 1000,
+		 timings['readObjects'], timings['readBytes'])
+
+def recordTimings(request, timings, start, status):
+	"""Add timings of request, which started at start (time.perf_counter()) and ended with status, to the histograms.
+	"""
+	end = time.perf_counter()
+	timings['total'] = end - start
+	timings['render'] = end - timings['renderStart'] if timings['renderStart'] is not None else 0
+
+	route = request.matched_route.name if request.matched_route else 'none'
+	collector.observe('biopyramid_request_seconds', timings['total'], route=route, status=status)
+	collector.observe('biopyramid_lock_wait_seconds', timings['lockWait'], route=route)
+	collector.observe('biopyramid_lock_hold_seconds', timings['lockHold'], route=route)
+	collector.observe('biopyramid_render_seconds', timings['render'], route=route)
+	collector.observe('biopyramid_hdf5_read_bytes', timings['readBytes'], route=route)
+	collector.observe('biopyramid_hdf5_read_objects', timings['readObjects'], route=route)
+
+def metricsTweenFactory(handler, registry):
+	"""Tween which records the timings of each request, see module docstring.
+	"""
+	addServerTiming = asbool(registry.settings.get('biopyramid.metrics.server_timing', False))
+
+	def metricsTween(request):
+		start = time.perf_counter()
+		timings = {'lockWait':0, 'lockHold':0, 'readBytes':0, 'readObjects':0, 'renderStart':None}
+		_local.timings = timings
+		status = 500	# if the handler raises an exception
+		try:
+			response = handler(request)
+			status = response.status_int
+		finally:
+			_local.timings = None
+			recordTimings(request, timings, start, status)
+		if addServerTiming:
+			response.headers['Server-Timing'] = serverTiming(timings)
+		return response
+	return metricsTween
+
+def showMetrics(request):
+	"""Serve all metrics of this process in the Prometheus text format, to clients in biopyramid.metrics.allowed_hosts.
+	"""
+	allowed = aslist(request.registry.settings.get('biopyramid.metrics.allowed_hosts', '127.0.0.1 ::1'))
+	if request.remote_addr not in allowed:
+		raise HTTPForbidden()
+	return Response(collector.text(), content_type='text/plain', charset='utf-8')
+
+def includeme(config):
+	"""Set up metrics collection, called from main() when biopyramid.metrics.enabled is true.
+	"""
+	if lockTimed not in mutex.manager.timingHooks:
+		mutex.manager.timingHooks.append(lockTimed)
+	if objectRead not in bpdataset.readHooks:
+		bpdataset.readHooks.append(objectRead)
+	config.add_tween('biopyramid.views.metrics.metricsTweenFactory')
+	config.add_subscriber(beforeRender, BeforeRender)
+	config.add_route('/metrics', '/metrics')
+	config.add_view(showMetrics, route_name='/metrics')
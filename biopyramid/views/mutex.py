@@ -1,33 +1,246 @@
+"""
+Locking of HDF5 dataset files.
+
+Each file gets its own reader/writer lock, so reading one dataset never waits on another dataset, and
+any number of threads can read the same file at once. Only writing to a file requires exclusive access.
+Use the context managers:
+
+	with mutex.reading(filepath):
+		df = pandas.read_hdf(filepath, '/dataframe/samples')
+
+	with mutex.writing(filepath):
+		df.to_hdf(filepath, '/dataframe/samples')
+
+When several processes serve the same files (eg. multiple workers), the locks can also be extended across
+processes by setting manager.processLocks = True (biopyramid.model.process_locks in the config file), in
+which case an fcntl lock is taken on a "<filepath>.lock" file next to the dataset file.
+"""
+import os, time, threading, logging
+from contextlib import contextmanager
+
 import pandas
-from threading import Lock
-mutex = Lock()
+
+try:
+	import fcntl
+except ImportError:	# not available on Windows, where process locks are skipped
+	fcntl = None
+
+log = logging.getLogger(__name__)
+
+# --------------------------------------------------
+# Reader/writer lock
+# --------------------------------------------------
+class ReadWriteLock(object):
+	"""
+	Lock which allows many readers or one writer at a time. Waiting writers take priority over new readers,
+	so a stream of readers cannot starve a writer. The lock is re-entrant: a reader may read again, and the
+	writer may re-acquire the lock for both reading and writing, so functions which write can call functions
+	which read the same file.
+	"""
+	def __init__(self):
+		self._condition = threading.Condition(threading.Lock())
+		self._readers = {}	# {thread ident: number of times the read lock is held}
+		self._writer = None	# thread ident of the writer
+		self._writerCount = 0
+		self._waitingWriters = 0
+
+	def acquireRead(self):
+		ident = threading.current_thread().ident
+		with self._condition:
+			if self._writer==ident:
+				self._writerCount += 1
+				return
+			if ident not in self._readers:
+				while self._writer is not None or self._waitingWriters>0:
+					self._condition.wait()
+			self._readers[ident] = self._readers.get(ident, 0) + 1
+
+	def releaseRead(self):
+		ident = threading.current_thread().ident
+		with self._condition:
+			if self._writer==ident:
+				self._writerCount -= 1
+				return
+			self._readers[ident] -= 1
+			if self._readers[ident]==0:
+				del self._readers[ident]
+				if not self._readers:
+					self._condition.notify_all()
+
+	def acquireWrite(self):
+		ident = threading.current_thread().ident
+		with self._condition:
+			if self._writer==ident:
+				self._writerCount += 1
+				return
+			self._waitingWriters += 1
+			try:
+				while self._writer is not None or self._readers:
+					self._condition.wait()
+			finally:
+				self._waitingWriters -= 1
+			self._writer = ident
+			self._writerCount = 1
+
+	def heldForWriting(self):
+		"""Return True if the current thread holds this lock for writing.
+		"""
+		return self._writer==threading.current_thread().ident
+
+	def releaseWrite(self):
+		with self._condition:
+			self._writerCount -= 1
+			if self._writerCount==0:
+				self._writer = None
+				self._condition.notify_all()
+
+# --------------------------------------------------
+# Lock manager holding one lock per file
+# --------------------------------------------------
+class LockManager(object):
+	"""
+	Hold one ReadWriteLock per file path. Paths are normalised, so different ways of writing the same
+	path share a lock.
+	"""
+	def __init__(self, processLocks=False):
+		self.processLocks = processLocks
+		self._locks = {}
+		self._lock = threading.Lock()
+		self._local = threading.local()	# depth of nested acquisitions per file by the current thread
+		self.writeHooks = []	# functions called with the filepath whenever writing to a file starts, eg. to close open handles
+		self.timingHooks = []	# functions called with (filepath, exclusive, seconds waited, seconds held) when a lock is released
+
+	def lockFor(self, filepath):
+		"""Return the ReadWriteLock associated with filepath.
+		"""
+		key = os.path.abspath(filepath)
+		with self._lock:
+			if key not in self._locks:
+				self._locks[key] = ReadWriteLock()
+			return self._locks[key]
+
+	@contextmanager
+	def reading(self, filepath):
+		start, acquired = time.perf_counter(), None
+		outermost = self._depth(filepath)==0
+		lock = self.lockFor(filepath)
+		lock.acquireRead()
+		try:
+			with self._processLock(filepath, exclusive=False):
+				acquired = time.perf_counter()
+				yield
+		finally:
+			lock.releaseRead()
+			if outermost and acquired is not None:
+				self._timed(filepath, False, start, acquired)
+
+	@contextmanager
+	def writing(self, filepath):
+		start, acquired = time.perf_counter(), None
+		outermost = self._depth(filepath)==0
+		lock = self.lockFor(filepath)
+		lock.acquireWrite()
+		try:
+			with self._processLock(filepath, exclusive=True):
+				acquired = time.perf_counter()
+				for hook in self.writeHooks:
+					hook(filepath)
+				yield
+		finally:
+			lock.releaseWrite()
+			if outermost and acquired is not None:
+				self._timed(filepath, True, start, acquired)
+
+	def _depth(self, filepath):
+		# number of reading() or writing() blocks for filepath the current thread is inside
+		return self._local.__dict__.get('depths', {}).get(os.path.abspath(filepath), 0)
+
+	def _timed(self, filepath, exclusive, start, acquired):
+		# Only the outermost acquisition by a thread is reported, so nested reads are not counted twice
+		if self.timingHooks:
+			released = time.perf_counter()
+			for hook in self.timingHooks:
+				hook(filepath, exclusive, acquired - start, released - acquired)
+
+	@contextmanager
+	def _processLock(self, filepath, exclusive):
+		# Only the outermost acquisition by a thread takes the process lock: fcntl locks taken through
+		# different file objects of the same process would otherwise block each other.
+		key = os.path.abspath(filepath)
+		depths = self._local.__dict__.setdefault('depths', {})
+		depths[key] = depths.get(key, 0) + 1
+		try:
+			if depths[key]>1 or not self.processLocks or fcntl is None:
+				yield
+			else:
+				with self._fileLock(filepath, exclusive):
+					yield
+		finally:
+			depths[key] -= 1
+
+	@contextmanager
+	def _fileLock(self, filepath, exclusive):
+		try:
+			f = open("%s.lock" % filepath, 'a')
+		except (IOError, OSError):	# eg. read only directory, in which case there are no writers to protect against
+			log.debug("Could not open lock file for %s", filepath)
+			yield
+			return
+		try:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+			yield
+		finally:
+			fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+			f.close()
+
+manager = LockManager()
+
+def reading(filepath):
+	"""Context manager for shared (read) access to filepath.
+	"""
+	return manager.reading(filepath)
+
+def writing(filepath):
+	"""Context manager for exclusive (write) access to filepath.
+	"""
+	return manager.writing(filepath)
+
+def isWriting(filepath):
+	"""Return True if the current thread is inside writing(filepath).
+	"""
+	return manager.lockFor(filepath).heldForWriting()
 
 # --------------------------------------------------
 # Mutual exclusion method decorator
-# --------------------------------------------------	
+# --------------------------------------------------
+# Kept for code outside this package which still uses it. It serialises all calls across all files,
+# so use reading() or writing() above instead.
+mutex = threading.Lock()
+
 def mutual_exclusion(func):
 	def access_mutex(*args, **kwargs):
 		mutex.acquire()
-		try:	
+		try:
 			return func(*args, **kwargs)
 		finally:
 			mutex.release()
 	return access_mutex
-	
+
+# --------------------------------------------------
+# HDF5 File access
 # --------------------------------------------------
-# HDF5 File access mutual exclusion
-# --------------------------------------------------		
-@mutual_exclusion
 def read_hdf_mutex(dataset, attr):
-	return pandas.read_hdf(dataset, attr)
+	with reading(dataset):
+		return pandas.read_hdf(dataset, attr)
 
-@mutual_exclusion
 def hdf_attr_to_dict(filepath, attr):
-	store = pandas.HDFStore(filepath)
-	d = store[attr].to_dict()
-	store.close()
-	return d
+	with reading(filepath):
+		store = pandas.HDFStore(filepath, mode='r')	# default mode 'a' would update the file's modification time
+		try:
+			return store[attr].to_dict()
+		finally:
+			store.close()
 
-@mutual_exclusion
 def to_hdf_mutex(item, filepath, key):
-	item.to_hdf(filepath, key)
\ No newline at end of file
+	with writing(filepath):
+		item.to_hdf(filepath, key)
@@ -2,11 +2,13 @@
 This view runs all the relevant code for the "PCA" page, which performs a PCA plot on a dataset.
 """
 from pyramid.view import view_config
+from pyramid.settings import asbool
+from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest
 
 # This page uses some of the functions defined in datasets.py
-from biopyramid.views import datasets
+from biopyramid.views import datasets, httpcache, jobs
 
-@view_config(route_name='/pca', renderer='biopyramid:templates/pca.mako')
+@view_config(route_name='/pca', renderer='biopyramid:templates/pca.mako', decorator=httpcache.cached)
 def showPage(request):
 	"""Show the PCA page, which has a list of available datasets so that user can plot PCA for 
 	a different dataset after loading the page. The dataset can be selected by passing a parameter
@@ -24,11 +26,13 @@ def showPage(request):
 	# Fetch required properties. Note that pca coordinates have been saved already in the BPDataset instance for
 	# quick retrieval. coords should be in 2xN shape, where N is the number of samples in the dataset.
 	coords = dataset.pca.values.T[:2].tolist()
-	sampleIds = dataset.sampleIds()
-	sampleGroups = dataset.sampleGroups(returnType="display")
-	sampleGroupItems = dict([(item, dataset.sampleGroupItems(sampleGroup=item)) for item in sampleGroups])
-	sampleGroupColours = dict([(item, dataset.sampleGroupColours(sampleGroup=item)) for item in sampleGroups])
-	sampleIdsAsGroupItems = dict([(group, dataset.sampleGroupItems(sampleGroup=group, duplicates=True)) for group in sampleGroups])
+	# Sample group properties are computed once per dataset and kept in memory.
+	metadata = dataset.sampleGroupMetadata()
+	sampleIds = metadata['sampleIds']
+	sampleGroups = metadata['sampleGroups']
+	sampleGroupItems = metadata['sampleGroupItems']
+	sampleGroupColours = metadata['sampleGroupColours']
+	sampleIdsAsGroupItems = metadata['sampleIdsAsGroupItems']
 	
 	return {'datasetNames':datasetNames, 
 			'selectedDatasetName':selectedDatasetName, 
@@ -39,3 +43,51 @@ def showPage(request):
 			'sampleGroupColours':sampleGroupColours, 
 			'sampleIdsAsGroupItems':sampleIdsAsGroupItems}
 
+@view_config(route_name='/pca_coords', renderer='json', decorator=httpcache.cached)
+def pcaCoords(request):
+	"""Compute PCA coordinates for a subset of samples of a dataset. Parameters:
+		dataset: name of the dataset
+		sampleIds: comma separated list of sample ids to use (and/or sampleId parameter repeated), or
+		sampleGroup and sampleGroupItems: sample group and comma separated list of its items, eg: celltype and 'B1,B2',
+			to use samples belonging to these items. All samples are used if neither is specified.
+		expressionKey: expression data key of the matrix to use, first one of the dataset by default
+		numberOfGenes: number of genes with highest variance to use (default 1000)
+	Returns a dictionary in the same format as used by the PCA page:
+		{'sampleIds':['sample1',...], 'coords':[[2.1,0.2,...],[3.3,0.0,...]], 'sampleIdsAsGroupItems':{'celltype':['B1',...],...}}
+	If the samples selected match no samples of the dataset, the lists are empty.
+	Results are cached, so repeated calls with the same parameters are fast. Set biopyramid.model.store_pca
+	in the config file to also save them next to the dataset file (see bpdataset.pcaCachePath()).
+	PCA of large datasets runs in the job queue (see jobs.runJob()), and a 202 response with the job's status
+	is returned if it takes too long.
+	"""
+	dataset = datasets.datasetFromName(request, request.params.get("dataset"))
+	if dataset is None:
+		raise HTTPNotFound("No dataset named %s" % request.params.get("dataset"))
+
+	try:
+		numberOfGenes = int(request.params.get("numberOfGenes", 1000))
+	except ValueError:
+		raise HTTPBadRequest("numberOfGenes should be an integer")
+	if numberOfGenes<1:
+		raise HTTPBadRequest("numberOfGenes should be at least 1")
+
+	sampleIds = datasets.listParameter(request, 'sampleId', 'sampleIds')
+	sampleGroup = request.params.get("sampleGroup")
+	if sampleGroup:
+		if sampleGroup not in dataset.sampleGroups():
+			raise HTTPBadRequest("No sample group called %s" % sampleGroup)
+		items = set(datasets.listParameter(request, 'sampleGroupItem', 'sampleGroupItems'))
+		sampleIds.extend(dataset.samples.index[dataset.samples[sampleGroup].isin(items)].tolist())
+	elif not sampleIds:
+		sampleIds = None	# all samples
+
+	pca = jobs.runJob(request, dataset, 'pca', {'sampleIds':sampleIds, 
+												'expressionKey':request.params.get("expressionKey"),
+												'numberOfGenes':numberOfGenes,
+												'store':asbool(request.registry.settings.get('biopyramid.model.store_pca', False))})
+	sampleIds = pca['sampleIds']
+	samples = dataset._sampleRows(sampleIds)
+	return {'sampleIds':sampleIds,
+			'coords':pca['coords'] if sampleIds else [[], []],
+			'sampleIdsAsGroupItems':dict([(group, samples[group].where(samples[group].notnull(), None).tolist()) \
+										  for group in dataset.sampleGroups(returnType="display")])}
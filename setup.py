@@ -20,6 +20,10 @@ requires = [
     'waitress',
     ]
 
+tests_require = requires + [
+    'webtest',
+    ]
+
 setup(name='biopyramid',
       version='0.0.1a',
       description='biopyramid',
@@ -38,10 +42,16 @@ setup(name='biopyramid',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
-      tests_require=requires,
+      tests_require=tests_require,
       test_suite="biopyramid",
       entry_points="""\
       [paste.app_factory]
       main = biopyramid:main
+      [console_scripts]
+      biopyramid_memmap = biopyramid.scripts.memmap:main
+      biopyramid_repack = biopyramid.scripts.repack:main
+      biopyramid_prefork = biopyramid.scripts.prefork:main
+      biopyramid_ingest = biopyramid.scripts.ingest:main
+      biopyramid_benchmark = biopyramid.scripts.benchmark:main
       """,
       )